@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""Papers/sec of building papers from image-heavy source versions.
+
+Makes source versions whose pages each have a large photo on them, in a
+temporary directory, and builds papers from them in a pool of worker
+processes.  We compare calling `make_PDF` for each paper, which opens
+the sources and draws every mark again (how it used to be), with
+`build_all_papers`, where each worker keeps a `PaperBuilder`.
+
+Usage: python3 benchmarks/bench_build.py [--papers 40] [--pages 12]
+"""
+
+import argparse
+from io import BytesIO
+from multiprocessing import Pool
+import os
+import tempfile
+import time
+
+import fitz
+from PIL import Image
+
+from plom.produce import build_all_papers, paperdir
+from plom.produce.mergeAndCodePages import make_PDF
+
+
+def make_sources(pages, versions, image_size):
+    os.makedirs("sourceVersions")
+    for v in range(1, versions + 1):
+        doc = fitz.open()
+        for p in range(pages):
+            page = doc.newPage(width=612, height=792)
+            img = Image.effect_noise((image_size, image_size), 64).convert("RGB")
+            buf = BytesIO()
+            img.save(buf, "JPEG", quality=85)
+            page.insertImage(fitz.Rect(72, 100, 540, 700), stream=buf.getvalue())
+            page.insertText((72, 80), "Version {} page {}".format(v, p + 1))
+        doc.save("sourceVersions/version{}.pdf".format(v))
+
+
+def _make_PDF(x):
+    make_PDF(*x)
+
+
+def per_paper(spec, pvmap):
+    args = [
+        (
+            spec["name"],
+            spec["publicCode"],
+            spec["numberOfPages"],
+            spec["numberOfVersions"],
+            t,
+            pvmap[t],
+        )
+        for t in range(1, spec["numberToProduce"] + 1)
+    ]
+    with Pool() as pool:
+        list(pool.imap_unordered(_make_PDF, args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--papers", type=int, default=40)
+    parser.add_argument("--pages", type=int, default=12)
+    parser.add_argument("--versions", type=int, default=2)
+    parser.add_argument(
+        "--image-size", type=int, default=1600, help="pixels across each photo"
+    )
+    args = parser.parse_args()
+
+    spec = {
+        "name": "bench",
+        "publicCode": "270385",
+        "numberOfPages": args.pages,
+        "numberOfVersions": args.versions,
+        "numberToProduce": args.papers,
+        "numberToName": 0,
+    }
+    pvmap = {
+        t: {p: 1 + (t + p) % args.versions for p in range(1, args.pages + 1)}
+        for t in range(1, args.papers + 1)
+    }
+
+    cdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        try:
+            make_sources(args.pages, args.versions, args.image_size)
+            os.makedirs(paperdir)
+            for name, build in (
+                ("per paper", lambda: per_paper(spec, pvmap)),
+                ("builder", lambda: build_all_papers(spec, pvmap, None)),
+            ):
+                start = time.perf_counter()
+                build()
+                rate = args.papers / (time.perf_counter() - start)
+                print("{:>12}: {:8.2f} papers/sec".format(name, rate))
+        finally:
+            os.chdir(cdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""Requests/sec of authenticated routes under concurrent load.
+
+Serves a route decorated with `authenticate_by_token_required_fields`
+(backed by a real, temporary Plom database) and hammers it with many
+concurrent clients.  The route pretends to do some slow work, like
+building a large spreadsheet would.  We compare running handlers
+directly on the event loop (how it used to be) with the thread-pool
+dispatcher.
+
+Usage: python3 benchmarks/bench_dispatch.py [--clients 40] [--requests 400]
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+from plom.db import PlomDB
+from plom.server.authenticate import Authority
+from plom.server.dispatcher import Dispatcher
+from plom.server.plomServer import serverUserInit
+from plom.server.plomServer.routeutils import authenticate_by_token_required_fields
+
+
+class InlineDispatcher:
+    """Run everything directly on the event loop, as before."""
+
+    async def run(self, request, f, *args, **kwargs):
+        return f(*args, **kwargs)
+
+    def shutdown(self):
+        pass
+
+
+class BenchServer:
+    validate = serverUserInit.validate
+
+    def __init__(self, db, dispatcher):
+        self.DB = db
+        self.authority = Authority(None)
+        self.dispatcher = dispatcher
+
+
+class BenchHandler:
+    def __init__(self, server, work):
+        self.server = server
+        self.work = work
+
+    @authenticate_by_token_required_fields([])
+    def slow(self, data, request):
+        self.server.DB.getUserList()
+        time.sleep(self.work)
+        return web.json_response(True, status=200)
+
+
+async def hammer(port, token, clients, total):
+    url = "http://127.0.0.1:{}/slow".format(port)
+    payload = {"user": "bench", "token": token}
+    queue = asyncio.Queue()
+    for n in range(total):
+        queue.put_nowait(n)
+
+    async def client(session):
+        while not queue.empty():
+            queue.get_nowait()
+            async with session.get(url, json=payload) as response:
+                assert response.status == 200, response.status
+                await response.read()
+
+    async with aiohttp.ClientSession() as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[client(session) for _ in range(clients)])
+        return total / (time.perf_counter() - start)
+
+
+async def measure(db, dispatcher, clients, total, work, port):
+    server = BenchServer(db, dispatcher)
+    clientToken, storageToken = server.authority.create_token()
+    db.setUserToken("bench", storageToken)
+    handler = BenchHandler(server, work)
+    app = web.Application()
+    app.router.add_get("/slow", handler.slow)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    try:
+        return await hammer(port, clientToken, clients, total)
+    finally:
+        await runner.cleanup()
+        dispatcher.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=40)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--work", type=float, default=0.01, help="seconds of blocking work per request"
+    )
+    parser.add_argument("--port", type=int, default=41999)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = PlomDB(Path(tmpdir) / "bench.db")
+        db.createUser("bench", None)
+        loop = asyncio.get_event_loop()
+        for name, dispatcher in (
+            ("inline", InlineDispatcher()),
+            ("dispatched", Dispatcher(args.workers)),
+        ):
+            rate = loop.run_until_complete(
+                measure(
+                    db, dispatcher, args.clients, args.requests, args.work, args.port
+                )
+            )
+            print("{:>12}: {:8.1f} requests/sec".format(name, rate))
+
+
+if __name__ == "__main__":
+    main()
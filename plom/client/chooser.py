@@ -54,6 +54,7 @@ def readLastTime():
     lastTime["mouse"] = "right"
     lastTime["CommentsWarnings"] = True
     lastTime["MarkWarnings"] = True
+    lastTime["PrefetchDepth"] = 2
     # If config file exists, use it to update the defaults
     if os.path.isfile("plomConfig.toml"):
         with open("plomConfig.toml") as data_file:
@@ -156,6 +157,7 @@ class Chooser(QDialog):
         lastTime["MarkWarnings"] = stuff[4]
         lastTime["mouse"] = "left" if stuff[5] else "right"
         lastTime["SidebarOnRight"] = stuff[6]
+        lastTime["PrefetchDepth"] = stuff[7]
         logging.getLogger().setLevel(lastTime["LogLevel"].upper())
 
     def validate(self):
@@ -44,6 +44,7 @@ from PyQt5.QtWidgets import (
 )
 
 from plom.plom_exceptions import *
+from plom.textools import texFragmentHash
 from .annotator import Annotator
 from .comment_list import AddTagBox, commentLoadAll, commentIsVisible
 from .examviewwindow import ExamViewWindow
@@ -62,6 +63,9 @@ log = logging.getLogger("marker")
 tempDirectory = tempfile.TemporaryDirectory(prefix="plom_")
 directoryPath = tempDirectory.name
 
+# rendered latex comments are kept here between sessions
+latexCacheDirectory = "plomLatexCache"
+
 
 # Read https://mayaposch.wordpress.com/2011/11/01/how-to-really-truly-use-qthreads-the-full-explanation/
 # and https://stackoverflow.com/questions/6783194/background-thread-with-qthread-in-pyqt
@@ -113,39 +117,18 @@ class BackgroundDownloader(QThread):
             None
 
         """
-        attempts = 0
-        while True:
-            attempts += 1
-            # little sanity check - shouldn't be needed.
-            # TODO remove.
-            if attempts > 5:
-                return
-            # ask server for task-code of next task
-            try:
-                task = messenger.MaskNextTask(self.question, self.version)
-                if not task:  # no more tests left
-                    self.downloadNoneAvailable.emit()
-                    self.quit()
-                    return
-            except PlomSeriousException as err:
-                self.downloadFail.emit(str(err))
-                self.quit()
-                return
-
-            try:
-                (
-                    imageList,
-                    image_md5s,
-                    tags,
-                    integrity_check,
-                ) = messenger.MclaimThisTask(task)
-                break
-            except PlomTakenException as err:
-                log.info("will keep trying as task already taken: {}".format(err))
-                continue
-            except PlomSeriousException as err:
-                self.downloadFail.emit(str(err))
-                self.quit()
+        # server chooses and claims the next task for us
+        try:
+            claimed = messenger.MclaimNextTask(self.question, self.version)
+        except PlomSeriousException as err:
+            self.downloadFail.emit(str(err))
+            self.quit()
+            return
+        if claimed is None:  # no more tests left
+            self.downloadNoneAvailable.emit()
+            self.quit()
+            return
+        task, imageList, image_md5s, tags, integrity_check = claimed
 
         # Image names = "<task>.<imagenumber>.<extension>"
         inames = []
@@ -925,9 +908,10 @@ class MarkerClient(QWidget):
         self.annotatorSettings = defaultdict(
             lambda: None
         )  # settings variable for annotator settings (initially None)
-        self.commentCache = {}  # cache for Latex Comments
-        self.backgroundDownloader = None
+        self.commentCache = {}  # cache for Latex Comments, see latexAFragment
+        self.backgroundDownloaders = []
         self.backgroundUploader = None
+        self.prefetchDepth = 2  # how many papers to keep downloaded ahead
 
         self.allowBackgroundOps = True
         self.canViewAll = False
@@ -967,6 +951,7 @@ class MarkerClient(QWidget):
                  "MarkWarnings"
                  "mouse": left or right mouse hand
                  "SidebarOnRight": True if sidebar is on right
+                 "PrefetchDepth": number of papers to download ahead
                   }
                 and potentially others
 
@@ -1011,6 +996,8 @@ class MarkerClient(QWidget):
         self.ui.tableView.selectionModel().selectionChanged.connect(self.updateImg)
 
         self.requestNext()  # Get a question to mark from the server
+        if self.allowBackgroundOps:
+            self.requestNextInBackgroundStart()  # and a few more behind it
         self.testImg.resetB.animateClick()  # reset the view so whole exam shown.
         # resize the table too.
         QTimer.singleShot(100, self.ui.tableView.resizeRowsToContents)
@@ -1049,6 +1036,8 @@ class MarkerClient(QWidget):
         if lastTime.get("FOREGROUND", False):
             self.allowBackgroundOps = False
 
+        self.prefetchDepth = max(1, int(lastTime.get("PrefetchDepth", 2)))
+
         self.ui.sidebarRightCB.setChecked(lastTime.get("SidebarOnRight", False))
 
         if lastTime["upDown"] == "up":
@@ -1353,7 +1342,6 @@ class MarkerClient(QWidget):
         """
         Ask server for unmarked paper, get file, add to list, update view.
 
-        Retry a view times in case two clients are asking for same.
         Notes:
             Side effects: on success, updates the table of tasks
             TODO: return value on success?  Currently None.
@@ -1366,32 +1354,15 @@ class MarkerClient(QWidget):
             error if getting task from messenger throws PlomSeriousException
 
         """
-        attempts = 0
-        while True:
-            attempts += 1
-            # little sanity check - shouldn't be needed.
-            # TODO remove.
-            if attempts > 5:
-                return
-            # ask server for task of next task
-            try:
-                task = messenger.MaskNextTask(self.question, self.version)
-                if not task:
-                    return False
-            except PlomSeriousException as err:
-                self.throwSeriousError(err)
-
-            try:
-                (
-                    imageList,
-                    image_md5_list,
-                    tags,
-                    integrity_check,
-                ) = messenger.MclaimThisTask(task)
-                break
-            except PlomTakenException as err:
-                log.info("will keep trying as task already taken: {}".format(err))
-                continue
+        # server chooses and claims the next task for us
+        try:
+            claimed = messenger.MclaimNextTask(self.question, self.version)
+        except PlomSeriousException as err:
+            self.throwSeriousError(err)
+            return
+        if claimed is None:
+            return False
+        task, imageList, image_md5_list, tags, integrity_check = claimed
 
         # Image names = "<task>.<imagenumber>.<extension>"
         inames = []
@@ -1421,31 +1392,41 @@ class MarkerClient(QWidget):
 
     def requestNextInBackgroundStart(self):
         """
-        Requests the next TGV in the background.
+        Keep the next few TGVs downloading in the background.
+
+        Starts enough background downloaders that the papers ready to
+        mark plus those still downloading make up `self.prefetchDepth`.
+        Each downloader claims and fetches one paper; any papers left
+        unmarked are handed back to the server by `DNF` on shutdown.
 
         Returns:
             None
 
         """
-        if self.backgroundDownloader:
-            log.info(
-                "Previous Downloader ({}) still here, waiting".format(
-                    str(self.backgroundDownloader)
-                )
-            )
-            # if prev downloader still going than wait.  might block the gui
-            self.backgroundDownloader.wait()
-        self.backgroundDownloader = BackgroundDownloader(self.question, self.version)
-        self.backgroundDownloader.downloadSuccess.connect(
-            self._requestNextInBackgroundFinished
+        # forget about the downloaders that have finished
+        self.backgroundDownloaders = [
+            d for d in self.backgroundDownloaders if d.isRunning()
+        ]
+        wanted = (
+            self.prefetchDepth
+            - self.examModel.countReadyToMark()
+            - len(self.backgroundDownloaders)
         )
-        self.backgroundDownloader.downloadNoneAvailable.connect(
-            self.requestNextInBackgroundNoneAvailable
-        )
-        self.backgroundDownloader.downloadFail.connect(
-            self.requestNextInBackgroundFailed
-        )
-        self.backgroundDownloader.start()
+        for n in range(wanted):
+            downloader = BackgroundDownloader(self.question, self.version)
+            downloader.downloadSuccess.connect(self._requestNextInBackgroundFinished)
+            downloader.downloadNoneAvailable.connect(
+                self.requestNextInBackgroundNoneAvailable
+            )
+            downloader.downloadFail.connect(self.requestNextInBackgroundFailed)
+            self.backgroundDownloaders.append(downloader)
+            downloader.start()
+        if wanted > 0:
+            log.debug("Started {} background downloaders".format(wanted))
+
+    def _downloadsInProgress(self):
+        """True if any of the background downloaders are still running."""
+        return any(d.isRunning() for d in self.backgroundDownloaders)
 
     def _requestNextInBackgroundFinished(
         self, task, fnames, image_md5s, tags, integrity_check
@@ -1517,12 +1498,13 @@ class MarkerClient(QWidget):
         Returns:
              True if move was successful, False if not, for any reason.
         """
-        if self.backgroundDownloader:
+        if self.backgroundDownloaders:
             # Might need to wait for a background downloader.  Important to
             # processEvents() so we can receive the downloader-finished signal.
-            # TODO: assumes the downloader tries to stay just one ahead.
             count = 0
-            while self.backgroundDownloader.isRunning():
+            while (
+                self.examModel.countReadyToMark() == 0 and self._downloadsInProgress()
+            ):
                 time.sleep(0.05)
                 self.Qapp.processEvents()
                 count += 1
@@ -1642,8 +1624,7 @@ class MarkerClient(QWidget):
             return
 
         if self.allowBackgroundOps:
-            if self.examModel.countReadyToMark() == 0:
-                self.requestNextInBackgroundStart()
+            self.requestNextInBackgroundStart()
 
         self.startTheAnnotator(inidata)
         # we started the annotator, we'll get a signal back when its done
@@ -1687,13 +1668,14 @@ class MarkerClient(QWidget):
         # Yes do this even for a regrade!  We will recreate the annotations
         # (using the plom file) on top of the original file.
         fnames = self.examModel.getOriginalFiles(task)
-        if self.backgroundDownloader:
+        if self.backgroundDownloaders:
             count = 0
-            # Notes: we could check using `while not os.path.exists(fname):`
-            # Or we can wait on the downloader, which works when there is only
-            # one download thread.  Better yet might be a dict/database that
-            # we update on downloadFinished signal.
-            while self.backgroundDownloader.isRunning():
+            # Papers only reach the table once downloaded, so normally the
+            # files are already here.  Otherwise wait on the downloaders.
+            while (
+                not all(os.path.exists(fn) for fn in fnames)
+                and self._downloadsInProgress()
+            ):
                 time.sleep(0.1)
                 count += 1
                 # if .remainder(count, 10) == 0: # this is only python3.7 and later. - see #509
@@ -1907,8 +1889,7 @@ class MarkerClient(QWidget):
         if self.allowBackgroundOps:
             # while annotator is firing up request next paper in background
             # after giving system a moment to do `annotator.exec_()`
-            if self.examModel.countReadyToMark() == 0:
-                self.requestNextInBackgroundStart()
+            self.requestNextInBackgroundStart()
 
         return data
 
@@ -2063,6 +2044,12 @@ class MarkerClient(QWidget):
                         break
             self.backgroundUploader.wait()
 
+        # Let any downloads in progress finish: the papers they claimed
+        # reach the table when we process their signals, and so get DNF'd.
+        for downloader in self.backgroundDownloaders:
+            downloader.wait()
+        self.Qapp.processEvents()
+
         # When shutting down, first alert server of any images that were
         # not marked - using 'DNF' (did not finish). Sever will put
         # those files back on the todo pile.
@@ -2143,43 +2130,69 @@ class MarkerClient(QWidget):
                 os.unlink(f)
 
     def cacheLatexComments(self):
-        """Caches Latexed comments."""
+        """Caches Latexed comments.
+
+        Any not already on disk from a previous session are rendered by
+        the server in a single request.
+        """
         clist = commentLoadAll()
-        # sort list in order of longest comment to shortest comment
-        clist.sort(key=lambda C: -len(C["text"]))
-
-        # Build a progress dialog to warn user
-        pd = QProgressDialog("Caching latex comments", None, 0, 2 * len(clist), self)
-        pd.setWindowModality(Qt.WindowModal)
-        pd.setMinimumDuration(0)
-        pd.setAutoClose(True)
-        # Start caching.
-        c = 0
         n = int(self.question)
         exam_name = self.exam_spec["name"]
 
+        fragments = []
         for X in clist:
             if commentIsVisible(X, n, exam_name) and X["text"][:4].upper() == "TEX:":
                 txt = X["text"][4:].strip()
-                pd.setLabelText("Caching:\n{}".format(txt[:64]))
-                # latex the red version
-                self.latexAFragment(txt)
-                c += 1
-                pd.setValue(c)
-                # and latex the preview
-                txtp = "\\color{blue}" + txt  # make color blue for ghost rendering
-                self.latexAFragment(txtp)
-                c += 1
-                pd.setValue(c)
-            else:
-                c += 2
-                pd.setValue(c)
+                # the red version and the blue preview for ghost rendering
+                for frag in (txt, "\\color{blue}" + txt):
+                    if frag not in fragments:
+                        fragments.append(frag)
+
+        missing = [
+            frag for frag in fragments if not os.path.isfile(self._latexCacheFile(frag))
+        ]
+        if missing:
+            log.info("requesting latex for {} comments".format(len(missing)))
+            pd = QProgressDialog("Caching latex comments", None, 0, 0, self)
+            pd.setWindowModality(Qt.WindowModal)
+            pd.setMinimumDuration(0)
+            pd.show()
+            self.Qapp.processEvents()
+            try:
+                images = messenger.MlatexFragments(missing)
+            finally:
+                pd.close()
+            for frag, image in zip(missing, images):
+                if image is not None:
+                    self._saveLatexFragment(frag, image)
+
+        for frag in fragments:
+            if os.path.isfile(self._latexCacheFile(frag)):
+                self.commentCache[frag] = self._latexCacheFile(frag)
+
+    @staticmethod
+    def _latexCacheFile(txt):
+        """The file in which the rendered image of some latex is kept."""
+        return os.path.join(latexCacheDirectory, texFragmentHash(txt) + ".png")
+
+    def _saveLatexFragment(self, txt, image):
+        """Write the rendered image of some latex to the on-disk cache."""
+        os.makedirs(latexCacheDirectory, exist_ok=True)
+        fragFile = self._latexCacheFile(txt)
+        # write elsewhere then move, so a partial file is never in the cache
+        with tempfile.NamedTemporaryFile(
+            dir=latexCacheDirectory, suffix=".tmp", delete=False
+        ) as fh:
+            fh.write(image)
+        os.replace(fh.name, fragFile)
+        return fragFile
 
     def latexAFragment(self, txt):
         """
         Run LaTeX on a fragment of text and return the file name of a png.
 
-        The files are cached for reuse if the same text is passed again.
+        The files are cached for reuse if the same text is passed again,
+        both in this session and on disk for later ones.
 
         Args:
             txt (str): the text to be Latexed.
@@ -2191,18 +2204,14 @@ class MarkerClient(QWidget):
         if txt in self.commentCache:
             # have already latex'd this comment
             return self.commentCache[txt]
-        log.debug('requesting latex for "{}"'.format(txt))
-        try:
-            fragment = messenger.MlatexFragment(txt)
-        except PlomLatexException:
-            return None
-        # a name for the fragment file
-        fragFile = tempfile.NamedTemporaryFile(
-            dir=self.workingDirectory, suffix=".png", delete=False
-        ).name
-        # save it
-        with open(fragFile, "wb+") as fh:
-            fh.write(fragment)
+        fragFile = self._latexCacheFile(txt)
+        if not os.path.isfile(fragFile):
+            log.debug('requesting latex for "{}"'.format(txt))
+            try:
+                fragment = messenger.MlatexFragment(txt)
+            except PlomLatexException:
+                return None
+            self._saveLatexFragment(txt, fragment)
         # add it to the cache
         self.commentCache[txt] = fragFile
         return fragFile
@@ -197,17 +197,12 @@ def startMarking(question, version):
     print("Maximum mark = ", maxMark)
     k = 0
     while True:
-        task = messenger.MaskNextTask(question, version)
-        if task is None:
+        claimed = messenger.MclaimNextTask(question, version)
+        if claimed is None:
             print("No more tasks.")
             break
-        # print("Trying to claim next ask = ", task)
-        try:
-            print("Marking task ", task)
-            imageList, image_ids, tags, integrity_check = messenger.MclaimThisTask(task)
-        except PlomTakenException as e:
-            print("Another user got that task. Trying again.")
-            continue
+        task, imageList, image_ids, tags, integrity_check = claimed
+        print("Marking task ", task)
 
         with tempfile.TemporaryDirectory() as td:
             aFile = os.path.join(td, "argh.png")
@@ -18,6 +18,7 @@ from PyQt5.QtWidgets import (
     QLineEdit,
     QMessageBox,
     QPushButton,
+    QSpinBox,
     QTableView,
     QToolButton,
     QVBoxLayout,
@@ -253,6 +254,11 @@ class ClientSettingsDialog(QDialog):
         # moreinfo.setWordWrap(True)
         flay.addWidget(moreinfo)
 
+        self.spinPrefetch = QSpinBox()
+        self.spinPrefetch.setRange(1, 10)
+        self.spinPrefetch.setValue(int(s.get("PrefetchDepth", 2)))
+        flay.addRow("Papers to download ahead:", self.spinPrefetch)
+
         line = QFrame()
         line.setFrameShape(QFrame.HLine)
         line.setFrameShadow(QFrame.Sunken)
@@ -310,4 +316,5 @@ class ClientSettingsDialog(QDialog):
             self.checkWarnMark.checkState() == Qt.Checked,
             self.leftHandMouse.checkState() == Qt.Checked,
             self.checkSidebarOnRight.checkState() == Qt.Checked,
+            self.spinPrefetch.value(),
         )
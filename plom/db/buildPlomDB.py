@@ -66,29 +66,14 @@ def buildExamDatabaseFromSpec(spec, db):
         status += "Error making bundle for replacement pages"
 
     # Note: need to produce these in a particular order for random seed to be
-    # reproducibile: so this really must be a loop, not a Pool.
+    # reproducibile: so this really must be a loop, not a Pool.  We work out
+    # the versions of every paper first and then create them all at once.
+    qvmap = {}
+    # what to report for each paper once it is created
+    entries = []
     for t in range(1, spec["numberToProduce"] + 1):
-        log.info(
-            "Creating DB entry for test {} of {}.".format(t, spec["numberToProduce"])
-        )
-        if db.createTest(t):
-            status += "DB entry for test {:04}:".format(t)
-        else:
-            status += " Error creating"
-            ok = False
-
-        if db.createIDGroup(t, spec["idPages"]["pages"]):
-            status += " ID"
-        else:
-            status += " Error creating idgroup"
-            ok = False
-
-        if db.createDNMGroup(t, spec["doNotMark"]["pages"]):
-            status += " DNM"
-        else:
-            status += "Error creating DoNotMark-group"
-            ok = False
-
+        qvmap[t] = {}
+        entry = "DB entry for test {:04}: ID DNM".format(t)
         for g in range(spec["numberOfQuestions"]):  # runs from 0,1,2,...
             gs = str(g + 1)  # now a str and 1,2,3,...
             if (
@@ -108,12 +93,19 @@ def buildExamDatabaseFromSpec(spec, db):
                         spec["question"][gs]["select"]
                     )
                 )
-            if db.createQGroup(t, int(gs), v, spec["question"][gs]["pages"]):
-                status += " Q{}{}".format(gs, vstr)
-            else:
-                status += "Error creating Question {} ver {}".format(gs, vstr)
-                ok = False
-        status += "\n"
+            qvmap[t][int(gs)] = v
+            entry += " Q{}{}".format(gs, vstr)
+        entries.append(entry + "\n")
+
+    log.info("Creating DB entries for {} tests.".format(spec["numberToProduce"]))
+    question_pages = {int(gs): spec["question"][gs]["pages"] for gs in spec["question"]}
+    if db.createTests(
+        qvmap, spec["idPages"]["pages"], spec["doNotMark"]["pages"], question_pages
+    ):
+        status += "".join(entries)
+    else:
+        status += "Error creating tests"
+        ok = False
 
     print("ok, status = ", ok, status)
     return ok, status
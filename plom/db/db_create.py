@@ -79,6 +79,34 @@ def createNewBundle(self, bundle_name, md5):
         return [False, bundle_check[1]]
 
 
+def checkBundleManifest(self, bundle_name, manifest):
+    """Compare a list of the pages of a bundle with those we already have.
+
+    Args:
+        bundle_name (str): name of an existing bundle.
+        manifest (list): pairs `[bundle_order, md5sum]`, one for each
+            page the client has.
+
+    Returns:
+        list: `[True, needed, mismatched]` where `needed` are the
+            bundle_orders we do not have yet and `mismatched` those we
+            have but with a different md5sum.  Or `[False, reason]`.
+    """
+    bref = Bundle.get_or_none(name=bundle_name)
+    if bref is None:
+        return [False, "no such bundle"]
+    query = Image.select(Image.bundle_order, Image.md5sum).where(Image.bundle == bref)
+    known = {iref.bundle_order: iref.md5sum for iref in query}
+    needed = []
+    mismatched = []
+    for bundle_order, md5 in manifest:
+        if bundle_order not in known:
+            needed.append(bundle_order)
+        elif known[bundle_order] != md5:
+            mismatched.append(bundle_order)
+    return [True, needed, mismatched]
+
+
 ########## Test creation stuff ##############
 def areAnyPapersProduced(self):
     """True if any papers have been produced."""
@@ -231,6 +259,8 @@ def createQGroup(self, t, q, v, pages):
         try:
             uref = User.get(name="HAL")
             aref = Annotation.create(qgroup=qref, edition=0, user=uref)
+            qref.current_annotation = aref
+            qref.save()
         except pw.IntegrityError as e:
             log.error(
                 "Create Q - cannot create Annotation  of question {} error - {}.".format(
@@ -242,6 +272,117 @@ def createQGroup(self, t, q, v, pages):
         return self.addTPages(tref, gref, t, pages, v)
 
 
+# rows per INSERT: keeps the number of sql variables well below sqlite's limit
+_insert_chunk_size = 100
+# how many ids to put in one "IN (...)" clause
+_chunk_size = 500
+
+
+def createTests(self, qvmap, id_pages, dnm_pages, question_pages):
+    """Create many papers at once, with all their groups and pages.
+
+    Does the same as calling :func:`createTest`, :func:`createIDGroup`,
+    :func:`createDNMGroup` and :func:`createQGroup` for each paper, but
+    works out all the rows first and inserts them in bulk in a single
+    transaction.  Groups are queued in the same order too.
+
+    Args:
+        qvmap (dict): keys are paper numbers, values are dicts of
+            question number to version.
+        id_pages (list): page numbers of the ID group.
+        dnm_pages (list): page numbers of the do-not-mark group, maybe
+            empty.
+        question_pages (dict): keys are question numbers, values are
+            lists of page numbers.
+
+    Returns:
+        bool: True if all created, False (and nothing created) if
+            something already existed.
+    """
+    tests = sorted(qvmap)
+    position = self.nextqueue_position()
+    groups = []
+    # for each group: its gid, its IDGroup/DNMGroup/QGroup row and its pages
+    members = []
+    for t in tests:
+        todo = [
+            ("i{:04}".format(t), "i", IDGroup, {}, id_pages, 1),
+            ("d{:04}".format(t), "d", DNMGroup, {}, dnm_pages, 1),
+        ]
+        for q, v in sorted(qvmap[t].items()):
+            row = {"question": q, "version": v}
+            todo.append(
+                ("q{:04}g{}".format(t, q), "q", QGroup, row, question_pages[q], v)
+            )
+        for gid, gtype, table, row, pp, v in todo:
+            # A DNM group may have 0 pages, in that case mark it as scanned
+            groups.append(
+                dict(
+                    test=t,
+                    gid=gid,
+                    group_type=gtype,
+                    scanned=len(pp) == 0,
+                    queue_position=position,
+                )
+            )
+            position += 1
+            members.append((gid, table, dict(row, test=t), [(t, p, v) for p in pp]))
+    # if any of these already exists, inserting fails and rolls back
+    first, last = tests[0], tests[-1]
+
+    uref = User.get(name="HAL")
+    try:
+        with plomdb.atomic():
+            for chunk in pw.chunked(tests, _insert_chunk_size):
+                Test.insert_many([{"test_number": t} for t in chunk]).execute()
+            for chunk in pw.chunked(groups, _insert_chunk_size):
+                Group.insert_many(chunk).execute()
+            # now we know the ids of the groups
+            gids = {}
+            for chunk in pw.chunked(tests, _insert_chunk_size):
+                query = Group.select(Group.id, Group.gid).where(Group.test.in_(chunk))
+                gids.update((gref.gid, gref.id) for gref in query)
+            rows = {IDGroup: [], DNMGroup: [], QGroup: []}
+            tpages = []
+            for gid, table, row, pp in members:
+                rows[table].append(dict(row, group=gids[gid]))
+                tpages.extend(
+                    {
+                        "test": t,
+                        "group": gids[gid],
+                        "page_number": p,
+                        "version": v,
+                        "scanned": False,
+                    }
+                    for t, p, v in pp
+                )
+            for table in (IDGroup, DNMGroup, QGroup):
+                for chunk in pw.chunked(rows[table], _insert_chunk_size):
+                    table.insert_many(chunk).execute()
+            # annotation 0 of each question, owned by HAL
+            qids = []
+            for chunk in pw.chunked(tests, _insert_chunk_size):
+                query = QGroup.select(QGroup.id).where(QGroup.test.in_(chunk))
+                qids.extend(qref.id for qref in query)
+            zeroth = Annotation.select(Annotation.id).where(
+                (Annotation.qgroup == QGroup.id) & (Annotation.edition == 0)
+            )
+            for chunk in pw.chunked(qids, _insert_chunk_size):
+                Annotation.insert_many(
+                    [{"qgroup": qid, "edition": 0, "user": uref} for qid in chunk]
+                ).execute()
+                QGroup.update(current_annotation=zeroth).where(
+                    QGroup.id.in_(chunk)
+                ).execute()
+            for chunk in pw.chunked(tpages, _insert_chunk_size):
+                TPage.insert_many(chunk).execute()
+    except pw.IntegrityError as e:
+        log.error("Create tests {}-{} error - {}".format(first, last, e))
+        return False
+    log.info("Created {} tests and {} groups".format(len(tests), len(groups)))
+    return True
+
+
 def getPageVersions(self, t):
     """Get the mapping between page numbers and version for a test.
 
@@ -260,6 +401,20 @@ def getPageVersions(self, t):
         return pvDict
 
 
+def getAllPageVersions(self):
+    """Get the mapping between page numbers and version for all tests.
+
+    Returns:
+        dict: keys are paper numbers (int), values are dicts as in
+            :func:`getPageVersions`.
+    """
+    pvmap = {}
+    query = TPage.select(TPage.test, TPage.page_number, TPage.version)
+    for t, p, v in query.tuples():
+        pvmap.setdefault(t, {})[p] = v
+    return pvmap
+
+
 def produceTest(self, t):
     """Someone has told us they produced (made PDF) for this paper.
 
@@ -286,6 +441,66 @@ def produceTest(self, t):
         log.info('Paper {} is set to "produced"'.format(t))
 
 
+def produceTests(self, papers, rebuilt=()):
+    """Someone has told us they produced (made PDFs for) these papers.
+
+    Telling us again about a paper that was produced is fine provided
+    the md5sum is the same as before.  Either all the papers are set to
+    "produced" or, if there is an exception, none are.
+
+    Args:
+        papers (list): pairs `[t, md5sum]` of the paper number and the
+            md5sum of its PDF file, which may be None.
+        rebuilt (list): paper numbers that were made again, e.g., to
+            print a name on them, so replace their md5sums rather than
+            complaining.  Not those already used (scanned pages have
+            been uploaded): those are out there already.
+
+    Exceptions:
+        IndexError: no such paper exists.
+        ValueError: a paper was already produced, from a different or
+            unknown PDF file, and was not rebuilt or is already used.
+    """
+    md5s = {int(t): md5 for t, md5 in papers}
+    with plomdb.atomic():
+        known = {}
+        for chunk in pw.chunked(list(md5s), _chunk_size):
+            query = Test.select(Test.test_number, Test.produced, Test.md5sum, Test.used)
+            for tref in query.where(Test.test_number.in_(chunk)):
+                known[tref.test_number] = tref
+        missing = sorted(set(md5s) - set(known))
+        if missing:
+            log.error(
+                'Cannot set papers {} to "produced" - no such papers'.format(missing)
+            )
+            raise IndexError(
+                "Paper numbers {} do not exist: out of range?".format(missing)
+            )
+        again = sorted(
+            t
+            for t, tref in known.items()
+            if tref.produced and (md5s[t] is None or tref.md5sum != md5s[t])
+        )
+        rebuilt = set(rebuilt)
+        used = [t for t in again if t in rebuilt and known[t].used]
+        if used:
+            log.error('Papers {} were rebuilt but are already "used"!'.format(used))
+            raise ValueError("Papers {} are already in use".format(used))
+        refused = [t for t in again if t not in rebuilt]
+        if refused:
+            log.error('Papers {} were already "produced"!'.format(refused))
+            raise ValueError("Papers {} were already produced".format(refused))
+        if again:
+            log.info('Papers {} were "produced" again'.format(again))
+        todo = [t for t, tref in known.items() if not tref.produced] + again
+        Test.bulk_update(
+            [Test(test_number=t, produced=True, md5sum=md5s[t]) for t in todo],
+            fields=[Test.produced, Test.md5sum],
+            batch_size=_insert_chunk_size,
+        )
+    log.info('{} papers are set to "produced"'.format(len(todo)))
+
+
 def id_paper(self, paper_num, user_name, sid, sname):
     """Associate student name and id with a paper in the database.
 
@@ -56,7 +56,7 @@ def MgetDoneTasks(self, user_name, q, v):
     )
     mark_list = []
     for qref in query:  # grab that questionData object
-        aref = qref.annotations[-1]  # grab the last annotation
+        aref = qref.current_annotation
         mark_list.append(
             [
                 qref.group.gid,
@@ -85,6 +85,7 @@ def MgetNextTask(self, q, v):
                     QGroup.version == v,
                     Group.scanned == True,
                 )
+                .order_by(Group.queue_position)
                 .get()
             )
         except QGroup.DoesNotExist as e:
@@ -125,7 +126,7 @@ def MgiveTaskToClient(self, user_name, group_id):
         # - create a new annotation copied from the previous one (inc the integrity_check code)
         # but we give the marker the pages from the **existing** annotation
         # when task comes back we create the new pages
-        aref = qref.annotations[-1]  # are these in right order
+        aref = qref.current_annotation
         new_aref = Annotation.create(
             qgroup=qref,
             user=uref,
@@ -134,6 +135,8 @@ def MgiveTaskToClient(self, user_name, group_id):
             time=datetime.now(),
             integrity_check=aref.integrity_check,
         )
+        qref.current_annotation = new_aref
+        qref.save()
         # get list of image-md5s to send to marker, but defer apage creation
         image_md5_list = []
         for p in aref.apages.order_by(APage.order):
@@ -155,6 +158,35 @@ def MgiveTaskToClient(self, user_name, group_id):
         return rval
 
 
+def MgiveNextTaskToClient(self, user_name, q, v):
+    """Take the next unmarked (but scanned) q/v-group off the queue and assign it to the given user.
+    Unlike calling MgetNextTask and then MgiveTaskToClient, the task is
+    found and claimed in one transaction so two markers cannot race for it.
+    Return [True, group-id, tags, integrity_check, [image-md5s], image0, image1,...]
+    or [False] if there is nothing left on the to-do pile.
+    """
+    with plomdb.atomic():
+        gref = (
+            Group.select()
+            .join(QGroup)
+            .where(
+                QGroup.status == "todo",
+                QGroup.question == q,
+                QGroup.version == v,
+                Group.scanned == True,
+            )
+            .order_by(Group.queue_position)
+            .first()
+        )
+        if gref is None:
+            log.info("Nothing left on Q{}v{} to-do pile".format(q, v))
+            return [False]
+        rval = self.MgiveTaskToClient(user_name, gref.gid)
+        if rval[0] is False:  # this should not happen
+            return [False]
+        return [True, gref.gid] + rval[1:]
+
+
 def MdidNotFinish(self, user_name, group_id):
     """When user logs off, any images they have still out should be put
     back on todo pile. This returns the given gid to the todo pile.
@@ -178,10 +210,13 @@ def MdidNotFinish(self, user_name, group_id):
         qref.user = None
         qref.marked = False
         # delete the annotation.
-        aref = qref.annotations[-1]
+        aref = qref.current_annotation
         for p in aref.apages:  # this should not be needed.
             p.delete_instance()
         aref.delete_instance()
+        qref.current_annotation = qref.annotations.order_by(
+            Annotation.edition.desc()
+        ).get()
         # now clean up the qgroup
         qref.test.marked = False
         qref.test.save()
@@ -236,7 +271,7 @@ def MtakeTaskFromClient(
         if qref.user != uref:  # this should not happen
             return [False, "not_owner"]  # has been claimed by someone else.
         # check the integrity_check code against the db
-        aref = qref.annotations[-1]
+        aref = qref.current_annotation
         if aref.integrity_check != integrity_check:
             return [False, "integrity_fail"]
         # check all the images actually come from this test - sanity check against client error
@@ -323,7 +358,7 @@ def MgetImages(self, user_name, task, integrity_check):
                 "Task {} does not belong to user {}".format(task, user_name),
             ]
         # check the integrity_check code against the db
-        aref = qref.annotations[-1]
+        aref = qref.current_annotation
         if aref.integrity_check != integrity_check:
             return [False, "integrity_fail"]
         # return [true, n, page1,..,page.n]
@@ -373,7 +408,7 @@ def MsetTag(self, user_name, task, tag):
         if qref.user != uref:
             return False  # not your task - should not happen
         # grab the last annotation
-        aref = qref.annotations[-1]
+        aref = qref.current_annotation
         if aref.user != uref:
             return False  # not your annotation - should not happen
         # update tag
@@ -406,9 +441,14 @@ def MgetWholePaper(self, test_number, question):
     # have to be a little careful
     # - if fresh annotation, then no apages present - grab from the previous annotation
     # - if reannotating, then apages present - grab from the current annotation.
-    aref = qref.annotations[-1]
+    aref = qref.current_annotation
     if aref.apages.count() == 0:  # no apages - must be fresh annotation
-        aref = qref.annotations[-2]  # grab from previous annot.
+        # grab from previous annot.
+        aref = (
+            qref.annotations.where(Annotation.edition < aref.edition)
+            .order_by(Annotation.edition.desc())
+            .get()
+        )
     for pref in aref.apages:
         current_image_orders[pref.image.id] = pref.order
     # give TPages (aside from ID pages), then HWPages, then EXPages, and then LPages
@@ -549,5 +589,9 @@ def MrevertTask(self, task):
             aref.aimage.delete_instance()
             # finally delete the annotation itself.
             aref.delete_instance()
-    log.info("Reverting tq {}.{}".format(test_number, question))
+        qref.current_annotation = qref.annotations.order_by(
+            Annotation.edition.desc()
+        ).get()
+        qref.save()
+    log.info("Reverting tq {}.{}".format(tref.test_number, qref.question))
     return [True]
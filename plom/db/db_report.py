@@ -1,4 +1,5 @@
 from plom.db.tables import *
+import peewee as pw
 from datetime import datetime, timedelta
 
 import logging
@@ -153,31 +154,40 @@ def RgetProgress(self, q, v):
     # set up a time-delta of 1 hour for calc of number done recently.
     one_hour = timedelta(hours=1)
 
-    NScanned = 0  # number scanned
-    NMarked = 0  # number marked
-    NRecent = 0  # number marked in the last hour
-    SMark = 0  # sum mark - for computing average
-    SMTime = 0  # sum marking time - for computing average
-
-    for qref in (
+    NScanned = (
         QGroup.select()
         .join(Group)
         .where(QGroup.question == q, QGroup.version == v, Group.scanned == True,)
-    ):
-        NScanned += 1
-        if qref.marked == True:
-            NMarked += 1
-            SMark += qref.annotations[-1].mark
-            SMTime += qref.annotations[-1].marking_time
-            if datetime.now() - qref.annotations[-1].time < one_hour:
-                NRecent += 1
+        .count()
+    )
+    # count, sum of marks and marking times of the current annotations
+    query = (
+        QGroup.select(
+            pw.fn.COUNT(Annotation.id),
+            pw.fn.SUM(Annotation.mark),
+            pw.fn.SUM(Annotation.marking_time),
+            pw.fn.SUM(
+                pw.Case(None, [(Annotation.time > datetime.now() - one_hour, 1)], 0)
+            ),
+        )
+        .join(Annotation, on=(QGroup.current_annotation == Annotation.id))
+        .switch(QGroup)
+        .join(Group)
+        .where(
+            QGroup.question == q,
+            QGroup.version == v,
+            QGroup.marked == True,
+            Group.scanned == True,
+        )
+    )
+    NMarked, SMark, SMTime, NRecent = query.tuples().get()
 
     log.debug("Sending progress summary for Q{}v{}".format(q, v))
     if NMarked == 0:  # in case nothing done.
         return {
             "NScanned": NScanned,
             "NMarked": NMarked,
-            "NRecent": NRecent,
+            "NRecent": 0,
             "avgMark": None,
             "avgMTime": None,
         }
@@ -195,8 +205,12 @@ def RgetMarkHistogram(self, q, v):
     """Return a dict of dicts containing histogram of marks for the given q/v as hist[user][question][mark]=count.
     """
     histogram = {}
-    for qref in (
-        QGroup.select()
+    query = (
+        QGroup.select(User.name, Annotation.mark, pw.fn.COUNT(QGroup.id))
+        .join(Annotation, on=(QGroup.current_annotation == Annotation.id))
+        .switch(QGroup)
+        .join(User, on=(QGroup.user == User.id))
+        .switch(QGroup)
         .join(Group)
         .where(
             QGroup.question == q,
@@ -204,15 +218,10 @@ def RgetMarkHistogram(self, q, v):
             QGroup.marked == True,
             Group.scanned == True,
         )
-    ):
-        # make sure user.name in histogram
-        if qref.user.name not in histogram:
-            histogram[qref.user.name] = {}
-        # make sure the mark is in the dict for that user
-        if qref.annotations[-1].mark not in histogram[qref.user.name]:
-            histogram[qref.user.name][qref.annotations[-1].mark] = 0
-        # add to the count.
-        histogram[qref.user.name][qref.annotations[-1].mark] += 1
+        .group_by(User.name, Annotation.mark)
+    )
+    for user_name, mark, count in query.tuples():
+        histogram.setdefault(user_name, {})[mark] = count
     log.debug("Sending mark histogram for Q{}v{}".format(q, v))
     return histogram
 
@@ -240,22 +249,29 @@ def RgetQuestionUserProgress(self, q, v):
     """For the given q/v return the number of questions marked by each user (who marked something in this q/v - so no zeros).
     Return a list of the form [ number_scanned, [user, nmarked], [user, nmarked], etc]
     """
-    user_counts = {}
-    number_scanned = 0
-    for qref in (
+    number_scanned = (
         QGroup.select()
         .join(Group)
         .where(QGroup.question == q, QGroup.version == v, Group.scanned == True,)
-    ):
-        number_scanned += 1
-        if qref.marked == True:
-            if qref.user.name not in user_counts:
-                user_counts[qref.user.name] = 0
-            user_counts[qref.user.name] += 1
+        .count()
+    )
+    query = (
+        QGroup.select(User.name, pw.fn.COUNT(QGroup.id))
+        .join(User, on=(QGroup.user == User.id))
+        .switch(QGroup)
+        .join(Group)
+        .where(
+            QGroup.question == q,
+            QGroup.version == v,
+            QGroup.marked == True,
+            Group.scanned == True,
+        )
+        .group_by(User.name)
+    )
     # build return list
     progress = [number_scanned]
-    for user in user_counts:
-        progress.append([user, user_counts[user]])
+    for user_name, count in query.tuples():
+        progress.append([user_name, count])
     log.debug("Sending question/user progress for Q{}v{}".format(q, v))
     return progress
 
@@ -298,7 +314,7 @@ def RgetOutToDo(self):
                     qref.test.test_number, qref.question, qref.version
                 ),
                 qref.user.name,
-                qref.annotations[-1].time.strftime("%y:%m:%d-%H:%M:%S"),
+                qref.current_annotation.time.strftime("%y:%m:%d-%H:%M:%S"),
             ]
         )
     log.debug("Sending list of tasks that are still out")
@@ -340,8 +356,8 @@ def RgetStatus(self, test_number):
             state[qref.question] = {
                 "marked": True,
                 "version": qref.version,
-                "mark": qref.annotations[-1].mark,
-                "who": qref.annotations[-1].user.name,
+                "mark": qref.current_annotation.mark,
+                "who": qref.current_annotation.user.name,
             }
         else:
             state[qref.question] = {
@@ -360,28 +376,58 @@ def RgetSpreadsheet(self):
     # each value that dict is a dict which contains the info about that test
     sheet = {}
     # look for all tests that are completely scanned.
-    for tref in Test.select().where(Test.scanned == True):
+    query = (
+        Test.select(
+            Test.test_number,
+            Test.identified,
+            Test.marked,
+            IDGroup.student_id,
+            IDGroup.student_name,
+        )
+        .join(IDGroup)
+        .where(Test.scanned == True)
+        .order_by(Test.test_number)
+    )
+    for test_number, identified, marked, sid, sname in query.tuples():
         # a dict for the current test.
         this_test = {
-            "identified": tref.identified,  # id'd or not
-            "marked": tref.marked,  # completely marked or not
+            "identified": identified,  # id'd or not
+            "marked": marked,  # completely marked or not
             "sid": "",  # blank entry for student id - replaced if id'd
             "sname": "",  # blank entry for student name - replaced if id'd
         }
         # if identified update sid, sname.
-        iref = tref.idgroups[0]
-        if tref.identified:  # set the sid and sname.
-            this_test["sid"] = iref.student_id
-            this_test["sname"] = iref.student_name
-        # check each question (in order)
-        for qref in tref.qgroups.order_by(QGroup.question):
-            # store the version and mark
-            this_test["q{}v".format(qref.question)] = qref.version
-            this_test["q{}m".format(qref.question)] = ""  # blank unless marked
-            if qref.marked:  # if marked, updated.
-                this_test["q{}m".format(qref.question)] = qref.annotations[-1].mark
-        # insert the data for this_test into the spreadsheet dict.
-        sheet[tref.test_number] = this_test
+        if identified:  # set the sid and sname.
+            this_test["sid"] = sid
+            this_test["sname"] = sname
+        sheet[test_number] = this_test
+
+    # the version of each question and the latest mark, if marked
+    query = (
+        QGroup.select(
+            QGroup.test,
+            QGroup.question,
+            QGroup.version,
+            QGroup.marked,
+            Annotation.mark,
+        )
+        .join(Test)
+        .switch(QGroup)
+        .join(
+            Annotation,
+            pw.JOIN.LEFT_OUTER,
+            on=(QGroup.current_annotation == Annotation.id),
+        )
+        .where(Test.scanned == True)
+        .order_by(QGroup.test, QGroup.question)
+    )
+    for test_number, question, version, marked, mark in query.tuples():
+        this_test = sheet[test_number]
+        # store the version and mark
+        this_test["q{}v".format(question)] = version
+        this_test["q{}m".format(question)] = ""  # blank unless marked
+        if marked:  # if marked, updated.
+            this_test["q{}m".format(question)] = mark
     log.debug("Sending spreadsheet data.")
     return sheet
 
@@ -421,7 +467,7 @@ def RgetCoverPageInfo(self, test_number):
     coverpage = [[iref.student_id, iref.student_name]]
     # then [q, v, mark]
     for qref in tref.qgroups.order_by(QGroup.question):
-        coverpage.append([qref.question, qref.version, qref.annotations[-1].mark])
+        coverpage.append([qref.question, qref.version, qref.current_annotation.mark])
     log.debug("Sending coverpage info of test {}".format(test_number))
     return coverpage
 
@@ -445,7 +491,7 @@ def RgetAnnotatedFiles(self, test_number):
         image_list.append(p.image.file_name)
     # append last annotation from each qgroup
     for g in tref.qgroups.order_by(QGroup.question):
-        image_list.append(g.annotations[-1].aimage.file_name)
+        image_list.append(g.current_annotation.aimage.file_name)
     log.debug("Sending annotated images for test {}".format(test_number))
     return image_list
 
@@ -470,11 +516,11 @@ def RgetMarkReview(self, filterQ, filterV, filterU):
                 qref.test.test_number,
                 qref.question,
                 qref.version,
-                qref.annotations[-1].mark,
+                qref.current_annotation.mark,
                 qref.user.name,
-                qref.annotations[-1].marking_time,
+                qref.current_annotation.marking_time,
                 # CANNOT JSON DATETIMEFIELD.
-                qref.annotations[-1].time.strftime("%y:%m:%d-%H:%M:%S"),
+                qref.current_annotation.time.strftime("%y:%m:%d-%H:%M:%S"),
             ]
         )
     log.debug(
@@ -502,7 +548,7 @@ def RgetAnnotatedImage(self, test_number, question, version):
     log.debug(
         "Sending annotated image of tqv {}.{}.{}".format(test_number, question, version)
     )
-    return [True, qref.annotations[-1].aimage.file_name]
+    return [True, qref.current_annotation.aimage.file_name]
 
 
 def RgetIDReview(self):
@@ -1,5 +1,6 @@
 from plom.db.tables import *
 
+from collections import defaultdict
 from datetime import datetime
 import uuid
 
@@ -10,7 +11,7 @@ import logging
 
 log = logging.getLogger("DB")
 
-from peewee import fn
+from peewee import fn, chunked, JOIN
 
 
 class PlomBundleImageDuplicationException(Exception):
@@ -99,16 +100,16 @@ def uploadTestPage(
                 [page_number, versions], test_number
             ),
         ]
+    # Exact duplicate - md5sum of this image is same as one already in database
+    # (for this page or any other) - e.g., the same bundle rescanned
+    if Image.get_or_none(md5sum=md5) is not None:
+        return [
+            False,
+            "duplicate",
+            "Exact duplicate of page already in database",
+        ]
     if pref.scanned:
-        # have already loaded an image for this page - so this is actually a duplicate
-        log.debug("This appears to be a duplicate. Checking md5sums")
-        if md5 == pref.image.md5sum:
-            # Exact duplicate - md5sum of this image is sames as the one already in database
-            return [
-                False,
-                "duplicate",
-                "Exact duplicate of page already in database",
-            ]
+        # have already loaded a different image for this page
         # Deal with duplicate pages separately. return to sender (as it were)
         return [
             False,
@@ -469,15 +470,14 @@ def uploadCollidingPage(
             "original",
             "This is not a collision - this page was not scanned previously",
         ]
-    # check this against other collisions for that page
-    for cp in pref.collisions:
-        if md5 == cp.image.md5sum:
-            # Exact duplicate - md5sum of this image is sames as the one already in database
-            return [
-                False,
-                "duplicate",
-                "Exact duplicate of page already in database",
-            ]
+    # check this against other collisions for that page, and any other image
+    if Image.get_or_none(md5sum=md5) is not None:
+        # Exact duplicate - md5sum of this image is sames as the one already in database
+        return [
+            False,
+            "duplicate",
+            "Exact duplicate of page already in database",
+        ]
     # make sure we know the bundle
     bref = Bundle.get_or_none(name=bundle_name)
     if bref is None:
@@ -517,302 +517,315 @@ def uploadCollidingPage(
 
 ## clean up after uploads
 
+# how many ids to put in one "IN (...)" clause, well below sqlite's limit
+_chunk_size = 500
 
-def updateDNMGroup(self, dref):
-    """Check all pages present in dnm group and set scanned flag accordingly.
-    Since homework does not upload DNM pages, only check testpages.
-    Will fail if some, but not all, pages scanned.
-    Note - a DNM group can be empty.
-    """
-    gref = dref.group  # find the group-parent of the dnmgroup
-    scan_list = []
-    for p in gref.tpages:
-        scan_list.append(p.scanned)
-    if True in scan_list and False in scan_list:  # some scanned, but not all.
-        return False
-    # all test pages scanned (or all unscanned), so set things ready to go.
-    with plomdb.atomic():
-        gref.scanned = True
-        gref.recent_upload = False
-        gref.save()
-        log.info("DNMGroup of test {} is all scanned.".format(gref.test.test_number))
-    return True
 
+def cleanIDGroups(self, irefs):
+    """Reset ID-tasks, and the identified flag of their tests, after new uploads.
 
-def cleanIDGroup(self, iref):
-    tref = iref.test
+    Args:
+        irefs (list): of IDGroup.
+    """
+    now = datetime.now()
     with plomdb.atomic():
-        iref.status = ""
-        iref.user = None
-        iref.time = datetime.now()
-        iref.student_id = None
-        iref.student_name = None
-        iref.identified = False
-        iref.time = datetime.now()
-        iref.save()
-        tref.identified = False
-        tref.save()
-        log.info("IDGroup of test {} cleaned.".format(tref.test_number))
-
-
-def updateIDGroup(self, iref):
-    """Update the ID task when new pages uploaded to IDGroup.
-    If group is all scanned then the associated ID-task should be set to "todo".
-    Note - be careful when group was auto-IDd (which happens when the associated user = HAL) - then we don't change anything.
-    Note - this should only be triggered by a tpage upload.
+        for chunk in chunked([iref.id for iref in irefs], _chunk_size):
+            IDGroup.update(
+                status="",
+                user=None,
+                time=now,
+                student_id=None,
+                student_name=None,
+                identified=False,
+            ).where(IDGroup.id.in_(chunk)).execute()
+        for chunk in chunked([iref.test_id for iref in irefs], _chunk_size):
+            Test.update(identified=False).where(Test.test_number.in_(chunk)).execute()
+    for iref in irefs:
+        log.info("IDGroup of test {} cleaned.".format(iref.test_id))
+
+
+def _retireAnnotation(aref, edition):
+    """Move an annotation, and its apages, to the old annotations."""
+    # make new oldannot using data from aref
+    oaref = OldAnnotation.create(
+        qgroup=aref.qgroup,
+        user=aref.user,
+        aimage=aref.aimage,
+        edition=edition,
+        plom_file=aref.plom_file,
+        comment_file=aref.comment_file,
+        mark=aref.mark,
+        marking_time=aref.marking_time,
+        time=aref.time,
+        tags=aref.tags,
+        integrity_check=aref.integrity_check,
+    )
+    # make oapges
+    for pref in aref.apages:
+        OAPage.create(old_annotation=oaref, order=pref.order, image=pref.image)
+    # now delete the apages and then the annotation-image and finally the annotation.
+    for pref in aref.apages:
+        pref.delete_instance()
+    # delete the annotated image from table (if it exists).
+    if aref.aimage is not None:
+        aref.aimage.delete_instance()
+    # finally delete the annotation itself.
+    aref.delete_instance()
+
+
+def cleanQGroups(self, qrefs):
+    """Reset question-tasks after new uploads.
+
+    The 0th annotation of each question gets its pages rebuilt from what
+    is now present: scanned tpages, then hwpages, then expages, finally
+    any lpages of the test.  Any later annotations are moved to the old
+    annotations.
+
+    Args:
+        qrefs (list): of QGroup.
     """
+    # the images of each group and each test, in the order they are annotated
+    images = defaultdict(list)
+    limages = defaultdict(list)
+    annotations = defaultdict(list)
+    page_queries = (
+        TPage.select(TPage.group, TPage.image)
+        .where(TPage.scanned == True)
+        .order_by(TPage.page_number),
+        HWPage.select(HWPage.group, HWPage.image).order_by(HWPage.order),
+        EXPage.select(EXPage.group, EXPage.image).order_by(EXPage.order),
+    )
+    for query in page_queries:
+        for chunk in chunked([qref.group_id for qref in qrefs], _chunk_size):
+            for g, i in query.where(query.model.group.in_(chunk)).tuples():
+                images[g].append(i)
+    for chunk in chunked({qref.test_id for qref in qrefs}, _chunk_size):
+        query = (
+            LPage.select(LPage.test, LPage.image)
+            .where(LPage.test.in_(chunk))
+            .order_by(LPage.order)
+        )
+        for t, i in query.tuples():
+            limages[t].append(i)
+    for chunk in chunked([qref.id for qref in qrefs], _chunk_size):
+        query = (
+            Annotation.select()
+            .where(Annotation.qgroup.in_(chunk))
+            .order_by(Annotation.id)
+        )
+        for aref in query:
+            annotations[aref.qgroup_id].append(aref)
 
-    # if IDGroup belongs to HAL then don't mess with it - was auto IDd.
-    if iref.user == User.get(name="HAL"):
-        auto_id = True
-    else:
-        auto_id = False
-        # clean the ID-task and set test-identified flag to false.
-        self.cleanIDGroup(iref)
-
-    # grab associated parent group
-    gref = iref.group
-    # now check if all test-pages pesent - note none-present when a hw upload.
-    for p in gref.tpages:
-        if p.scanned is False:
-            return False  # not yet completely present.
-
-    # all test ID pages present, and group cleaned, so set things ready to go.
     with plomdb.atomic():
-        gref.scanned = True
-        gref.recent_upload = False
-        gref.save()
-        if auto_id is False:
-            iref.status = "todo"
-            iref.save()
-            log.info(
-                "IDGroup of test {} is ready to be identified.".format(
-                    gref.test.test_number
-                )
-            )
-        else:
-            log.info(
-                "IDGroup of test {} is present and already IDd.".format(
-                    gref.test.test_number
-                )
-            )
-    return True
-
+        zeroth = []
+        apages = []
+        for qref in qrefs:
+            # update 0th annotation but move other annotations to oldannotations
+            # set starting edition for oldannot to either 0 or whatever was last.
+            ed = None
+            qref.current_annotation = None
+            for aref in annotations[qref.id]:
+                if aref.edition == 0:
+                    aref.integrity_check = uuid.uuid4().hex
+                    zeroth.append(aref)
+                    pages = images[qref.group_id] + limages[qref.test_id]
+                    for ord, i in enumerate(pages, 1):
+                        apages.append({"annotation": aref, "image": i, "order": ord})
+                    qref.current_annotation = aref
+                else:
+                    if ed is None:
+                        if qref.oldannotations.count() == 0:
+                            ed = 0
+                        else:
+                            ed = qref.oldannotations[-1].edition
+                    ed += 1
+                    _retireAnnotation(aref, ed)
+            qref.user = None
+            qref.status = ""
+            qref.marked = False
+
+        for chunk in chunked([aref.id for aref in zeroth], _chunk_size):
+            APage.delete().where(APage.annotation.in_(chunk)).execute()
+        for chunk in chunked(apages, 100):
+            APage.insert_many(chunk).execute()
+        Annotation.bulk_update(zeroth, [Annotation.integrity_check], batch_size=100)
+        QGroup.bulk_update(
+            qrefs,
+            [QGroup.current_annotation, QGroup.user, QGroup.status, QGroup.marked],
+            batch_size=100,
+        )
+        for chunk in chunked({qref.test_id for qref in qrefs}, _chunk_size):
+            Test.update(marked=False).where(Test.test_number.in_(chunk)).execute()
 
-def cleanQGroup(self, qref):
-    tref = qref.test
-    with plomdb.atomic():
-        # update 0th annotation but move other annotations to oldannotations
-        # set starting edition for oldannot to either 0 or whatever was last.
-        if qref.oldannotations.count() == 0:
-            ed = 0
-        else:
-            ed = qref.oldannotations[-1].edition
-
-        for aref in qref.annotations:
-            if aref.edition == 0:  # update 0th edition.
-                # delete old apages
-                for p in aref.apages:
-                    p.delete_instance()
-                # now create new ones - tpages, then hwpage, then expages, finally any lpages
-                # set the integrity_check string to a UUID
-                ord = 0
-                integrity_check = uuid.uuid4().hex
-                for p in qref.group.tpages.order_by(TPage.page_number):
-                    if p.scanned:  # make sure the tpage is actually scanned.
-                        ord += 1
-                        APage.create(annotation=aref, image=p.image, order=ord)
-                for p in qref.group.hwpages.order_by(HWPage.order):
-                    ord += 1
-                    APage.create(annotation=aref, image=p.image, order=ord)
-                for p in qref.group.expages.order_by(EXPage.order):
-                    ord += 1
-                    APage.create(annotation=aref, image=p.image, order=ord)
-                for p in tref.lpages.order_by(LPage.order):
-                    ord += 1
-                    APage.create(annotation=aref, image=p.image, order=ord)
-                aref.integrity_check = integrity_check
-                aref.save()
-            else:
-                ed += 1
-                # make new oldannot using data from aref
-                oaref = OldAnnotation.create(
-                    qgroup=aref.qgroup,
-                    user=aref.user,
-                    aimage=aref.aimage,
-                    edition=ed,
-                    plom_file=aref.plom_file,
-                    comment_file=aref.comment_file,
-                    mark=aref.mark,
-                    marking_time=aref.marking_time,
-                    time=aref.time,
-                    tags=aref.tags,
-                    integrity_check=aref.integrity_check,
-                )
-                # make oapges
-                for pref in aref.apages:
-                    OAPage.create(
-                        old_annotation=oaref, order=pref.order, image=pref.image
-                    )
-                # now delete the apages and then the annotation-image and finally the annotation.
-                for pref in aref.apages:
-                    pref.delete_instance()
-                # delete the annotated image from table (if it exists).
-                if aref.aimage is not None:
-                    aref.aimage.delete_instance()
-                # finally delete the annotation itself.
-                aref.delete_instance()
-
-        qref.user = None
-        qref.status = ""
-        qref.marked = False
-        qref.save()
-        tref.marked = False
-        tref.save()
+    for qref in qrefs:
+        log.info("QGroup {} of test {} cleaned".format(qref.question, qref.test_id))
 
-    log.info("QGroup {} of test {} cleaned".format(qref.question, tref.test_number))
 
+def updateGroupsAfterUpload(self, groups):
+    """Clean the tasks of groups after new uploads and set those ready to go.
 
-def updateQGroup(self, qref):
-    # TODO = if loose / extra pages present in test, then test is not ready.
+    ID-tasks are cleaned unless the group was auto-IDd (when the associated
+    user is HAL), and question-tasks are always cleaned.  Then a group is
+    ready to go when:
+      * DNM: all or none of its tpages are scanned.  Since homework does not
+        upload DNM pages, only testpages count, and a DNM group can be empty.
+      * ID: all of its tpages are scanned.
+      * question: all of its tpages are scanned, or none are but it has
+        hwpages.
+    Everything is fetched and updated in bulk, in one transaction, as there
+    can be thousands of groups after a large upload.
 
-    # clean up the QGroup and its annotations
-    self.cleanQGroup(qref)
+    Args:
+        groups (iterable): of Group, for example a query.
 
-    gref = qref.group
+    Returns:
+        list: of Group, those that are now ready to go.
+    """
+    grefs = list(groups)
+    scans = defaultdict(list)
+    has_hwpages = set()
+    idgroups = {}
+    qgroups = {}
+    for chunk in chunked([gref.id for gref in grefs], _chunk_size):
+        query = TPage.select(TPage.group, TPage.scanned).where(TPage.group.in_(chunk))
+        for g, scanned in query.tuples():
+            scans[g].append(scanned)
+        query = HWPage.select(HWPage.group).where(HWPage.group.in_(chunk)).distinct()
+        has_hwpages.update(g for (g,) in query.tuples())
+        for iref in IDGroup.select().where(IDGroup.group.in_(chunk)):
+            idgroups[iref.group_id] = iref
+        for qref in QGroup.select().where(QGroup.group.in_(chunk)):
+            qgroups[qref.group_id] = qref
+    # if IDGroup belongs to HAL then don't mess with it - was auto IDd.
+    HAL = User.get(name="HAL")
+    auto_id = {g for g, iref in idgroups.items() if iref.user_id == HAL.id}
 
-    # when some but not all TPages present - not ready
-    # when 0 pages present - not ready
-    # otherwise ready.
-    scan_list = [p.scanned for p in gref.tpages]  # list never zero length.
-    if True in scan_list:  # some tpages scanned.
-        if False in scan_list:  # some tpages unscanned - definitely not ready to go.
-            log.info("Group {} is only half-scanned - not ready".format(gref.gid))
-            return False
+    ready = []
+    with plomdb.atomic():
+        self.cleanIDGroups([iref for g, iref in idgroups.items() if g not in auto_id])
+        self.cleanQGroups(list(qgroups.values()))
+
+        for gref in grefs:
+            scan_list = scans[gref.id]
+            if gref.group_type == "d":
+                # some scanned, but not all, is not ready
+                if True in scan_list and False in scan_list:
+                    continue
+            elif gref.group_type == "i":
+                if False in scan_list:
+                    continue
+            elif gref.group_type == "q":
+                if True in scan_list and False in scan_list:
+                    log.info(
+                        "Group {} is only half-scanned - not ready".format(gref.gid)
+                    )
+                    continue
+                if True not in scan_list and gref.id not in has_hwpages:
+                    log.info(
+                        "Group {} has no scanned tpages and no hwpages - not ready".format(
+                            gref.gid
+                        )
+                    )
+                    continue
+            else:
+                raise ValueError("Tertium non datur: should never happen")
+            ready.append(gref)
+
+        ready_ids = [gref.id for gref in ready]
+        for chunk in chunked(ready_ids, _chunk_size):
+            Group.update(scanned=True, recent_upload=False).where(
+                Group.id.in_(chunk)
+            ).execute()
+        todo = [idgroups[g].id for g in ready_ids if g in idgroups and g not in auto_id]
+        for chunk in chunked(todo, _chunk_size):
+            IDGroup.update(status="todo").where(IDGroup.id.in_(chunk)).execute()
+        todo = [qgroups[g].id for g in ready_ids if g in qgroups]
+        for chunk in chunked(todo, _chunk_size):
+            QGroup.update(status="todo").where(QGroup.id.in_(chunk)).execute()
+
+    for gref in ready:
+        if gref.group_type == "d":
+            log.info("DNMGroup of test {} is all scanned.".format(gref.test_id))
+        elif gref.group_type == "i" and gref.id in auto_id:
+            log.info(
+                "IDGroup of test {} is present and already IDd.".format(gref.test_id)
+            )
+        elif gref.group_type == "i":
+            log.info(
+                "IDGroup of test {} is ready to be identified.".format(gref.test_id)
+            )
         else:
-            pass  # all tpages scanned - so ready to go.
-    else:  # all tpages unscanned - check hw pages
-        if gref.hwpages.count() == 0:  # no  hw pages present - not ready
             log.info(
-                "Group {} has no scanned tpages and no hwpages - not ready".format(
-                    gref.gid
+                "QGroup {} of test {} is ready to be marked.".format(
+                    qgroups[gref.id].question, gref.test_id
                 )
             )
-            return False
-        else:
-            pass  # no unscanned tpages, but not hw pages - so ready to go.
+    return ready
 
-    # If we get here - we are ready to go.
-    with plomdb.atomic():
-        gref.scanned = True
-        gref.recent_upload = False
-        qref.status = "todo"
-        qref.save()
-        gref.save()
-        log.info(
-            "QGroup {} of test {} is ready to be marked.".format(
-                qref.question, qref.test.test_number
-            )
-        )
-    return True
 
+def updateTestsScanned(self, test_numbers):
+    """Set tests as scanned if all their groups are.
 
-def updateGroupAfterUpload(self, gref):
-    """Check the type of the group and update accordingly.
-    return success/failure of that update.
-    """
-    if gref.group_type == "i":
-        return self.updateIDGroup(gref.idgroups[0])
-    elif gref.group_type == "d":
-        return self.updateDNMGroup(gref.dnmgroups[0])
-    elif gref.group_type == "q":
-        # if the group is ready - all good.
-        return self.updateQGroup(gref.qgroups[0])
-    else:
-        raise ValueError("Tertium non datur: should never happen")
+    DNM groups are ignored and an ID group that is already identified
+    need not be scanned.
 
+    Args:
+        test_numbers (iterable): of int.
 
-def checkTestScanned(self, tref):
-    """Check if all groups scanned."""
-    for gref in tref.groups:
-        if gref.group_type == "q":
-            if gref.scanned is False:
-                log.info(
-                    "Group {} of test {} is not scanned - test not ready.".format(
-                        gref.gid, tref.test_number
-                    )
-                )
-                return False
-        elif gref.group_type == "d":
-            if gref.scanned is False:
-                log.info(
-                    "DNM Group {} of test {} is not scanned - ignored.".format(
-                        gref.gid, tref.test_number
-                    )
-                )
-        elif gref.group_type == "i":
-            if gref.idgroups[0].identified:
-                log.info(
-                    "ID Group {} of test {} is identified".format(
-                        gref.gid, tref.test_number
-                    )
-                )
-            elif not gref.scanned:
-                log.info(
-                    "ID Group {} of test {} is not scanned - test not ready.".format(
-                        gref.gid, tref.test_number
-                    )
-                )
-                return False
-
-    return True
+    Returns:
+        list: the numbers of the tests that are scanned.
+    """
+    test_numbers = sorted(set(test_numbers))
+    not_ready = set()
+    for chunk in chunked(test_numbers, _chunk_size):
+        query = (
+            Group.select(Group.test)
+            .join(IDGroup, JOIN.LEFT_OUTER, on=(IDGroup.group == Group.id))
+            .where(
+                Group.test.in_(chunk),
+                Group.scanned == False,
+                (Group.group_type == "q")
+                | ((Group.group_type == "i") & (IDGroup.identified == False)),
+            )
+        )
+        not_ready.update(t for (t,) in query.tuples())
+    scanned = [t for t in test_numbers if t not in not_ready]
+    with plomdb.atomic():
+        for chunk in chunked(scanned, _chunk_size):
+            Test.update(scanned=True).where(Test.test_number.in_(chunk)).execute()
+    for t in scanned:
+        log.info("Test {} is scanned".format(t))
+    return scanned
 
 
 def updateTestAfterUpload(self, tref):
-    update_count = 0
     # check each group in the test
-    for gref in tref.groups:
-        if self.updateGroupAfterUpload(gref):
-            update_count += 1
-
+    update_count = len(self.updateGroupsAfterUpload(tref.groups))
     # now make sure the whole thing is scanned.
-    if self.checkTestScanned(tref):
-        # set the test as scanned
-        with plomdb.atomic():
-            tref.scanned = True
-            log.info("Test {} is scanned".format(tref.test_number))
-            tref.save()
-
+    self.updateTestsScanned([tref.test_number])
     return update_count
 
 
 def processUpdatedTests(self):
     """Update the groups of tests in response to new uploads.
     The recent_upload flag is set either for the whole test or for a given group.
-    If the whole test then we must update every group - this happens when lpages are uploaded.
-    If a group is flagged, then we update just that group - this happens when tpages or hwpages are uploaded.
+    If the whole test then we must update every group - this happens when all scanned pages of a test are removed.
+    If a group is flagged, then we update just that group - this happens when tpages, hwpages or lpages are uploaded.
+    Groups that are not yet ready keep their flag, a test loses its flag once its groups are updated.
+    All of this is done in bulk, in one transaction.
     """
-    update_count = 0  # how many groups updated
-    # process whole tests first
-    for tref in Test.select().where(Test.recent_upload == True):
-        update_count += self.updateTestAfterUpload(tref)
-
-    # make a dict of tests that need checking for ready-status
-    tests_to_update = {}
-    # then process groups
-    for gref in Group.select().where(Group.recent_upload == True):
-        if self.updateGroupAfterUpload(gref):
-            update_count += 1
-            tests_to_update[gref.test] = 1
-    for tref in tests_to_update:
-        if self.checkTestScanned(tref):
-            # set the test as scanned
-            with plomdb.atomic():
-                tref.scanned = True
-                log.info("Test {} is scanned".format(tref.test_number))
-                tref.save()
-
-    return [True, update_count]
+    flagged = Test.select(Test.test_number).where(Test.recent_upload == True)
+    groups = Group.select().where(
+        (Group.recent_upload == True) | Group.test.in_(flagged)
+    )
+    with plomdb.atomic():
+        ready = self.updateGroupsAfterUpload(groups)
+        # tests that need checking for ready-status
+        tests = [t for (t,) in flagged.tuples()] + [gref.test_id for gref in ready]
+        self.updateTestsScanned(tests)
+        Test.update(recent_upload=False).where(Test.recent_upload == True).execute()
+
+    return [True, len(ready)]
 
 
 def removeAllScannedPages(self, test_number):
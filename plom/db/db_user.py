@@ -81,10 +81,12 @@ def disableUser(self, uname):
     if uref is None:
         return False
     # set enabled flag to false and remove their token
-    with plomdb.atomic():
-        uref.enabled = False
-        uref.token = None
-        uref.save()
+    with self._token_lock:
+        with plomdb.atomic():
+            uref.enabled = False
+            uref.token = None
+            uref.save()
+        self._token_cache[uname] = None
     # put all of user's tasks back on the todo pile.
     self.resetUsersToDo(uname)
     return True
@@ -92,14 +94,16 @@ def disableUser(self, uname):
 
 def setUserToken(self, uname, token, msg="Log on"):
     # token generated by server not DB
-    uref = User.get_or_none(name=uname)
-    if uref is None:
-        return False
-    with plomdb.atomic():
-        uref.token = token
-        uref.last_activity = datetime.now()
-        uref.last_action = msg
-        uref.save()
+    with self._token_lock:
+        uref = User.get_or_none(name=uname)
+        if uref is None:
+            return False
+        with plomdb.atomic():
+            uref.token = token
+            uref.last_activity = datetime.now()
+            uref.last_action = msg
+            uref.save()
+        self._token_cache[uname] = token
     return True
 
 
@@ -108,10 +112,21 @@ def clearUserToken(self, uname):
 
 
 def getUserToken(self, uname):
-    uref = User.get_or_none(name=uname)
-    if uref is None:
-        return None
-    else:
+    """Get the (stored form of the) user's token.
+
+    This is called to validate every authenticated request so we keep
+    the tokens in memory: :func:`setUserToken`, :func:`clearUserToken`
+    and :func:`disableUser` keep the cache in sync with the table.
+    """
+    with self._token_lock:
+        try:
+            return self._token_cache[uname]
+        except KeyError:
+            pass
+        uref = User.get_or_none(name=uname)
+        if uref is None:
+            return None
+        self._token_cache[uname] = uref.token
         return uref.token
 
 
@@ -177,10 +192,13 @@ def resetUsersToDo(self, uname):
             x.user = None
             x.save()
             # delete the last annotation and its pages
-            aref = x.annotations[-1]
+            aref = x.current_annotation
             for p in aref.apages:
                 p.delete_instance()
             aref.delete_instance()
+            x.current_annotation = x.annotations.order_by(
+                Annotation.edition.desc()
+            ).get()
             # now clean up the qgroup
             x.save()
             log.info(
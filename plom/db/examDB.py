@@ -3,8 +3,10 @@
 # Copyright (C) 2020 Colin B. Macdonald
 
 from datetime import datetime, timedelta
+import threading
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 from plom.rules import censorStudentNumber as censorID
 from plom.rules import censorStudentName as censorName
@@ -22,9 +24,15 @@ from plom.db.tables import *
 class PlomDB:
     def __init__(self, dbfile_name="plom.db"):
         # can't handle pathlib?
-        plomdb.init(str(dbfile_name))
+        # Write-ahead logging lets the server's reader threads query while
+        # the writer thread is in a transaction.
+        plomdb.init(str(dbfile_name), pragmas={"journal_mode": "wal"})
+        # user tokens, checked on every request: see getUserToken
+        self._token_cache = {}
+        self._token_lock = threading.Lock()
 
         with plomdb:
+            self._add_missing_columns()
             plomdb.create_tables(
                 [
                     User,
@@ -66,6 +74,31 @@ class PlomDB:
             )
             log.info("User 'HAL' created to do all our automated tasks.")
 
+    def _add_missing_columns(self):
+        """Add columns to a database made by an earlier version.
+
+        `create_tables` makes any missing tables and indexes, but not
+        columns added to existing tables since.  Only optional columns
+        can be added this way.  Call this first: sqlite would otherwise
+        quietly index a missing column as a string constant.
+        """
+        migrator = SqliteMigrator(plomdb)
+        for field in (Test.md5sum, QGroup.current_annotation):
+            table = field.model._meta.table_name
+            if not plomdb.table_exists(table):
+                continue
+            columns = [c.name for c in plomdb.get_columns(table)]
+            if field.column_name not in columns:
+                log.info("Adding column {}.{}".format(table, field.column_name))
+                migrate(migrator.add_column(table, field.column_name, field))
+                if field is QGroup.current_annotation:
+                    # point each question at its latest annotation
+                    plomdb.execute_sql(
+                        "UPDATE qgroup SET current_annotation_id = ("
+                        "SELECT id FROM annotation WHERE qgroup_id = qgroup.id "
+                        "ORDER BY edition DESC LIMIT 1)"
+                    )
+
     ########### User stuff #############
     from plom.db.db_user import (
         createUser,
@@ -88,6 +121,7 @@ class PlomDB:
     from plom.db.db_create import (
         doesBundleExist,
         createNewBundle,
+        checkBundleManifest,
         createReplacementBundle,
         areAnyPapersProduced,
         nextqueue_position,
@@ -96,8 +130,11 @@ class PlomDB:
         createIDGroup,
         createDNMGroup,
         createQGroup,
+        createTests,
         getPageVersions,
+        getAllPageVersions,
         produceTest,
+        produceTests,
         id_paper,
     )
 
@@ -111,13 +148,10 @@ class PlomDB:
         uploadLPage,
         uploadUnknownPage,
         uploadCollidingPage,
-        updateDNMGroup,
-        updateIDGroup,
-        cleanIDGroup,
-        updateQGroup,
-        cleanQGroup,
-        updateGroupAfterUpload,
-        checkTestScanned,
+        cleanIDGroups,
+        cleanQGroups,
+        updateGroupsAfterUpload,
+        updateTestsScanned,
         updateTestAfterUpload,
         processUpdatedTests,
         getSIDFromTest,
@@ -196,6 +230,7 @@ class PlomDB:
         MgetDoneTasks,
         MgetNextTask,
         MgiveTaskToClient,
+        MgiveNextTaskToClient,
         MdidNotFinish,
         MtakeTaskFromClient,
         MgetImages,
@@ -19,7 +19,8 @@ class User(BaseModel):
 
 class Bundle(BaseModel):
     name = pw.CharField(unique=True, null=True)  # unique names please
-    md5sum = pw.CharField(null=True)  # to check for duplications
+    # to check for duplications, indexed to find them quickly
+    md5sum = pw.CharField(null=True, index=True)
 
 
 class Image(BaseModel):
@@ -28,13 +29,16 @@ class Image(BaseModel):
     # the order of the image within its bundle
     bundle_order = pw.IntegerField(null=True)
     file_name = pw.CharField(null=True)
-    md5sum = pw.CharField(null=True)  # to check for duplications
+    # to check for duplications, indexed to find them quickly
+    md5sum = pw.CharField(null=True, index=True)
 
 
 class Test(BaseModel):
     test_number = pw.IntegerField(primary_key=True, unique=True)
     # some state pw.Bools
     produced = pw.BooleanField(default=False)
+    # md5sum of the PDF file that was produced, if we were told it
+    md5sum = pw.CharField(null=True)
     used = pw.BooleanField(default=False)
     scanned = pw.BooleanField(default=False)
     identified = pw.BooleanField(default=False)
@@ -77,6 +81,15 @@ class QGroup(BaseModel):
     user = pw.ForeignKeyField(User, backref="qgroups", null=True)
     status = pw.CharField(default="")
     marked = pw.BooleanField(default=False)
+    # the latest edition of its annotations, kept up to date by whoever
+    # creates or deletes them
+    current_annotation = pw.DeferredForeignKey("Annotation", null=True, backref="+")
+
+    class Meta:
+        indexes = (
+            # the marking queue: look up tasks by question, version and status
+            (("question", "version", "status"), False),
+        )
 
 
 class TPage(BaseModel):  # a test page that knows its tpgv
@@ -159,6 +172,12 @@ class Annotation(BaseModel):
     time = pw.DateTimeField(null=True)
     tags = pw.CharField(default="")
 
+    class Meta:
+        indexes = (
+            # finding the latest edition for each qgroup
+            (("qgroup", "edition"), False),
+        )
+
 
 class APage(BaseModel):
     annotation = pw.ForeignKeyField(Annotation, backref="apages")
@@ -7,11 +7,11 @@
 import os
 import sys
 import tempfile
-import subprocess
 
 import fitz
 
 from plom import __version__
+from plom.image_utils import is_wider
 
 # hardcoded for letter, https://gitlab.com/plom/plom/issues/276
 papersize_portrait = (612, 792)
@@ -19,24 +19,6 @@ papersize_landscape = (792, 612)
 margin = 10
 
 
-def is_wider(f):
-    """True if image is wider than it is high.
-
-    Args:
-        f (str): The name of the file we are checking.
-
-    Returns:
-        boolean : True if the image is wider than it is tall, False otherwise.
-    """
-    # TODO: shell likely SLOW for this task...?
-    ratio = (
-        subprocess.check_output(["identify", "-format", "%[fx:w/h]", f])
-        .decode()
-        .rstrip()
-    )
-    return float(ratio) > 1
-
-
 def reassemble(outname, shortName, sid, coverfname, imglist):
     """Reassemble a pdf from the cover and question images.
 
@@ -0,0 +1,180 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""Image operations for scanning and finishing, done in-process
+
+These used to shell out to ImageMagick (`identify`, `mogrify` and
+`convert`) once per page, which costs more than the work itself.
+
+Functions that take an image accept either a file name or the contents
+of the file as bytes.
+"""
+
+from io import BytesIO
+import os
+
+from PIL import Image
+import jpegtran
+
+
+def _open(src):
+    if isinstance(src, (bytes, bytearray)):
+        return Image.open(BytesIO(src))
+    return Image.open(src)
+
+
+def _save(img, format, info=None):
+    out = BytesIO()
+    kwargs = {}
+    if info and "dpi" in info:
+        kwargs["dpi"] = info["dpi"]
+    img.save(out, format, **kwargs)
+    return out.getvalue()
+
+
+def _is_jpeg_name(f):
+    return os.path.splitext(str(f))[1].lower() in (".jpg", ".jpeg")
+
+
+def image_size(src):
+    """The width and height of an image, reading only its header.
+
+    Args:
+        src (str/pathlib.Path/bytes): an image file or its contents.
+
+    Returns:
+        tuple: `(width, height)` in pixels.
+    """
+    with _open(src) as img:
+        return img.size
+
+
+def is_wider(src):
+    """True if image is wider than it is high.
+
+    Args:
+        src (str/pathlib.Path/bytes): an image file or its contents.
+    """
+    width, height = image_size(src)
+    return width > height
+
+
+def _gamma_lut(gamma):
+    # same convention as ImageMagick's `-gamma`
+    return [round(255 * (x / 255) ** (1 / gamma)) for x in range(256)]
+
+
+def gamma_adjust(data, gamma=0.5):
+    """Apply a simple gamma shift to an image, returning a png.
+
+    Same as `mogrify -gamma 0.5`: white stays white but everything else
+    gets darker, which helps with very light pencil.  Transparency is
+    left alone and palette images stay palette images.
+
+    Args:
+        data (bytes): contents of an image file.
+        gamma (float): less than one to darken.
+
+    Returns:
+        bytes: contents of a png file.
+    """
+    img = _open(data)
+    info = img.info
+    if img.mode == "1":
+        # nothing but black and white
+        return data
+    lut = _gamma_lut(gamma)
+    if img.mode == "P":
+        palette = img.getpalette()
+        img.putpalette([lut[x] for x in palette])
+    else:
+        if img.mode not in ("L", "LA", "RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        bands = list(img.split())
+        for k, name in enumerate(img.getbands()):
+            if name != "A":
+                bands[k] = bands[k].point(lut)
+        img = Image.merge(img.mode, bands)
+    return _save(img, "PNG", info)
+
+
+def gamma_adjust_file(f, gamma=0.5):
+    """Apply a simple gamma shift to a png file, in place."""
+    with open(f, "rb") as fh:
+        data = fh.read()
+    with open(f, "wb") as fh:
+        fh.write(gamma_adjust(data, gamma))
+
+
+# PIL rotates anticlockwise, we want clockwise
+_transposes = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}
+
+
+def rotate(data, angle, jpeg=False):
+    """Rotate an image clockwise, losslessly.
+
+    Args:
+        data (bytes): contents of an image file.
+        angle (int/str): a multiple of 90 degrees, negative for
+            anticlockwise.
+        jpeg (bool): the image is a jpeg, which we rotate without
+            decoding it.  See :func:`plom.scan.rotateBitmap` for the
+            caveats.
+
+    Returns:
+        bytes: contents of an image file, in the same format.
+    """
+    angle = int(angle) % 360
+    if angle == 0:
+        return data
+    if angle not in _transposes:
+        raise ValueError("Can only rotate by multiples of 90, not {}".format(angle))
+    if jpeg:
+        return jpegtran.JPEGImage(blob=data).rotate(angle).as_blob()
+    img = _open(data)
+    return _save(img.transpose(_transposes[angle]), img.format, img.info)
+
+
+def rotate_file(f, angle):
+    """Rotate an image file clockwise in place, losslessly."""
+    with open(f, "rb") as fh:
+        data = fh.read()
+    with open(f, "wb") as fh:
+        fh.write(rotate(data, angle, jpeg=_is_jpeg_name(f)))
+
+
+def normalize_jpeg_orientation(data):
+    """Transform a jpeg according to its Exif metadata.
+
+    Args:
+        data (bytes): contents of a jpeg file.
+
+    Returns:
+        bytes: contents of a jpeg file with no Exif rotation, possibly
+            the input unchanged.
+    """
+    im = jpegtran.JPEGImage(blob=data)
+    if not im.exif_orientation:
+        return data
+    return im.exif_autotransform().as_blob()
+
+
+def to_png(data):
+    """Transcode an image to png.
+
+    Args:
+        data (bytes): contents of an image file in any format Pillow
+            can read.
+
+    Returns:
+        bytes: contents of a png file.
+
+    Raises:
+        OSError: Pillow could not read the image.
+    """
+    img = _open(data)
+    if img.mode not in ("1", "L", "LA", "P", "RGB", "RGBA", "I", "I;16"):
+        # e.g., CMYK jpegs
+        img = img.convert("RGB")
+    return _save(img, "PNG", img.info)
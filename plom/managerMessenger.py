@@ -96,6 +96,47 @@ class ManagerMessenger(BaseMessenger):
         finally:
             self.SRmutex.release()
 
+    def notify_pdfs_of_papers_produced(self, papers, rebuilt=()):
+        """Notify the server that we have produced the PDFs for many papers.
+
+        Args:
+            papers (list): pairs `[test_num, md5sum]` of the test number
+                and the md5sum of its PDF file (or None).
+            rebuilt (list): the numbers of papers we made again, so the
+                server should replace the md5sums it has for them.
+
+        Returns:
+            None
+        """
+        self.SRmutex.acquire()
+        try:
+            response = self.session.put(
+                "https://{}/admin/pdf_produced".format(self.server),
+                verify=False,
+                json={
+                    "user": self.user,
+                    "token": self.token,
+                    "papers": papers,
+                    "rebuilt": list(rebuilt),
+                },
+            )
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            if response.status_code == 400:
+                raise PlomAuthenticationException() from None
+            elif response.status_code == 401:
+                raise PlomAuthenticationException() from None
+            elif response.status_code == 404:
+                raise PlomRangeException(response.reason) from None
+            elif response.status_code == 409:
+                raise PlomSeriousException(response.reason) from None
+            else:
+                raise PlomSeriousException(
+                    "Some other sort of error {}".format(e)
+                ) from None
+        finally:
+            self.SRmutex.release()
+
     def getGlobalPageVersionMap(self):
         self.SRmutex.acquire()
         try:
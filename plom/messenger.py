@@ -720,6 +720,48 @@ class Messenger(BaseMessenger):
             i += 1
         return imageList, image_id_list, tags, integrity_check
 
+    def MclaimNextTask(self, q, v):
+        """Ask server to give us the next marking task, and download it.
+
+        The server chooses and assigns the task in one go, so unlike
+        `MaskNextTask` followed by `MclaimThisTask` there is no race
+        with other markers.
+
+        Returns:
+            None if there are no more tasks, otherwise a tuple of the
+            task code, list of images (as bytes), list of image
+            md5sums, tags and integrity check string.
+        """
+        self.SRmutex.acquire()
+        try:
+            response = self.session.patch(
+                "https://{}/MK/tasks/available".format(self.server),
+                json={"user": self.user, "token": self.token, "q": q, "v": v},
+                verify=False,
+            )
+            if response.status_code == 204:
+                return None
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            if response.status_code == 401:
+                raise PlomAuthenticationException() from None
+            else:
+                raise PlomSeriousException(
+                    "Some other sort of error {}".format(e)
+                ) from None
+        finally:
+            self.SRmutex.release()
+
+        # should be multipart = [task, tags, integrity_check, image_id_list, image1, image2, ....]
+        parts = MultipartDecoder.from_response(response).parts
+        task = parts[0].text
+        tags = parts[1].text
+        integrity_check = parts[2].text
+        image_id_list = json.loads(parts[3].text)
+        # pass back images as bytes
+        imageList = [BytesIO(img.content).getvalue() for img in parts[4:]]
+        return task, imageList, image_id_list, tags, integrity_check
+
     def MlatexFragment(self, latex):
         self.SRmutex.acquire()
         try:
@@ -746,6 +788,39 @@ class Messenger(BaseMessenger):
 
         return image
 
+    def MlatexFragments(self, fragments):
+        """Render many fragments of latex in a single request.
+
+        Args:
+            fragments (list): of str, the latex fragments.
+
+        Returns:
+            list: in the same order as `fragments`, the bytes of each
+                png image or None if that fragment has a latex error.
+        """
+        self.SRmutex.acquire()
+        try:
+            response = self.session.get(
+                "https://{}/MK/latex/batch".format(self.server),
+                json={"user": self.user, "token": self.token, "fragments": fragments},
+                verify=False,
+            )
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            if response.status_code == 401:
+                raise PlomAuthenticationException() from None
+            else:
+                raise PlomSeriousException(
+                    "Some other sort of error {}".format(e)
+                ) from None
+        finally:
+            self.SRmutex.release()
+
+        # should be multipart = [list of bools, image1, image2, ...]
+        parts = MultipartDecoder.from_response(response).parts
+        images = iter(BytesIO(img.content).getvalue() for img in parts[1:])
+        return [next(images) if ok else None for ok in json.loads(parts[0].text)]
+
     def MrequestImages(self, code, integrity_check):
         """Download images relevant to a question, both original and annotated.
 
@@ -7,8 +7,11 @@ __copyright__ = "Copyright (C) 2019 Colin B. Macdonald, Omer Angel"
 __license__ = "AGPL-3.0-or-later"
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import sys
+import hashlib
+import json
 import math
+import os
+import sys
 
 
 def format_int_list_with_runs(L, use_unicode=None):
@@ -51,3 +54,83 @@ def _flatten_2len_runs(L):
         else:
             L2.append(l)
     return L2
+
+
+# results of md5sum_of_file, by (name, size, modification time)
+_md5sums = {}
+
+
+def md5sum_of_file(filename, chunk_size=1024 * 1024):
+    """The md5sum of a file, read a chunk at a time.
+
+    Bundles of scans can be large, so we do not read the whole file into
+    memory.  The result is remembered (with the size and modification
+    time of the file) so asking about the same file again is instant.
+
+    Args:
+        filename (str/pathlib.Path): the file.
+        chunk_size (int): how many bytes to read at once.
+
+    Returns:
+        str: the md5sum in hex.
+    """
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    if key not in _md5sums:
+        md5 = hashlib.md5()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                md5.update(chunk)
+        _md5sums[key] = md5.hexdigest()
+    return _md5sums[key]
+
+
+def read_jsonl(filename):
+    """The records in a file with a line of JSON for each.
+
+    A line half-written by a crash is skipped.
+
+    Args:
+        filename (str/pathlib.Path): the file, which need not exist.
+
+    Returns:
+        list: of the records, in order.
+    """
+    records = []
+    try:
+        with open(filename, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # half-written by a crash
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def open_jsonl_for_append(filename):
+    """Open a file with a line of JSON for each record, to add more.
+
+    If a crash left the last line half-written, it is ended first so
+    the next record is not lost along with it.
+
+    Args:
+        filename (str/pathlib.Path): the file, created if necessary.
+
+    Returns:
+        file: line buffered, so each record is on disk before we go on.
+    """
+    torn = False
+    try:
+        with open(filename, "rb") as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+    except FileNotFoundError:
+        pass
+    fh = open(filename, "a", buffering=1)
+    if torn:
+        fh.write("\n")
+    return fh
@@ -14,7 +14,7 @@ from plom.messenger import ManagerMessenger
 from plom.plom_exceptions import PlomExistingLoginException, PlomBenignException
 
 
-def buildDatabaseAndPapers(server=None, password=None):
+def buildDatabaseAndPapers(server=None, password=None, incremental=False):
     if server and ":" in server:
         s, p = server.split(":")
         msgr = ManagerMessenger(s, port=p)
@@ -42,8 +42,10 @@ def buildDatabaseAndPapers(server=None, password=None):
         try:
             status = msgr.TriggerPopulateDB()
         except PlomBenignException:
-            print("Error: Server already has a populated database")
-            exit(3)
+            if not incremental:
+                print("Error: Server already has a populated database")
+                exit(3)
+            status = "Server already has a populated database"
         print(status)
         pvmap = msgr.getGlobalPageVersionMap()
         os.makedirs(paperdir, exist_ok=True)
@@ -68,10 +70,10 @@ def buildDatabaseAndPapers(server=None, password=None):
                     spec["numberToProduce"], paperdir
                 )
             )
-        build_all_papers(spec, pvmap, classlist)
+        rebuilt = build_all_papers(spec, pvmap, classlist, incremental)
 
         print("Checking papers produced and updating databases")
-        confirm_processed(spec, msgr, classlist)
+        confirm_processed(spec, msgr, classlist, rebuilt)
         print("Identifying any pre-named papers into the database")
         identify_prenamed(spec, msgr, classlist)
     finally:
@@ -9,23 +9,36 @@ from pathlib import Path
 from multiprocessing import Pool
 from tqdm import tqdm
 
-from .mergeAndCodePages import make_PDF
+from plom.misc_utils import md5sum_of_file
+from .mergeAndCodePages import PaperBuilder, paper_file_name
+from .builtPapers import BuiltPapers, paper_inputs_hash
 from . import paperdir
 
+# set in each worker process by _initWorker
+_builder = None
 
-def _make_PDF(x):
-    """Call make_PDF from mergeAndCodePages with arguments expanded.
 
-    *Note*: this is a little bit of glue to make the parallel Pool code
-    elsewhere work.
+def _initWorker(name, code, length, versions):
+    """Each worker opens the source versions once and keeps them open."""
+    global _builder
+    _builder = PaperBuilder(name, code, length, versions)
+
+
+def _make_PDF(x):
+    """Make one paper in a worker, using its :class:`PaperBuilder`.
 
     Arguments:
-        x (tuple): this is expanded as the arguments to :func:`make_PDF`.
+        x (tuple): `(paper_index, page_version, student_info)`, the
+            arguments to :meth:`PaperBuilder.make_PDF`.
+
+    Returns:
+        int: the paper number, so we can record it as built.
     """
-    make_PDF(*x)
+    _builder.make_PDF(*x)
+    return x[0]
 
 
-def build_all_papers(spec, global_page_version_map, classlist):
+def build_all_papers(spec, global_page_version_map, classlist, incremental=False):
     """Builds the papers using _make_PDF.
 
     Based on `numberToName` this uses `_make_PDF` to create some
@@ -34,11 +47,22 @@ def build_all_papers(spec, global_page_version_map, classlist):
     For the prenamed papers, names and IDs are taken in order from the
     classlist.
 
+    What went into each paper is recorded in paperdir, see
+    :class:`BuiltPapers`, so that building again can skip the papers
+    which would come out the same.
+
     Arguments:
         spec (dict): exam specification, see :func:`plom.SpecVerifier`.
         global_page_version_map (dict): dict of dicts mapping first by
             paper number (int) then by page number (int) to version (int).
         classlist (list, None): ordered list of (sid, sname) pairs.
+        incremental (bool): only build papers which are missing, or
+            whose inputs (spec, versions, source pdfs, name on the front)
+            have changed since they were built.  Default False: build
+            them all.
+
+    Returns:
+        list: the numbers of the papers which were built.
 
     Raises:
         ValueError: classlist is invalid in some way.
@@ -52,7 +76,14 @@ def build_all_papers(spec, global_page_version_map, classlist):
                     spec["numberToName"]
                 )
             )
+    source_md5s = {
+        v: md5sum_of_file(Path("sourceVersions") / "version{}.pdf".format(v))
+        for v in range(1, spec["numberOfVersions"] + 1)
+    }
+    built = BuiltPapers(paperdir)
     make_PDF_args = []
+    inputs = {}
+    file_names = {}
     for paper_index in range(1, spec["numberToProduce"] + 1):
         page_version = global_page_version_map[paper_index]
         if paper_index <= spec["numberToName"]:
@@ -62,33 +93,67 @@ def build_all_papers(spec, global_page_version_map, classlist):
             }
         else:
             student_info = None
-        make_PDF_args.append(
-            (
-                spec["name"],
-                spec["publicCode"],
-                spec["numberOfPages"],
-                spec["numberOfVersions"],
-                paper_index,
-                page_version,
-                student_info,
-            )
+        inputs[paper_index] = paper_inputs_hash(
+            spec, paper_index, page_version, student_info, source_md5s
         )
+        file_names[paper_index] = paper_file_name(paper_index, student_info)
+        if incremental and built.is_current(
+            paper_index, file_names[paper_index], inputs[paper_index]
+        ):
+            continue
+        # e.g., a blank paper which is now pre-named, don't leave the old one
+        old_file_name = built.file_name(paper_index)
+        if old_file_name and old_file_name != file_names[paper_index]:
+            try:
+                os.unlink(old_file_name)
+            except FileNotFoundError:
+                pass
+        make_PDF_args.append((paper_index, page_version, student_info))
 
     # Same as:
+    # builder = PaperBuilder(...)
     # for x in make_PDF_args:
-    #     make_PDF(*x)
+    #     builder.make_PDF(*x)
     num_PDFs = len(make_PDF_args)
-    with Pool() as pool:
-        r = list(tqdm(pool.imap_unordered(_make_PDF, make_PDF_args), total=num_PDFs))
-
-
-def confirm_processed(spec, msgr, classlist):
+    if incremental:
+        print(
+            "{} papers are up to date, building {}".format(
+                spec["numberToProduce"] - num_PDFs, num_PDFs
+            )
+        )
+    # hand out papers a few at a time, but not so many the progress bar stalls
+    chunksize = max(1, min(8, num_PDFs // (4 * (os.cpu_count() or 1))))
+    with built, Pool(
+        initializer=_initWorker,
+        initargs=(
+            spec["name"],
+            spec["publicCode"],
+            spec["numberOfPages"],
+            spec["numberOfVersions"],
+        ),
+    ) as pool:
+        r = []
+        for paper_index in tqdm(
+            pool.imap_unordered(_make_PDF, make_PDF_args, chunksize=chunksize),
+            total=num_PDFs,
+        ):
+            # recorded as each one finishes, in case we crash part way
+            built.add(paper_index, file_names[paper_index], inputs[paper_index])
+            r.append(paper_index)
+    built.compact()
+    return sorted(r)
+
+
+def confirm_processed(spec, msgr, classlist, rebuilt=()):
     """Checks that each PDF file was created and notify server.
 
     Arguments:
         spec (dict): exam specification, see :func:`plom.SpecVerifier`.
         msgr (Messenger): an open active connection to the server.
         classlist (list, None): ordered list of (sid, sname) pairs.
+        rebuilt (list): numbers of papers we built again, see
+            :func:`build_all_papers`, so the server should replace its
+            record of them.
 
     Raises:
         RuntimeError: raised if any of the expected PDF files not found.
@@ -103,21 +168,22 @@ def confirm_processed(spec, msgr, classlist):
                     spec["numberToName"]
                 )
             )
+    produced = []
     for paper_index in range(1, spec["numberToProduce"] + 1):
         if paper_index <= spec["numberToName"]:
-            PDF_file_name = Path(paperdir) / "exam_{}_{}.pdf".format(
-                str(paper_index).zfill(4), classlist[paper_index - 1][0]
+            PDF_file_name = paper_file_name(
+                paper_index, {"id": classlist[paper_index - 1][0]}
             )
         else:
-            PDF_file_name = Path(paperdir) / "exam_{}.pdf".format(
-                str(paper_index).zfill(4)
-            )
+            PDF_file_name = paper_file_name(paper_index)
 
         # We will raise and error if the pdf file was not found
         if os.path.isfile(PDF_file_name):
-            msgr.notify_pdf_of_paper_produced(paper_index)
+            produced.append([paper_index, md5sum_of_file(PDF_file_name)])
         else:
             raise RuntimeError('Cannot find pdf for paper "{}"'.format(PDF_file_name))
+    # tell the server about them all at once
+    msgr.notify_pdfs_of_papers_produced(produced, rebuilt)
 
 
 def identify_prenamed(spec, msgr, classlist):
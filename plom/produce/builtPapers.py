@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""A record of the papers we have built and what went into each one
+
+Building the papers again only needs to make those whose inputs have
+changed, or whose PDF has gone missing or been changed since: e.g.,
+after a crash part way through, or after pre-naming a few more papers
+for students who joined late.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from plom import __version__
+from plom.misc_utils import read_jsonl, open_jsonl_for_append
+
+
+def paper_inputs_hash(spec, paper_index, page_version, student_info, source_md5s):
+    """A hash of everything that goes into making a paper.
+
+    If this has not changed then building the paper again would give
+    the same paper.
+
+    Args:
+        spec (dict): exam specification, see :func:`plom.SpecVerifier`.
+        paper_index (int): the paper number.
+        page_version (dict): page number (int) to version (int).
+        student_info (dict/None): the id and name on a pre-named paper.
+        source_md5s (dict): version (int) to the md5sum of its source
+            PDF file.
+
+    Returns:
+        str: the hash, in hex.
+    """
+    inputs = {
+        "plom": __version__,
+        "name": spec["name"],
+        "publicCode": spec["publicCode"],
+        "paper": paper_index,
+        "pages": [
+            [p, page_version[p], source_md5s[page_version[p]]]
+            for p in range(1, spec["numberOfPages"] + 1)
+        ],
+        "student": student_info,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class BuiltPapers:
+    """The papers we have built in a directory and the inputs to each.
+
+    The record of each paper is its file name, the hash of its inputs
+    (see :func:`paper_inputs_hash`) and the size and modification time
+    of the file when we made it.
+
+    The file "built.jsonl" in the directory has a line of JSON for each
+    paper built.  We append to it as each paper is made, so a crash
+    loses at most the last one, and :meth:`compact` it at the end.
+    """
+
+    filename = "built.jsonl"
+
+    def __init__(self, directory):
+        """Load the record of a directory of papers, if it has one yet.
+
+        Args:
+            directory (str/pathlib.Path): where the papers are.
+        """
+        self.directory = Path(directory)
+        self.path = self.directory / self.filename
+        self._papers = {}
+        self._fh = None
+        for record in read_jsonl(self.path):
+            self._papers[record.pop("paper")] = record
+
+    def file_name(self, paper_index):
+        """The file we last built a paper as, or None."""
+        record = self._papers.get(paper_index)
+        return self.directory / record["file"] if record else None
+
+    def is_current(self, paper_index, file_name, inputs):
+        """Is the paper already built from these inputs and still there?
+
+        Args:
+            paper_index (int): the paper number.
+            file_name (str/pathlib.Path): where the paper should be.
+            inputs (str): see :func:`paper_inputs_hash`.
+
+        Returns:
+            bool
+        """
+        record = self._papers.get(paper_index)
+        if not record:
+            return False
+        if record["file"] != Path(file_name).name or record["inputs"] != inputs:
+            return False
+        try:
+            st = os.stat(file_name)
+        except FileNotFoundError:
+            return False
+        return st.st_size == record["size"] and st.st_mtime_ns == record["mtime_ns"]
+
+    def add(self, paper_index, file_name, inputs):
+        """Record that we have just built a paper.
+
+        Args:
+            paper_index (int): the paper number.
+            file_name (str/pathlib.Path): the file it was saved as.
+            inputs (str): see :func:`paper_inputs_hash`.
+        """
+        st = os.stat(file_name)
+        record = {
+            "file": Path(file_name).name,
+            "inputs": inputs,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+        }
+        if self._fh is None:
+            self._fh = open_jsonl_for_append(self.path)
+        self._fh.write(json.dumps(dict(record, paper=paper_index)) + "\n")
+        self._papers[paper_index] = record
+
+    def compact(self):
+        """Rewrite the file with just the latest record of each paper."""
+        self.close()
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            for paper_index, record in sorted(self._papers.items()):
+                f.write(json.dumps(dict(record, paper=paper_index)) + "\n")
+        os.replace(tmp, self.path)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -5,12 +5,9 @@
 # Copyright (C) 2020 Dryden Wiebe
 
 import sys
-import shlex
-import subprocess
-import os
 import fitz
+from PIL import Image, ImageOps
 import pyqrcode
-import tempfile
 from pathlib import Path
 
 from plom.tpv_utils import encodeTPV
@@ -19,58 +16,142 @@ from . import paperdir
 # paperdir = "papersToPrint"
 
 
-# TODO: Complete the test mode functionality
-def create_QR_file_dictionary(
-    length, test, page_versions, code, tmp_dir, test_mode=False, test_folder=None
-):
-    """Creates a dictionary of the QR codes and save them.
+def qr_pixmap(tpv, scale=4, quiet_zone=4):
+    """Make a QR code with a frame around it, in memory.
+
+    Same image as `pyqrcode`'s png followed by `mogrify -mattecolor
+    black -frame 1x1 -background "#FFFFFF" -flatten`, without writing a
+    file or running ImageMagick.
 
     Arguments:
-        length {int} -- Length of the document or number of pages.
-        test {int} -- Test number based on the combination we have around (length ^ versions - initial pages) tests.
-        page_versions {dict} -- (int:int) Dictionary representing the version of each page for this test.
-        code {Str} -- 6 digit distinguished code for the document.
-        tmp_dir {Str} -- Path string representing the directory paht of a QR code.
+        tpv {Str} -- the text to encode, see :func:`plom.tpv_utils.encodeTPV`.
 
     Keyword Arguments:
-        test_mode {bool} -- boolean elements used for testing, testing case with show the documents (default: {False}).
-        test_folder {Str} -- String for where to place the generated test files (default: {None}).
+        scale {int} -- pixels per module of the QR code (default: {4}).
+        quiet_zone {int} -- modules of white around the code (default: {4}).
 
     Returns:
-        dict -- dict(int: dict(int: Str)) a dictionary that has another embedded dictionary for each page.
-                The embedded dictionary has a string for QR code paths saved for each corner.
+        fitz.Pixmap -- a greyscale image of the framed QR code.
     """
+    code = pyqrcode.create(tpv, error="H").code
+    img = Image.frombytes(
+        "L",
+        (len(code[0]), len(code)),
+        bytes(0 if module else 255 for row in code for module in row),
+    )
+    img = ImageOps.expand(img, border=quiet_zone, fill=255)
+    img = img.resize((img.width * scale, img.height * scale), Image.NEAREST)
+    img = ImageOps.expand(img, border=1, fill=0)
+    return fitz.Pixmap(fitz.csGRAY, img.width, img.height, img.tobytes(), False)
 
-    # Command line parameters to imagemagick's mogrify
-    # puts a frame around the image.
-    mogParams = ' -mattecolor black -frame 1x1 -background "#FFFFFF" ' "-flatten"
 
-    qr_file = {}
+def create_QR_codes(length, test, page_versions, code):
+    """Creates the QR codes for each corner of each page, in memory.
 
+    Arguments:
+        length {int} -- Length of the document or number of pages.
+        test {int} -- Test number based on the combination we have around (length ^ versions - initial pages) tests.
+        page_versions {dict} -- (int:int) Dictionary representing the version of each page for this test.
+        code {Str} -- 6 digit distinguished code for the document.
+
+    Returns:
+        dict -- dict(int: dict(int: fitz.Pixmap)) a dictionary that has another embedded dictionary for each page.
+                The embedded dictionary has the QR code image for each corner.
+    """
+    qr_code = {}
     for page_index in range(1, length + 1):
         # 4 qr codes for the corners (one will be omitted for the staple)
-        qr_file[page_index] = {}
-
+        qr_code[page_index] = {}
         for corner_index in range(1, 5):
             # the tpv (test page version) is a code used for creating the qr code
             tpv = encodeTPV(
                 test, page_index, page_versions[page_index], corner_index, code
             )
-            qr_code = pyqrcode.create(tpv, error="H")
+            qr_code[page_index][corner_index] = qr_pixmap(tpv)
+    return qr_code
 
-            # save it in the associated file
-            qr_file[page_index][corner_index] = os.path.join(
-                tmp_dir, "page{}_{}.png".format(page_index, corner_index)
-            )
-            qr_code.png(qr_file[page_index][corner_index], scale=4)
 
-            # use a terminal mogrify process to put a border around the QR code
-            cmd = shlex.split(
-                "mogrify {} {}".format(mogParams, qr_file[page_index][corner_index])
-            )
-            subprocess.run(cmd, check=True)
+def open_source_versions(versions):
+    """Opens the source pdf of each version, from sourceVersions.
+
+    Arguments:
+        versions {int} -- Number of version of this Document.
+
+    Returns:
+        dict -- (int: fitz.Document) the source pdf of each version.
+    """
+    return {
+        version_index: fitz.open("sourceVersions/version{}.pdf".format(version_index))
+        for version_index in range(1, versions + 1)
+    }
+
+
+def create_page_stamps(name, page_width, page_height):
+    """Creates the marks which are the same on every paper.
+
+    These are the box for the test/page number and the "do not write"
+    (DNW) triangle near the staple, with the name of the document in
+    it.  Stamping these onto each page is quicker than drawing them
+    and the resulting pdf has only one copy.
+
+    Arguments:
+        name {Str} -- Document Name.
+        page_width {float} -- Width of the pages of the document.
+        page_height {float} -- Height of the pages of the document.
+
+    Returns:
+        fitz.Document -- Two pages: the marks for even pages (counting from 0) and for odd pages.
+    """
+    stamps = fitz.open()
+
+    # box for the test/page number in top-centre of page
+    # Rectangle size hacked by hand. TODO = do this more algorithmically
+    rect = fitz.Rect(page_width // 2 - 40, 20, page_width // 2 + 40, 44)
+
+    # put marks at top left/right so students don't write near
+    # staple or near where client will stamp marks
+
+    # create two "do not write" (DNW) rectangles accordingly with TL (top left) and TR (top right)
+    rDNW_TL = fitz.Rect(15, 15, 90, 90)
+    rDNW_TR = fitz.Rect(page_width - 90, 15, page_width - 15, 90)
+
+    for page_index in range(2):
+        page = stamps.newPage(width=page_width, height=page_height)
+        page.drawRect(rect, color=[0, 0, 0])
+
+        # stamp DNW near staple: even/odd pages different
+        # Top Left for even pages, Top Right for odd pages
+        rDNW = rDNW_TL if page_index % 2 == 0 else rDNW_TR
+        shape = page.newShape()
+        shape.drawLine(rDNW.top_left, rDNW.top_right)
+        if page_index % 2 == 0:
+            shape.drawLine(rDNW.top_right, rDNW.bottom_left)
+        else:
+            shape.drawLine(rDNW.top_right, rDNW.bottom_right)
+        shape.finish(width=0.5, color=[0, 0, 0], fill=[0.75, 0.75, 0.75])
+        shape.commit()
+        if page_index % 2 == 0:
+            # offset by trial-and-error, could be improved
+            rDNW = rDNW + (19, 19, 19, 19)
+        else:
+            rDNW = rDNW + (-19, 19, -19, 19)
+        mat = fitz.Matrix(45 if page_index % 2 == 0 else -45)
+        pivot = rDNW.tr / 2 + rDNW.bl / 2
+        morph = (pivot, mat)
+        insertion_confirmed = page.insertTextbox(
+            rDNW,
+            name,
+            fontsize=8,
+            fontname="Helvetica",
+            fontfile=None,
+            align=1,
+            morph=morph,
+        )
+        assert (
+            insertion_confirmed > 0
+        ), "Text didn't fit: shortname too long?  or font issue/bug?"
 
-    return qr_file
+    return stamps
 
 
 # TODO: Complete the test mode functionality
@@ -81,9 +162,11 @@ def create_exam_and_insert_QR(
     versions,
     test,
     page_versions,
-    qr_file,
+    qr_code,
     test_mode=False,
     test_folder=None,
+    sources=None,
+    stamps=None,
 ):
     """Creates the exam objects and insert the QR codes.
 
@@ -98,23 +181,22 @@ def create_exam_and_insert_QR(
         versions {int} -- Number of version of this Document.
         test {int} -- Test number based on the combination we have around (length ^ versions - initial pages) tests .
         page_versions {dict} -- (int,int) dictionary representing the version of each page for this test.
-        qr_file {dict} -- dict(int: dict(int: Str)) Dictionary that has another embedded dictionary for each page.
-                          The embedded dictionary has a string for QR code paths saved for each corner.
+        qr_code {dict} -- dict(int: dict(int: fitz.Pixmap)) Dictionary that has another embedded dictionary for each page.
+                          The embedded dictionary has the QR code image for each corner, see :func:`create_QR_codes`.
 
     Keyword Arguments:
         test_mode {bool} -- Boolean elements used for testing, testing case with show the documents.  (default: {False})
         test_folder {Str} -- String for where to place the generated test files. (default: {None})
+        sources {dict} -- (int: fitz.Document) the already open source pdfs, see :func:`open_source_versions`. (default: {None}, open them here)
+        stamps {fitz.Document} -- the marks that are the same on every paper, see :func:`create_page_stamps`. (default: {None}, create them here)
 
     Returns:
         fitz.Document -- PDF document type returned as the exam, similar to a dictionary with the ge numbers as the keys.
     """
 
     # A (int : fitz.fitz.Document) dictionary that has the page document/path from each source based on page version
-    version_paths_for_pages = {}
-    for version_index in range(1, versions + 1):
-        version_paths_for_pages[version_index] = fitz.open(
-            "sourceVersions/version{}.pdf".format(version_index)
-        )
+    if sources is None:
+        sources = open_source_versions(versions)
 
     # Create test pdf as "exam"
     exam = fitz.open()
@@ -122,7 +204,7 @@ def create_exam_and_insert_QR(
     for page_index in range(1, length + 1):
         # Pymupdf starts pagecounts from 0 rather than 1. So offset things.
         exam.insertPDF(
-            version_paths_for_pages[page_versions[page_index]],
+            sources[page_versions[page_index]],
             from_page=page_index - 1,
             to_page=page_index - 1,
             start_at=-1,
@@ -131,16 +213,8 @@ def create_exam_and_insert_QR(
     # Get page width and height
     page_width = exam[0].bound().width
     page_height = exam[0].bound().height
-
-    # create a box for the test number near top-centre
-    rTC = fitz.Rect(page_width // 2 - 50, 20, page_width // 2 + 50, 40)
-
-    # put marks at top left/right so students don't write near
-    # staple or near where client will stamp marks
-
-    # create two "do not write" (DNW) rectangles accordingly with TL (top left) and TR (top right)
-    rDNW_TL = fitz.Rect(15, 15, 90, 90)
-    rDNW_TR = fitz.Rect(page_width - 90, 15, page_width - 15, 90)
+    if stamps is None:
+        stamps = create_page_stamps(name, page_width, page_height)
 
     # 70x70 page-corner boxes for the QR codes
     # TL: Top Left, TR: Top Right, BL: Bottom Left, BR: Bottom Right
@@ -152,10 +226,7 @@ def create_exam_and_insert_QR(
     )
 
     for page_index in range(length):
-        # test/page stamp in top-centre of page
-        # Rectangle size hacked by hand. TODO = do this more algorithmically
-        # VALA SAYS: TODO still tands given that the pages are all the same
-        # size. Will ask what it mean to do it algorithmically
+        # test/page stamp in top-centre of page, in the box from the stamps
         rect = fitz.Rect(page_width // 2 - 40, 20, page_width // 2 + 40, 44)
         text = "{}.{}".format(str(test).zfill(4), str(page_index + 1).zfill(2))
         insertion_confirmed = exam[page_index].insertTextbox(
@@ -167,58 +238,28 @@ def create_exam_and_insert_QR(
             fontfile=None,
             align=1,
         )
-        exam[page_index].drawRect(rect, color=[0, 0, 0])
         assert insertion_confirmed > 0
 
-        # stamp DNW near staple: even/odd pages different
-        # Top Left for even pages, Top Right for odd pages
-        # TODO: Perhaps this process could be improved by putting
-        # into functions
-        rDNW = rDNW_TL if page_index % 2 == 0 else rDNW_TR
-        shape = exam[page_index].newShape()
-        shape.drawLine(rDNW.top_left, rDNW.top_right)
-        if page_index % 2 == 0:
-            shape.drawLine(rDNW.top_right, rDNW.bottom_left)
-        else:
-            shape.drawLine(rDNW.top_right, rDNW.bottom_right)
-        shape.finish(width=0.5, color=[0, 0, 0], fill=[0.75, 0.75, 0.75])
-        shape.commit()
-        if page_index % 2 == 0:
-            # offset by trial-and-error, could be improved
-            rDNW = rDNW + (19, 19, 19, 19)
-        else:
-            rDNW = rDNW + (-19, 19, -19, 19)
-        mat = fitz.Matrix(45 if page_index % 2 == 0 else -45)
-        pivot = rDNW.tr / 2 + rDNW.bl / 2
-        morph = (pivot, mat)
-        insertion_confirmed = exam[page_index].insertTextbox(
-            rDNW,
-            name,
-            fontsize=8,
-            fontname="Helvetica",
-            fontfile=None,
-            align=1,
-            morph=morph,
+        # the box and DNW: even/odd pages different
+        exam[page_index].showPDFpage(
+            fitz.Rect(0, 0, page_width, page_height),
+            stamps,
+            page_index % 2,
+            overlay=True,
         )
-        # exam[page_index].drawRect(rDNW, morph=morph)
-        assert (
-            insertion_confirmed > 0
-        ), "Text didn't fit: shortname too long?  or font issue/bug?"
 
         # Grab the tpv QRcodes for current page and put them on the pdf
         # Remember that we only add 3 of the 4 QR codes for each page since
         # we always have a corner section for staples and such
-        qr_code = {}
-        for corner_index in range(1, 5):
-            qr_code[corner_index] = fitz.Pixmap(qr_file[page_index + 1][corner_index])
+        qr = qr_code[page_index + 1]
         if page_index % 2 == 0:
-            exam[page_index].insertImage(rTR, pixmap=qr_code[1], overlay=True)
-            exam[page_index].insertImage(rBR, pixmap=qr_code[4], overlay=True)
-            exam[page_index].insertImage(rBL, pixmap=qr_code[3], overlay=True)
+            exam[page_index].insertImage(rTR, pixmap=qr[1], overlay=True)
+            exam[page_index].insertImage(rBR, pixmap=qr[4], overlay=True)
+            exam[page_index].insertImage(rBL, pixmap=qr[3], overlay=True)
         else:
-            exam[page_index].insertImage(rTL, pixmap=qr_code[2], overlay=True)
-            exam[page_index].insertImage(rBL, pixmap=qr_code[3], overlay=True)
-            exam[page_index].insertImage(rBR, pixmap=qr_code[4], overlay=True)
+            exam[page_index].insertImage(rTL, pixmap=qr[2], overlay=True)
+            exam[page_index].insertImage(rBL, pixmap=qr[3], overlay=True)
+            exam[page_index].insertImage(rBR, pixmap=qr[4], overlay=True)
 
     return exam
 
@@ -346,6 +387,24 @@ def insert_extra_info(extra, exam, test_mode=False, test_folder=None):
     return exam
 
 
+def paper_file_name(test, extra=None):
+    """The file in paperdir that a paper is saved as.
+
+    Arguments:
+        test {int} -- Test number.
+
+    Keyword Arguments:
+        extra {dict} -- (Str:Str) dictioary with student id and name, if the paper is pre-named (default: {None})
+
+    Returns:
+        pathlib.Path -- e.g., "papersToPrint/exam_0012.pdf".
+    """
+    if extra:
+        # save with ID-number is making named papers = issue 790
+        return Path(paperdir) / "exam_{}_{}.pdf".format(str(test).zfill(4), extra["id"])
+    return Path(paperdir) / "exam_{}.pdf".format(str(test).zfill(4))
+
+
 # TODO: Complete the test mode functionality
 def save_PDFs(extra, exam, test, test_mode=False, test_folder=None):
     """Used for saving the exams in paperdir.
@@ -365,13 +424,7 @@ def save_PDFs(extra, exam, test, test_mode=False, test_folder=None):
     # also do garbage collection to remove duplications within pdf
     # and try to clean up as much as possible.
     # `linear=True` causes https://gitlab.com/plom/plom/issues/284
-    if extra:
-        save_name = Path(paperdir) / "exam_{}_{}.pdf".format(
-            str(test).zfill(4), extra["id"]
-        )
-    else:
-        save_name = Path(paperdir) / "exam_{}.pdf".format(str(test).zfill(4))
-    # save with ID-number is making named papers = issue 790
+    save_name = paper_file_name(test, extra)
     exam.save(
         save_name, garbage=4, deflate=True, clean=True,
     )
@@ -394,7 +447,7 @@ def make_PDF(
     """A function that makes the PDFs and saves the modified exam files.
 
     Overall it has 4 steps for each document:
-    1- Create and save Qr codes.
+    1- Create Qr codes.
     2- Create and save exams with the addition of the QR codes.
     3- If extra is defined, add student id and student name.
     4- Finally save the Documents.
@@ -416,24 +469,67 @@ def make_PDF(
         ValueError: Raise error if the student name and number is not encodable
     """
 
-    # Build all relevant pngs in a temp directory
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        # create QR codes and other stamps for each test/page/version
-        qr_file = create_QR_file_dictionary(
-            length, test, page_versions, code, tmp_dir, test_mode, test_folder
-        )
+    builder = PaperBuilder(name, code, length, versions)
+    builder.make_PDF(test, page_versions, extra, test_mode, test_folder)
+
+
+class PaperBuilder:
+    """Makes many papers from the same source versions.
+
+    The source pdfs are opened once and the marks which are the same on
+    every paper are made once (see :func:`create_page_stamps`), rather
+    than again for each paper.  Keep one of these in each process that
+    builds papers.
+    """
+
+    def __init__(self, name, code, length, versions):
+        """Open the source versions from sourceVersions.
+
+        Arguments:
+            name {Str} -- Document Name.
+            code {Str} -- 6 digit distinguished code for the document.
+            length {int} -- Length of the document or number of pages.
+            versions {int} -- Number of version of this Document.
+        """
+        self.name = name
+        self.code = code
+        self.length = length
+        self.versions = versions
+        self.sources = open_source_versions(versions)
+        # stamps for each page size
+        self._stamps = {}
+
+    def stamps(self, page_width, page_height):
+        """The marks which are the same on every paper, made on first use."""
+        key = (page_width, page_height)
+        if key not in self._stamps:
+            self._stamps[key] = create_page_stamps(self.name, page_width, page_height)
+        return self._stamps[key]
+
+    def make_PDF(
+        self, test, page_versions, extra=None, test_mode=False, test_folder=None
+    ):
+        """Makes the PDF of one paper and saves it, as in :func:`make_PDF`."""
+        # create QR codes for each test/page/version
+        qr_code = create_QR_codes(self.length, test, page_versions, self.code)
+
+        # The first page of the paper decides the page size
+        first = self.sources[page_versions[1]][0].bound()
+        stamps = self.stamps(first.width, first.height)
 
         # We then create the exam pdfs while adding the QR codes to it
         exam = create_exam_and_insert_QR(
-            name,
-            code,
-            length,
-            versions,
+            self.name,
+            self.code,
+            self.length,
+            self.versions,
             test,
             page_versions,
-            qr_file,
+            qr_code,
             test_mode,
             test_folder,
+            sources=self.sources,
+            stamps=stamps,
         )
 
         # If we are provided with the student number and student id,
@@ -442,8 +538,8 @@ def make_PDF(
         if extra:
             exam = insert_extra_info(extra, exam, test_mode, test_folder)
 
-    # Finally save the resulting pdf.
-    save_PDFs(extra, exam, test)
+        # Finally save the resulting pdf.
+        save_PDFs(extra, exam, test)
 
 
 if __name__ == "__main__":
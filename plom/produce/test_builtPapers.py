@@ -0,0 +1,43 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Colin B. Macdonald
+
+from .builtPapers import BuiltPapers, paper_inputs_hash
+
+spec = {"name": "foo", "publicCode": "123456", "numberOfPages": 2}
+md5s = {1: "aaaa", 2: "bbbb"}
+
+
+def test_inputs_hash_changes_with_name_on_paper():
+    pv = {1: 1, 2: 2}
+    h = paper_inputs_hash(spec, 1, pv, None, md5s)
+    assert h == paper_inputs_hash(spec, 1, dict(pv), None, dict(md5s))
+    assert h != paper_inputs_hash(spec, 1, pv, {"id": "1234", "name": "A"}, md5s)
+    assert h != paper_inputs_hash(spec, 1, pv, None, {1: "aaaa", 2: "cccc"})
+    assert h != paper_inputs_hash(spec, 2, pv, None, md5s)
+
+
+def test_built_papers_record(tmpdir):
+    f = tmpdir / "exam_0001.pdf"
+    f.write("foo")
+    with BuiltPapers(tmpdir) as built:
+        assert not built.is_current(1, f, "h1")
+        built.add(1, f, "h1")
+        built.add(1, f, "h2")
+    # last one wins when read back, and a torn line is ignored
+    with open(tmpdir / BuiltPapers.filename, "a") as fh:
+        fh.write('{"paper": 2, "fi')
+    built = BuiltPapers(tmpdir)
+    assert built.is_current(1, f, "h2")
+    # crash again before compacting: what we add after the torn line is kept
+    g = tmpdir / "exam_0002.pdf"
+    g.write("bar")
+    with built:
+        built.add(2, g, "h3")
+    assert BuiltPapers(tmpdir).is_current(2, g, "h3")
+    assert not built.is_current(1, f, "h1")
+    assert not built.is_current(2, g, "h2")
+    assert not built.is_current(1, tmpdir / "exam_0001_1234.pdf", "h2")
+    built.compact()
+    assert len((tmpdir / BuiltPapers.filename).readlines()) == 2
+    f.write("changed by hand")
+    assert not BuiltPapers(tmpdir).is_current(1, f, "h2")
@@ -0,0 +1,22 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Colin B. Macdonald
+
+from io import BytesIO
+
+from PIL import Image, ImageOps
+import pyqrcode
+
+from plom.tpv_utils import encodeTPV
+from .mergeAndCodePages import qr_pixmap
+
+
+def test_qr_pixmap_same_as_framed_png():
+    tpv = encodeTPV(12, 3, 1, 4, "123456")
+    buf = BytesIO()
+    pyqrcode.create(tpv, error="H").png(buf, scale=4)
+    # what `mogrify -mattecolor black -frame 1x1` used to do to the png
+    expected = ImageOps.expand(Image.open(buf).convert("L"), border=1, fill=0)
+    pix = qr_pixmap(tpv)
+    assert (pix.width, pix.height) == expected.size
+    assert pix.n == 1
+    assert pix.samples == expected.tobytes()
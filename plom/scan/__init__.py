@@ -10,7 +10,8 @@ __license__ = "AGPL-3.0-or-later"
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 from .rotate import rotateBitmap
-from .fasterQRExtract import QRextract
+from .fasterQRExtract import QRextract, QRextractImage
+from .scanManifest import ScanManifest, pageName
 
 from .sendUnknownsToServer import (
     upload_unknowns,
@@ -5,24 +5,49 @@ __license__ = "AGPL-3.0-or-later"
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import json
-import os
-import subprocess
 import sys
 
 from pyzbar.pyzbar import decode
 from PIL import Image
 
+from plom.tpv_utils import isValidTPV, parseTPV
+from plom.image_utils import is_wider
 from plom.scan import rotateBitmap
 
+# How much of the width and height of the page to search from each
+# corner: the codes are stamped well inside this.  A little more than
+# the 30% that findCorner accepts so we don't cut codes in half.
+corner_fraction = 0.35
+# Try a crop at this scale first, if it is at least this big (pixels)
+reduced_scale = 0.5
+reduced_min_size = 500
+# Upright, the SW and SE codes are always there and the staple corner
+# is usually NW.  Trying that last means we can often skip it.
+corner_order = ("SE", "SW", "NE", "NW")
 
-def findCorner(qr, dim):
+
+def centreOf(qr, offset=(0, 0), scale=1):
+    """The centre of a decoded qr code, in coordinates of the page."""
     xc = []
     yc = []
     for p in qr.polygon:
         xc.append(p.x)
         yc.append(p.y)
-    mx = sum(xc) / len(xc)
-    my = sum(yc) / len(yc)
+    mx = sum(xc) / len(xc) / scale + offset[0]
+    my = sum(yc) / len(yc) / scale + offset[1]
+    return mx, my
+
+
+def findCorner(qr, dim, offset=(0, 0), scale=1):
+    """Which corner of the page a decoded qr code is in, or "??".
+
+    Args:
+        qr: a result from `pyzbar.decode`.
+        dim (tuple): width and height of the page.
+        offset (tuple): where the decoded image was cropped from.
+        scale (float): how much the decoded image was scaled.
+    """
+    mx, my = centreOf(qr, offset, scale)
 
     NS = "?"
     EW = "?"
@@ -42,37 +67,123 @@ def findCorner(qr, dim):
 
 
 def QRextract(imgName):
-    """Decode qr codes from an image file, save them in .qr file.
+    """Decode qr codes from an image file.
 
-    Currently, those are written into a `imgName.qr` file but this could
-    change in the future.  TODO: document whether `imgName` is a full path
-    or just a filename and where the `.qr` file gets written.
-    """
-    qrname = "{}.qr".format(imgName)
-    if os.path.exists(qrname) and os.path.getsize(qrname) != 0:
-        return
+    The image is first rotated into portrait, if needed.
 
+    Args:
+        imgName (str/pathlib.Path): the image file.
+
+    Returns:
+        dict: the qr codes found in each corner, see
+            :func:`QRextractImage`.  The callers keep these in the
+            manifest of the bundle, see :class:`plom.scan.ScanManifest`.
+    """
     # First check if the image is in portrait or landscape by aspect ratio
     # Should be in portrait.
-    cmd = ["identify", "-format", "%[fx:w/h]", imgName]
-    ratio = subprocess.check_output(cmd).decode().rstrip()
-    if float(ratio) > 1:  # landscape
+    if is_wider(imgName):  # landscape
         rotateBitmap(imgName, 90)
 
-    cornerQR = {"NW": [], "NE": [], "SW": [], "SE": []}
+    return QRextractImage(Image.open(imgName))
+
+
+def cornerBoxes(dim):
+    """The regions of the page to search for each corner's qr code.
+
+    Args:
+        dim (tuple): width and height of the page.
+
+    Returns:
+        dict: keys "NW", "NE", "SW", "SE", each a box `(left, upper,
+            right, lower)` as used by `PIL.Image.crop`.
+    """
+    W, H = dim
+    w = round(W * corner_fraction)
+    h = round(H * corner_fraction)
+    return {
+        "NW": (0, 0, w, h),
+        "NE": (W - w, 0, W, h),
+        "SW": (0, H - h, w, H),
+        "SE": (W - w, H - h, W, H),
+    }
+
 
-    img = Image.open(imgName)
-    qrlist = decode(img)
-    for qr in qrlist:
-        cnr = findCorner(qr, img.size)
-        if cnr in ["NW", "NE", "SW", "SE"]:
-            cornerQR[cnr].append(qr.data.decode())
+def decodeCorner(img, cnr, box):
+    """Decode the qr codes in one corner of a page.
 
-    with open(qrname, "w") as fh:
-        json.dump(cornerQR, fh)
+    We first try a reduced copy of the corner, which is usually plenty,
+    and only look at full resolution if that finds nothing.
+
+    Args:
+        img (PIL.Image): the whole page.
+        cnr (str): which corner, "NW", "NE", "SW" or "SE".
+        box (tuple): region of the page to search, see :func:`cornerBoxes`.
+
+    Returns:
+        list: strings decoded from the codes whose centre is in that
+            corner of the page (as decided by :func:`findCorner`).
+    """
+    crop = img.crop(box)
+    scales = [1]
+    if min(crop.size) >= reduced_min_size:
+        scales = [reduced_scale, 1]
+    for scale in scales:
+        if scale == 1:
+            small = crop
+        else:
+            size = (round(crop.width * scale), round(crop.height * scale))
+            small = crop.resize(size, Image.BILINEAR)
+        found = [
+            qr.data.decode()
+            for qr in decode(small)
+            if findCorner(qr, img.size, box[:2], scale) == cnr
+        ]
+        if found:
+            return found
+    return []
+
+
+def enoughCorners(cornerQR):
+    """Have we found enough qr codes to stop looking?
+
+    Each page is stamped with three codes.  We stop when three corners
+    each have one valid code and they all agree which page this is.
+    """
+    found = [qrs for qrs in cornerQR.values() if qrs]
+    if len(found) < 3 or any(len(qrs) != 1 for qrs in found):
+        return False
+    if not all(isValidTPV(qrs[0]) for qrs in found):
+        return False
+    return len(set(parseTPV(qrs[0])[:4] for qrs in found)) == 1
+
+
+def QRextractImage(img):
+    """Decode the qr codes in the corners of an image.
+
+    We only look in the corners: most of a page is handwriting, which
+    there is no point searching.  The corners are searched one at a
+    time and we stop early if :func:`enoughCorners` is happy, so
+    corners we did not need to look at will have empty lists.
+
+    Args:
+        img (PIL.Image): the page, which should already be in portrait.
+
+    Returns:
+        dict: keys "NW", "NE", "SW", "SE", each a list of the strings
+            decoded from the codes found in that corner.
+    """
+    cornerQR = {"NW": [], "NE": [], "SW": [], "SE": []}
+    boxes = cornerBoxes(img.size)
+    if img.mode not in ("L", "1"):
+        img = img.convert("L")
+    for cnr in corner_order:
+        cornerQR[cnr] = decodeCorner(img, cnr, boxes[cnr])
+        if enoughCorners(cornerQR):
+            break
+    return cornerQR
 
 
 if __name__ == "__main__":
     # Take the bitmap file name as argument.
     imgName = sys.argv[1]
-    QRextract(imgName)
+    print(json.dumps(QRextract(imgName)))
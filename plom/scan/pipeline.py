@@ -0,0 +1,297 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""Process and upload a bundle of scans page by page, in memory.
+
+The usual route writes every page to `scanPNGs`, gamma shifts them in
+place, moves them to `pageImages`, reads them again for QR codes, moves
+them to `decodedPages` and reads them again to upload.  Here each page
+goes render -> gamma -> QR decode -> orient in a pool of worker
+processes while the main process uploads the pages that are ready.  A
+page is written to disk once, into wherever it ends up (sent,
+discarded, colliding or unknown), and recorded in the manifest of the
+bundle as usual so the other upload commands still work on the bundle.
+"""
+
+from collections import defaultdict, deque
+import getpass
+import hashlib
+from io import BytesIO
+import math
+from multiprocessing import Pool
+import os
+from pathlib import Path
+
+import fitz
+from PIL import Image
+from tqdm import tqdm
+
+from plom.image_utils import (
+    gamma_adjust,
+    is_wider,
+    normalize_jpeg_orientation,
+    rotate,
+)
+from plom.messenger import ScanMessenger
+from plom.plom_exceptions import *
+from plom.scan import QRextractImage, ScanManifest
+from plom.scan.readQRCodes import checkQRs
+from plom.scan.scansToImages import makeBundleDirectories, processPageToBitmap
+
+# set in each worker process by _initWorker
+_spec = None
+_skip_gamma = False
+_do_not_extract = False
+_docs = {}
+
+
+def _initWorker(spec, skip_gamma, do_not_extract):
+    global _spec, _skip_gamma, _do_not_extract
+    _spec = spec
+    _skip_gamma = skip_gamma
+    _do_not_extract = do_not_extract
+
+
+def _getDoc(file_name):
+    """Each worker opens the PDF once and keeps it open."""
+    if file_name not in _docs:
+        _docs[file_name] = fitz.open(file_name)
+    return _docs[file_name]
+
+
+def processPage(task):
+    """Render, gamma-shift, QR-decode and orient one page, in a worker.
+
+    Args:
+        task (tuple): `(file_name, page_number, basename)`, the page
+            is numbered from zero.
+
+    Returns:
+        dict: with keys `order` (the page number in the bundle, from
+            1), `name` (a file name), `data` (the image as bytes),
+            `qrs` (QR codes found in each corner), `tpv` (None if we
+            could not tell what page it is) and `msg` (None, or a
+            warning or the reason we could not tell).
+    """
+    file_name, page_number, basename = task
+    doc = _getDoc(file_name)
+    ext, data = processPageToBitmap(doc[page_number], doc, basename, _do_not_extract)
+    jpeg = ext.lower() in ("jpg", "jpeg")
+    if jpeg:
+        data = normalize_jpeg_orientation(data)
+    elif ext.lower() == "png" and not _skip_gamma:
+        data = gamma_adjust(data)
+
+    # Should be in portrait.
+    if is_wider(data):
+        data = rotate(data, 90, jpeg)
+    qrs = QRextractImage(Image.open(BytesIO(data)))
+
+    tpv, angle, msg = checkQRs(qrs, _spec)
+    if tpv:
+        t, p, v = tpv
+        if not (
+            0 <= t <= _spec["numberToProduce"]
+            and 0 <= p <= _spec["numberOfPages"]
+            and 0 <= v <= _spec["numberOfVersions"]
+        ):
+            tpv = None
+            msg = "Mismatch between page scanned and spec: t{} p{} v{}".format(t, p, v)
+        elif angle:
+            data = rotate(data, angle, jpeg)
+
+    return {
+        "order": page_number + 1,
+        "name": "{}.{}".format(basename, ext),
+        "data": data,
+        "qrs": qrs,
+        "tpv": tpv,
+        "msg": msg,
+    }
+
+
+def processPages(pool, tasks, ahead=None):
+    """Generate processed pages in order, working ahead in the pool.
+
+    Args:
+        pool (multiprocessing.Pool): workers set up by `_initWorker`.
+        tasks (list): arguments for :func:`processPage`.
+        ahead (int/None): how many pages to have in progress or
+            waiting at once, by default twice the number of CPUs.  This
+            keeps the workers busy while the caller uploads, without
+            holding the whole bundle in memory if uploading is slow.
+
+    Yields:
+        dict: the result of :func:`processPage` for each task.
+    """
+    if ahead is None:
+        ahead = 2 * (os.cpu_count() or 1)
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(processPage, (task,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _savePage(page, manifest, dest, status, **fields):
+    """Write the image of a page into the bundle and record it in the manifest.
+
+    Args:
+        page (dict): see :func:`processPage`.
+        manifest (ScanManifest): of the bundle.
+        dest (pathlib.Path): the file name, relative to the bundle.
+        status (str): see :class:`plom.scan.ScanManifest`.
+        fields: anything else to record about the page.
+    """
+    with open(manifest.bundledir / dest, "wb") as f:
+        f.write(page["data"])
+    manifest.update(
+        page["name"],
+        qrs=page["qrs"],
+        tpv=page["tpv"] and list(page["tpv"]),
+        msg=page["msg"],
+        status=status,
+        file=str(dest),
+        **fields,
+    )
+
+
+def processAndUploadPages(
+    msgr, pdf_fname, bundledir, skip_list, skip_gamma=False, skip_img_extract=False
+):
+    """Process each page of a bundle and upload it as soon as it is ready.
+
+    Args:
+        msgr (ScanMessenger): an open authenticated messenger.
+        pdf_fname (str, pathlib.Path): the PDF file of scans.
+        bundledir (pathlib.Path): the bundle directory, which must
+            already have its "uploads" subdirectories.
+        skip_list (list of int): the bundle-orders of pages already in
+            the system, which we do not process at all.
+        skip_gamma (bool): skip white balancing.
+        skip_img_extract (bool): always render, don't extract images.
+
+    Returns:
+        defaultdict: the pages uploaded for each test, as in
+            :func:`plom.scan.sendPagesToServer.sendTestFiles`.
+    """
+    spec = msgr.get_spec()
+    makeBundleDirectories(pdf_fname, bundledir)
+    bundle_name = bundledir.name
+    # issue #126 - replace spaces in names with underscores for output names.
+    safeScan = Path(pdf_fname).stem.replace(" ", "_")
+    doc = fitz.open(pdf_fname)
+    N = len(doc)
+    doc.close()
+    zpad = math.floor(math.log10(N)) + 1
+
+    tasks = []
+    for n in range(N):
+        if n + 1 in skip_list:
+            print("Page {} already uploaded. Skipping.".format(n + 1))
+            continue
+        basename = "{}-{:0{width}}".format(safeScan, n + 1, width=zpad)
+        tasks.append((str(pdf_fname), n, basename))
+
+    TUP = defaultdict(list)
+    with ScanManifest(bundledir) as manifest, Pool(
+        initializer=_initWorker, initargs=(spec, skip_gamma, skip_img_extract)
+    ) as pool:
+        pages = processPages(pool, tasks)
+        for page in tqdm(pages, total=len(tasks)):
+            if page["tpv"] is None:
+                print(
+                    "[F] {0}: {1} - saving to unknownPages".format(
+                        page["name"], page["msg"]
+                    )
+                )
+                dest = Path("unknownPages") / page["name"]
+                _savePage(page, manifest, dest, "unknown")
+                continue
+            if page["msg"]:
+                print("[W] {0}: {1}".format(page["name"], page["msg"]))
+            t, p, v = page["tpv"]
+            ts, ps, vs = str(t), str(p), str(v)
+            shortName = "t{}p{}v{}.{}".format(
+                ts.zfill(4), ps.zfill(2), vs, page["name"]
+            )
+            code = "t{}p{}v{}".format(ts.zfill(4), ps.zfill(2), vs)
+            md5 = hashlib.md5(page["data"]).hexdigest()
+            rmsg = msgr.uploadTestPage(
+                code, t, p, v, shortName, page["data"], md5, bundle_name, page["order"]
+            )
+            # rmsg = [True] or [False, reason, message]
+            if rmsg[0]:
+                _savePage(page, manifest, Path("uploads/sentPages") / shortName, "sent")
+                TUP[ts].append(ps)
+            elif rmsg[1] == "duplicate":
+                print("Failed upload = {}, {}".format(rmsg[1], rmsg[2]))
+                dest = Path("uploads/discardedPages") / shortName
+                _savePage(page, manifest, dest, "discarded")
+            elif rmsg[1] == "collision":
+                print("Failed upload = {}, {}".format(rmsg[1], rmsg[2]))
+                # rmsg[2] is [collidingFile, test, page, version]
+                dest = Path("uploads/collidingPages") / shortName
+                _savePage(page, manifest, dest, "colliding", collide=rmsg[2])
+            else:
+                print("Image upload failed for *bad* reason - this should not happen.")
+                print("Reason = {}".format(rmsg[1]))
+                print("Message = {}".format(rmsg[2]))
+                _savePage(page, manifest, Path("decodedPages") / shortName, "decoded")
+    return TUP
+
+
+def processAndUploadScans(
+    pdf_fname, bundledir, skip_list, server=None, password=None, skip_gamma=False
+):
+    """Process a bundle of scans and upload the test pages as we go.
+
+    The bundle must already be created on the server.  Afterwards we
+    send a 'please trigger an update' message to the server.
+
+    Returns:
+        list: `[TUP, updates]` as for
+            :func:`plom.scan.sendPagesToServer.uploadTPages`.
+    """
+    if server and ":" in server:
+        s, p = server.split(":")
+        msgr = ScanMessenger(s, port=p)
+    else:
+        msgr = ScanMessenger(server)
+    msgr.start()
+
+    # get the password if not specified
+    if password is None:
+        try:
+            pwd = getpass.getpass("Please enter the 'scanner' password:")
+        except Exception as error:
+            print("ERROR", error)
+    else:
+        pwd = password
+
+    # get started
+    try:
+        msgr.requestAndSaveToken("scanner", pwd)
+    except PlomExistingLoginException:
+        print(
+            "You appear to be already logged in!\n\n"
+            "  * Perhaps a previous session crashed?\n"
+            "  * Do you have another scanner-script running,\n"
+            "    e.g., on another computer?\n\n"
+            'In order to force-logout the existing authorisation run "plom-scan clear"'
+        )
+        exit(10)
+
+    try:
+        TUP = processAndUploadPages(
+            msgr, pdf_fname, bundledir, skip_list, skip_gamma=skip_gamma
+        )
+        updates = msgr.triggerUpdateAfterTUpload()
+    finally:
+        msgr.closeUser()
+        msgr.stop()
+
+    return [TUP, updates]
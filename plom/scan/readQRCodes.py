@@ -9,8 +9,6 @@ __license__ = "AGPL-3.0-or-later"
 from collections import defaultdict
 import getpass
 import json
-import os
-import shutil
 import subprocess
 from multiprocessing import Pool
 from pathlib import Path
@@ -27,35 +25,72 @@ from plom.tpv_utils import (
 )
 from plom.messenger import ScanMessenger
 from plom.plom_exceptions import *
-from plom.scan import QRextract
+from plom.scan import QRextract, ScanManifest
 from plom.scan import rotateBitmap
 from plom import PlomImageExts
 
 
-def decodeQRs(where):
+def decodeQRs(where, manifest):
     """Find all bitmaps in pageImages dir and decode their QR codes.
 
     If their QRcodes have not been successfully decoded previously
-    then decode them.  The results are stored in blah.<ext>.qr files.
+    then decode them.  The results are stored in the manifest of the
+    bundle.
 
     Args:
         where (str, Path): where to search, e.g., "bundledir/pageImages"
+        manifest (ScanManifest): the manifest of the bundle.
     """
     stuff = []
     for ext in PlomImageExts:
-        stuff.extend(where.glob("*.{}".format(ext)))
+        for fname in where.glob("*.{}".format(ext)):
+            if "qrs" in manifest.get(fname.name):
+                continue
+            # bundles from earlier versions have a .qr file for each image
+            qrname = Path(str(fname) + ".qr")
+            if qrname.exists() and qrname.stat().st_size != 0:
+                with open(qrname, "r") as fh:
+                    qrs = json.load(fh)
+                fpath = fname.relative_to(manifest.bundledir)
+                manifest.update(fname.name, qrs=qrs, file=str(fpath))
+                continue
+            stuff.append(fname)
     N = len(stuff)
     # TODO: processes=8?  Seems its chosen automatically (?)
     with Pool() as p:
-        r = list(tqdm(p.imap_unordered(QRextract, stuff), total=N))
-    # This does the same as the following serial loop but in parallel
-    # for x in glob.glob(...):
-    #     QRextract(x)
+        for fname, qrs in zip(stuff, tqdm(p.imap(QRextract, stuff), total=N)):
+            fpath = fname.relative_to(manifest.bundledir)
+            manifest.update(fname.name, qrs=qrs, file=str(fpath))
 
 
 def reOrientPage(fname, qrs):
     """Re-orient this page if needed
 
+    Args:
+       fname (str): the bitmap filename of this page.  Either its the FQN
+                    or we are currently in the right directory.
+       qrs (dict): the QR codes of the four corners.  Some or all may
+                   be missing.
+
+    Returns:
+       bool: True if the image was already upright or has now been
+             made upright.  False if the image is in unknown
+             orientation or we have contradictory information.
+
+    See :func:`orientationFromQRs` for how we decide.
+    """
+    angle = orientationFromQRs(qrs)
+    if angle is None:
+        # either not enough info or conflicting info
+        return False
+    if angle:
+        rotateBitmap(fname, angle)
+    return True
+
+
+def orientationFromQRs(qrs):
+    """How much to rotate a page to make it upright.
+
     If a page is upright, a subset of the QR codes 1 through 4 are on
     the corners:
 
@@ -72,16 +107,12 @@ def reOrientPage(fname, qrs):
     scenario, we can orient even if we know only one corner.
 
     Args:
-       fname (str): the bitmap filename of this page.  Either its the FQN
-                    or we are currently in the right directory.
        qrs (dict): the QR codes of the four corners.  Some or all may
                    be missing.
 
     Returns:
-       bool: True if the image was already upright or has now been
-             made upright.  False if the image is in unknown
-             orientation or we have contradictory information.
-
+       int/None: 0 if the page is upright, 180 if it is upside down, or
+                 None if we don't know or have contradictory information.
     """
     upright = [1, 2, 3, 4]  # [NE, NW, SW, SE]
     flipped = [3, 4, 1, 2]
@@ -101,20 +132,94 @@ def reOrientPage(fname, qrs):
 
     if upFlag and not flipFlag:
         # is upright, no rotation needed
-        return True
+        return 0
     if flipFlag and not upFlag:
-        rotateBitmap(fname, 180)
-        return True
-    else:
-        # either not enough info or conflicting info
-        return False
+        return 180
+    # either not enough info or conflicting info
+    return None
+
 
+def checkQRs(qrs, spec):
+    """Sanity check the QR codes decoded from one page image.
 
-def checkQRsValid(bundledir, spec, examsScannedNow):
+    Args:
+        qrs (dict): the lists of QR codes found in each corner, as
+            produced by :func:`plom.scan.QRextractImage`.
+        spec (dict): exam specification, see :func:`plom.SpecVerifier`.
+
+    Returns:
+        tuple: `(tpv, angle, msg)`.  If we are confident which page
+            this is then `tpv` is the triple `(test, page, version)`,
+            `angle` is how much to rotate the image to make it upright
+            and `msg` is None or a warning.  Otherwise `tpv` is None
+            and `msg` explains why.
+    """
+    # Flag papers that have too many QR codes in some corner
+    if any(len(x) > 1 for x in qrs.values()):
+        msg = "Too many QR codes in some corner (debug: qrs is {})".format(str(qrs))
+        return None, None, msg
+
+    # Unpack the lists of QRs, building a new dict with only the
+    # the corners with exactly one QR code.
+    tmp = {}
+    for (d, qr) in qrs.items():
+        if len(qr) == 1:
+            tmp[d] = qr[0]
+    qrs = tmp
+    del tmp
+
+    if len(qrs) == 0:
+        return None, None, "No QR codes were decoded."
+
+    for tpvc in qrs.values():
+        if not isValidTPV(tpvc):
+            return None, None, "TPV '{}' is not a valid format".format(tpvc)
+        elif not hasCurrentAPI(tpvc):
+            msg = "TPV '{}' does not match API.  Legacy issue?".format(tpvc)
+            return None, None, msg
+        elif str(getCode(tpvc)) != str(spec["publicCode"]):
+            msg = (
+                "Magic code '{0}' did not match spec '{1}'.  "
+                "Did you scan the wrong test?".format(getCode(tpvc), spec["publicCode"])
+            )
+            return None, None, msg
+
+    # Make sure all (t,p,v) on this page are the same
+    tgvs = []
+    for tpvc in qrs.values():
+        tn, pn, vn, cn, o = parseTPV(tpvc)
+        tgvs.append((tn, pn, vn))
+
+    if not len(set(tgvs)) == 1:
+        # Decoder either gives the correct code or no code at all
+        # Perhaps if you see this, its a folded page
+        return None, None, "Multiple different QR codes! (rare in theory: folded page?)"
+
+    angle = orientationFromQRs(qrs)
+    # TODO: future improvement: could keep going, its possible
+    # we can go on to find the (t,p,v) in some cases.
+    if angle is None:
+        return None, None, "Orientation not known"
+
+    # Decide in which cases we can be confident we know this papers (t,p,v)
+    if len(tgvs) == 1:
+        # TODO: in principle could proceed, albeit dangerously
+        return tgvs[0], angle, "Only one of three QR codes decoded."
+    elif len(tgvs) == 2:
+        return tgvs[0], angle, "Only two of three QR codes decoded."
+    elif len(tgvs) == 3:
+        # full consensus
+        return tgvs[0], angle, None
+    else:  # len > 3, shouldn't be possible now
+        return None, None, "Too many QR codes on the page!"
+
+
+def checkQRsValid(bundledir, spec, examsScannedNow, manifest):
     """Check that the QRcodes in each pageimage are valid.
 
-    When each bitmap is scanned a .qr is produced.  Load the dict of
-    QR codes from that file and do some sanity checks.
+    When each bitmap is decoded its QR codes go in the manifest of the
+    bundle.  Look them up and do some sanity checks, see
+    :func:`checkQRs`.
 
     Rotate any images that we can.
 
@@ -123,129 +228,46 @@ def checkQRsValid(bundledir, spec, examsScannedNow):
             `bundledir/pageImages` and other subdirs.
         spec (dict): exam specification, see :func:`plom.SpecVerifier`.
         examsScannedNow: TODO?
-
-    TODO: maybe we should split this function up a bit!
+        manifest (ScanManifest): the manifest of the bundle.
     """
-    # go into page image directory of each bundle and look at each .qr file.
-    for fnqr in (bundledir / "pageImages").glob("*.qr"):
-        # fname = fnqr.stem  # strip .qr from blah.<ext>.qr
-        fname = Path(str(fnqr)[0:-3])  # Yuck, TODO
-        with open(fnqr, "r") as qrfile:
-            qrs = json.load(qrfile)
-
-        problemFlag = False
-        warnFlag = False
-
-        # Flag papers that have too many QR codes in some corner
-        if any(len(x) > 1 for x in qrs.values()):
-            msg = "Too many QR codes in some corner (debug: qrs is {})".format(str(qrs))
-            problemFlag = True
-
-        # Unpack the lists of QRs, building a new dict with only the
-        # the corners with exactly one QR code.
-        tmp = {}
-        for (d, qr) in qrs.items():
-            if len(qr) == 1:
-                tmp[d] = qr[0]
-        qrs = tmp
-        del tmp
-
-        if len(qrs) == 0:
-            msg = "No QR codes were decoded."
-            problemFlag = True
-
-        if not problemFlag:
-            for tpvc in qrs.values():
-                if not isValidTPV(tpvc):
-                    msg = "TPV '{}' is not a valid format".format(tpvc)
-                    problemFlag = True
-                elif not hasCurrentAPI(tpvc):
-                    msg = "TPV '{}' does not match API.  Legacy issue?".format(tpvc)
-                    problemFlag = True
-                elif str(getCode(tpvc)) != str(spec["publicCode"]):
-                    msg = (
-                        "Magic code '{0}' did not match spec '{1}'.  "
-                        "Did you scan the wrong test?".format(
-                            getCode(tpvc), spec["publicCode"]
-                        )
-                    )
-                    problemFlag = True
-
-        # Make sure all (t,p,v) on this page are the same
-        if not problemFlag:
-            tgvs = []
-            for tpvc in qrs.values():
-                tn, pn, vn, cn, o = parseTPV(tpvc)
-                tgvs.append((tn, pn, vn))
-
-            if not len(set(tgvs)) == 1:
-                # Decoder either gives the correct code or no code at all
-                # Perhaps if you see this, its a folded page
-                msg = "Multiple different QR codes! (rare in theory: folded page?)"
-                problemFlag = True
-
-        if not problemFlag:
-            orientationKnown = reOrientPage(fname, qrs)
-            # TODO: future improvement: could keep going, its possible
-            # we can go on to find the (t,p,v) in some cases.
-            if not orientationKnown:
-                msg = "Orientation not known"
-                problemFlag = True
-
-        # Decide in which cases we can be confident we know this papers (t,p,v)
-        if not problemFlag:
-            if len(tgvs) == 1:
-                msg = "Only one of three QR codes decoded."
-                # TODO: in principle could proceed, albeit dangerously
-                warnFlag = True
-                riskiness = 10
-                tgv = tgvs[0]
-            elif len(tgvs) == 2:
-                msg = "Only two of three QR codes decoded."
-                warnFlag = True
-                riskiness = 1
-                tgv = tgvs[0]
-            elif len(tgvs) == 3:
-                # full consensus
-                tgv = tgvs[0]
-            else:  # len > 3, shouldn't be possible now
-                msg = "Too many QR codes on the page!"
-                problemFlag = True
-
-        if not problemFlag:
+    # go into page image directory of each bundle and look at each image.
+    files = []
+    for ext in PlomImageExts:
+        files.extend((bundledir / "pageImages").glob("*.{}".format(ext)))
+    for fname in files:
+        qrs = manifest.get(fname.name).get("qrs")
+        if qrs is None:
+            # not decoded
+            continue
+
+        tpv, angle, msg = checkQRs(qrs, spec)
+
+        if tpv:
             # we have a valid TGVC and the code matches.
-            if warnFlag:
+            if angle:
+                rotateBitmap(fname, angle)
+            if msg:
                 print("[W] {0}: {1}".format(fname, msg))
                 print(
                     "   (high occurrences of these warnings may mean printer/scanner problems)"
                 )
+            manifest.update(fname.name, tpv=list(tpv), angle=angle, msg=msg)
             # store the tpv in examsScannedNow
-            examsScannedNow[fname] = [tn, pn, vn]
+            examsScannedNow[fname] = list(tpv)
             # later we check that list against those produced during build
-
-        if problemFlag:
+        else:
             # Difficulty scanning this pageimage so move it to unknownPages
-            # fname =  bname/pageImages/blah-n.png
-            # dst = bname/unknownPages/blah-n.png
-            [prefix, suffix] = os.path.split(
-                fname
-            )  # pref = "bname/pageImages", suf = blah-n.png
-            dst = os.path.join(os.path.split(prefix)[0], "unknownPages", suffix)
-
             print("[F] {0}: {1} - moving to unknownPages".format(fname, msg))
-            # move blah.<ext> and blah.<ext>.qr
-            shutil.move(fname, dst)
-            # TODO: better with some `.with_suffix()` juggling
-            # TODO: there are at least two other places
-            shutil.move(Path(str(fname) + ".qr"), Path(str(dst) + ".qr"))
+            dst = Path("unknownPages") / fname.name
+            manifest.move(fname, dst, "unknown", tpv=None, msg=msg)
 
 
-def validateQRsAgainstSpec(spec, examsScannedNow):
+def validateQRsAgainstSpec(spec, examsScannedNow, manifest):
     """After pageimages have been decoded we need to check the results
     against the spec. A simple check of test-name and magic-code were
     done already, but now the test-page-version triples are checked.
     """
-    for fname in examsScannedNow:
+    for fname in list(examsScannedNow):
         t = examsScannedNow[fname][0]
         p = examsScannedNow[fname][1]
         v = examsScannedNow[fname][2]
@@ -259,7 +281,7 @@ def validateQRsAgainstSpec(spec, examsScannedNow):
             flag = False
         if not flag:
             print(">> Mismatch between page scanned and spec - this should NOT happen")
-            print(">> Produced t{} p{} v{}".format(t, p, tfv[1]))
+            print(">> Produced t{} p{} v{}".format(t, p, v))
             print(
                 ">> Must have t-code in [1,{}], p-code in [1,{}], v-code in [1,{}]".format(
                     spec["numberToProduce"],
@@ -268,43 +290,26 @@ def validateQRsAgainstSpec(spec, examsScannedNow):
                 )
             )
             print(">> Moving problem files to unknownPages")
-            # fname =  bname/pageImages/blah-n.png
-            # dst = bname/unknownPages/blah-n.png
-            [prefix, suffix] = os.path.split(
-                fname
-            )  # pref = "bname/pageImages", suf = blah-n.png
-            dst = os.path.join(os.path.split(prefix)[0], "unknownPages", suffix)
-
+            msg = "Mismatch between page scanned and spec: t{} p{} v{}".format(t, p, v)
             print("[F] {0}: {1} - moving to unknownPages".format(fname, msg))
-            # move the blah.<ext> and blah.<ext>.qr
             # this means that they won't be added to the
             # list of correctly scanned page images
-            shutil.move(fname, dst)
-            # TODO: better with some `.with_suffix()` juggling
-            # TODO: there are at least two other places
-            shutil.move(Path(str(fname) + ".qr"), Path(str(dst) + ".qr"))
+            dst = Path("unknownPages") / Path(fname).name
+            manifest.move(fname, dst, "unknown", tpv=None, msg=msg)
+            del examsScannedNow[fname]
 
 
-def moveScansIntoPlace(examsScannedNow):
-    # os.chdir("pageImages")
+def moveScansIntoPlace(examsScannedNow, manifest):
     # For each test we have just scanned
     for fname in examsScannedNow:
         t = examsScannedNow[fname][0]
         p = examsScannedNow[fname][1]
         v = examsScannedNow[fname][2]
 
-        [prefix, suffix] = os.path.split(
-            fname
-        )  # pref = "bname/pageImages", suf = blah-n.png
-        dpath = os.path.join(os.path.split(prefix)[0], "decodedPages")
-        # move blah-n.png to txxxxpyyvz.blah-n.png
+        # move blah-n.png to decodedPages/txxxxpyyvz.blah-n.png
+        suffix = Path(fname).name
         dname = "t{}p{}v{}.{}".format(str(t).zfill(4), str(p).zfill(2), str(v), suffix)
-        shutil.move(fname, os.path.join(dpath, dname))
-        # TODO: better with some `.with_suffix()` juggling
-        # TODO: there are at least two other places
-        shutil.move(
-            Path(str(fname) + ".qr"), os.path.join(dpath, Path(str(dname) + ".qr"))
-        )
+        manifest.move(fname, Path("decodedPages") / dname, "decoded")
 
 
 def processBitmaps(bundle, server=None, password=None):
@@ -344,7 +349,8 @@ def processBitmaps(bundle, server=None, password=None):
     scanMessenger.closeUser()
     scanMessenger.stop()
 
-    decodeQRs(bundle / "pageImages")
-    checkQRsValid(bundle, spec, examsScannedNow)
-    validateQRsAgainstSpec(spec, examsScannedNow)
-    moveScansIntoPlace(examsScannedNow)
+    with ScanManifest(bundle) as manifest:
+        decodeQRs(bundle / "pageImages", manifest)
+        checkQRsValid(bundle, spec, examsScannedNow, manifest)
+        validateQRsAgainstSpec(spec, examsScannedNow, manifest)
+        moveScansIntoPlace(examsScannedNow, manifest)
@@ -6,10 +6,11 @@ __license__ = "AGPL-3.0-or-later"
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import os
-import subprocess
 
 import jpegtran
 
+from plom.image_utils import rotate_file
+
 
 def rotateBitmap(fname, angle):
     """Rotate bitmap, (almost) lossless for jpg.
@@ -27,9 +28,4 @@ def rotateBitmap(fname, angle):
         im.rotate(angle).save(fname)
         return
 
-    subprocess.run(
-        ["mogrify", "-quiet", "-rotate", str(angle), fname],
-        stderr=subprocess.STDOUT,
-        shell=False,
-        check=True,
-    )
+    rotate_file(fname, angle)
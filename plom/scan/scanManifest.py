@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""A record of what happened to each page image of a bundle
+
+Each page image of a bundle has its QR codes decoded, its test, page
+and version worked out, and is then uploaded (or not).  We used to keep
+the QR codes in a `.qr` file next to each image and move that around
+with the image.  Now all of this goes in one file per bundle, which we
+only ever append to.
+"""
+
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+
+from plom.misc_utils import md5sum_of_file, read_jsonl, open_jsonl_for_append
+
+
+def pageName(fname):
+    """The name a page image was given when it was made from its bundle.
+
+    Decoded pages get "tXXXXpYYvZ." put in front of this name, which we
+    strip off, so a page keeps its name as it moves around the bundle.
+
+    Args:
+        fname (str/pathlib.Path): the image file, e.g.,
+            "bundles/foo/decodedPages/t0001p02v1.foo-003.png".
+
+    Returns:
+        str: e.g., "foo-003.png".
+    """
+    name = os.path.basename(fname)
+    m = re.match(r"t\d+p\d+v\d+\.(.+)", name)
+    return m.group(1) if m else name
+
+
+class ScanManifest:
+    """The QR codes, test-page-version and status of the pages of a bundle.
+
+    Pages are keyed by :func:`pageName`.  The record of each page is a
+    dict with some of the keys:
+      * `qrs`: the QR codes found in each corner, see
+        :func:`plom.scan.QRextractImage`.
+      * `tpv`: `[test, page, version]` or None if we could not tell.
+      * `angle`: how much the image was rotated to make it upright.
+      * `msg`: a warning, or the reason we could not tell the tpv.
+      * `status`: where the page is at: "decoded", "unknown", "sent",
+        "discarded" or "colliding".
+      * `file`: the image file now, relative to the bundle directory.
+      * `collide`: for a colliding page, `[file, test, page, version]`
+        of the page it collides with.
+      * `md5sum`: of the image file, with the `size` and `mtime_ns` of
+        the file when it was hashed, see :meth:`md5sums`.
+
+    The file "scan.jsonl" in the bundle directory has a line of JSON for
+    each update.  We only ever append to it, so a crash loses at most
+    the last update.
+    """
+
+    filename = "scan.jsonl"
+
+    def __init__(self, bundledir):
+        """Load the manifest of a bundle, if it has one yet.
+
+        Args:
+            bundledir (str/pathlib.Path): the bundle directory.
+        """
+        self.bundledir = Path(bundledir)
+        self.path = self.bundledir / self.filename
+        self._pages = {}
+        self._fh = None
+        for record in read_jsonl(self.path):
+            self._pages.setdefault(record.pop("name"), {}).update(record)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __contains__(self, name):
+        return name in self._pages
+
+    def get(self, name):
+        """The record of a page, empty if we know nothing about it."""
+        return dict(self._pages.get(name, {}))
+
+    def update(self, name, **fields):
+        """Record changes to a page.
+
+        Args:
+            name (str): see :func:`pageName`.
+            fields: the keys to change, see :class:`ScanManifest`.
+        """
+        self.update_many([dict(name=name, **fields)])
+
+    def update_many(self, records):
+        """Record changes to many pages at once.
+
+        Args:
+            records (list): of dicts, each with key `name` and the
+                fields to change.
+        """
+        if not records:
+            return
+        if self._fh is None:
+            self._fh = open_jsonl_for_append(self.path)
+        self._fh.write("".join(json.dumps(record) + "\n" for record in records))
+        for record in records:
+            record = dict(record)
+            self._pages.setdefault(record.pop("name"), {}).update(record)
+
+    def move(self, fname, dest, status, **fields):
+        """Move a page image within the bundle and record where it went.
+
+        Args:
+            fname (str/pathlib.Path): the image file.
+            dest (str/pathlib.Path): its new name, relative to the
+                bundle directory, e.g., "uploads/sentPages/foo-003.png".
+            status (str): see :class:`ScanManifest`.
+            fields: anything else to record about the page.
+        """
+        shutil.move(fname, self.bundledir / dest)
+        self.update(pageName(fname), status=status, file=str(dest), **fields)
+
+    def md5sums(self, files):
+        """The md5sum of each of some page images of the bundle.
+
+        Hashing a big bundle takes a while, so these are recorded with
+        the size and modification time of each file.  Only new or
+        changed files are read again.
+
+        Args:
+            files (list of pathlib.Path): page images in the bundle.
+
+        Returns:
+            dict: keys are the files and values their md5sums.
+        """
+        md5s = {}
+        changed = []
+        for fname in files:
+            name = pageName(fname)
+            page = self._pages.get(name, {})
+            st = os.stat(fname)
+            if (
+                page.get("size") == st.st_size
+                and page.get("mtime_ns") == st.st_mtime_ns
+            ):
+                md5s[fname] = page["md5sum"]
+                continue
+            md5s[fname] = md5sum_of_file(fname)
+            changed.append(
+                {
+                    "name": name,
+                    "md5sum": md5s[fname],
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                }
+            )
+        self.update_many(changed)
+        return md5s
+
+    def files(self, status):
+        """The image files of the pages with a given status.
+
+        Returns:
+            list: of `pathlib.Path`, sorted.
+        """
+        return sorted(
+            self.bundledir / page["file"]
+            for page in self._pages.values()
+            if page.get("status") == status
+        )
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
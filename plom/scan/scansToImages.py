@@ -4,14 +4,13 @@
 # Copyright (C) 2019-2020 Colin B. Macdonald
 # Copyright (C) 2020 Victoria Schuster
 
-import hashlib
 import os
 from pathlib import Path
 import shutil
+import sqlite3
 import subprocess
 from multiprocessing import Pool
 import math
-import tempfile
 import warnings
 
 import toml
@@ -22,29 +21,54 @@ import jpegtran
 
 from plom import PlomImageExts
 from plom import ScenePixelHeight
+from plom.image_utils import gamma_adjust_file, to_png
+from plom.misc_utils import md5sum_of_file
 
 
 # TODO: make some common util file to store all these names?
 archivedir = Path("archivedPDFs")
 
 
+def _archiveDB():
+    """Open the database of archived bundles, creating it if needed.
+
+    It has one table, `bundles`, of the md5sum (the primary key) and
+    name of each archived bundle.  Earlier versions kept these in
+    "archive.toml", which we import the first time and then rename.
+
+    Returns:
+        sqlite3.Connection
+    """
+    db = sqlite3.connect(str(archivedir / "archive.db"))
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS bundles (md5sum TEXT PRIMARY KEY, name TEXT)"
+    )
+    legacy = archivedir / "archive.toml"
+    if legacy.exists():
+        with db:
+            db.executemany(
+                "INSERT OR IGNORE INTO bundles VALUES (?, ?)",
+                toml.load(legacy).items(),
+            )
+        legacy.rename(archivedir / "archive.toml.imported")
+    return db
+
+
 def _archiveBundle(file_name, this_archive_dir):
     """Archive the bundle pdf.
 
     The bundle.pdf is moved into the appropriate archive directory
-    as given by this_archive_dir. The archive.toml file is updated
+    as given by this_archive_dir. The archive database is updated
     with the name and md5sum of that bundle.pdf.
     """
-    md5 = hashlib.md5(open(file_name, "rb").read()).hexdigest()
+    md5 = md5sum_of_file(file_name)
     shutil.move(file_name, this_archive_dir / Path(file_name).name)
-    try:
-        arch = toml.load(archivedir / "archive.toml")
-    except FileNotFoundError:
-        arch = {}
-    arch[md5] = str(file_name)
-    # now save it
-    with open(archivedir / "archive.toml", "w+") as fh:
-        toml.dump(arch, fh)
+    db = _archiveDB()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO bundles VALUES (?, ?)", (md5, str(file_name))
+        )
+    db.close()
 
 
 def archiveHWBundle(file_name):
@@ -77,14 +101,15 @@ def _md5sum_in_archive(filename):
 
     Note: Current unused?
     """
-    try:
-        archive = toml.load(archivedir / "archive.toml")
-    except FileNotFoundError:
-        return ""
-    for md5, name in archive.items():
-        if filename == name:
-            # if not unique too bad you get 1st one
-            return md5
+    if not archivedir.is_dir():
+        return None
+    db = _archiveDB()
+    # if not unique too bad you get 1st one
+    row = db.execute(
+        "SELECT md5sum FROM bundles WHERE name = ?", (filename,)
+    ).fetchone()
+    db.close()
+    return row[0] if row else None
 
 
 def isInArchive(file_name):
@@ -95,15 +120,16 @@ def isInArchive(file_name):
         None/str: None if not found, otherwise filename of archived file
             with the same md5sum.
     """
-    try:
-        archive = toml.load(archivedir / "archive.toml")
-    except FileNotFoundError:
+    if not archivedir.is_dir():
         return None
-    md5 = hashlib.md5(open(file_name, "rb").read()).hexdigest()
-    return archive.get(md5, None)
+    md5 = md5sum_of_file(file_name)
+    db = _archiveDB()
+    row = db.execute("SELECT name FROM bundles WHERE md5sum = ?", (md5,)).fetchone()
+    db.close()
+    return row[0] if row else None
 
 
-def processFileToBitmaps(file_name, dest, do_not_extract=False):
+def processFileToBitmaps(file_name, dest, do_not_extract=False, workers=None):
     """Extract/convert each page of pdf into bitmap.
 
     We have various ways to do this, in rough order of preference:
@@ -116,6 +142,10 @@ def processFileToBitmaps(file_name, dest, do_not_extract=False):
         file_name (str, Path): PDF file from which to extract bitmaps.
         do_not_extract (bool): always render, do no extract even if
             it seems possible to do so.
+        workers (int/None): how many processes to use, by default one
+            per CPU.  Each works through its own ranges of pages with
+            its own handle on the PDF file.  The output files are the
+            same whatever the number of workers.
 
     For extracting the scanned data as is, we must be careful not to
     just grab any image off the page (for example, it must be the only
@@ -129,113 +159,149 @@ def processFileToBitmaps(file_name, dest, do_not_extract=False):
     # issue #126 - replace spaces in names with underscores for output names.
     safeScan = Path(file_name).stem.replace(" ", "_")
 
-    doc = fitz.open(file_name)
+    with fitz.open(file_name) as doc:
+        N = len(doc)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, N))
+    # Contiguous ranges of pages, a few per worker to even out the load
+    chunk = max(1, math.ceil(N / (4 * workers)))
+    ranges = []
+    for start in range(0, N, chunk):
+        stop = min(start + chunk, N)
+        ranges.append((file_name, dest, safeScan, start, stop, N, do_not_extract))
+    if workers == 1:
+        for r in ranges:
+            _processPageRange(r)
+        return
+    with Pool(workers) as p:
+        list(p.imap(_processPageRange, ranges))
+
 
+def _processPageRange(args):
+    """Extract/convert a range of pages of a pdf into bitmaps, see above."""
+    file_name, dest, safeScan, start, stop, N, do_not_extract = args
     # 0:9 -> 10 pages -> 2 digits
-    zpad = math.floor(math.log10(len(doc))) + 1
-
-    for p in doc:
-        basename = "{}-{:0{width}}".format(safeScan, p.number + 1, width=zpad)
-
-        ok_extract = True
-        msgs = []
-
-        # Any of these might indicate something more complicated than a scan
-        if p.getLinks():
-            msgs.append("Has links")
-            ok_extract = False
-        if list(p.annots()):
-            msgs.append("Has annotations")
-            ok_extract = False
-        if list(p.widgets()):
-            msgs.append("Has fillable forms")
-            ok_extract = False
-        # TODO: which is more expensive, this or getImageList?
-        if p.getText("text"):
-            msgs.append("Has text")
-            ok_extract = False
-
-        # TODO: Do later to get more info in prep for future change to default
-        if do_not_extract:
-            msgs.append("Disabled by flag")
-            ok_extract = False
-
-        if ok_extract:
-            r, d = extractImageFromFitzPage(p, doc)
-            if not r:
-                msgs.append(d)
-            else:
-                print(
-                    '{}: Extracted "{}" from single-image page w={} h={}'.format(
-                        basename, d["ext"], d["width"], d["height"]
-                    )
+    zpad = math.floor(math.log10(N)) + 1
+    with fitz.open(file_name) as doc:
+        for n in range(start, stop):
+            p = doc[n]
+            basename = "{}-{:0{width}}".format(safeScan, p.number + 1, width=zpad)
+            ext, data = processPageToBitmap(p, doc, basename, do_not_extract)
+            outname = os.path.join(dest, basename + "." + ext)
+            with open(outname, "wb") as f:
+                f.write(data)
+
+
+def processPageToBitmap(p, doc, basename, do_not_extract=False):
+    """Extract/convert one page of a pdf into a bitmap, in memory.
+
+    Args:
+        p: a page of a fitz document.
+        doc: fitz doc containing `p`.
+        basename (str): name of the page, for messages.
+        do_not_extract (bool): always render, do no extract even if
+            it seems possible to do so.
+
+    Returns:
+        tuple: `(ext, data)`, the file extension (without dot) and the
+            contents of the bitmap file as bytes.
+
+    See :func:`processFileToBitmaps` for how we choose between
+    extracting and rendering.
+    """
+    ok_extract = True
+    msgs = []
+
+    # Any of these might indicate something more complicated than a scan
+    if p.getLinks():
+        msgs.append("Has links")
+        ok_extract = False
+    if list(p.annots()):
+        msgs.append("Has annotations")
+        ok_extract = False
+    if list(p.widgets()):
+        msgs.append("Has fillable forms")
+        ok_extract = False
+    # TODO: which is more expensive, this or getImageList?
+    if p.getText("text"):
+        msgs.append("Has text")
+        ok_extract = False
+
+    # TODO: Do later to get more info in prep for future change to default
+    if do_not_extract:
+        msgs.append("Disabled by flag")
+        ok_extract = False
+
+    if ok_extract:
+        r, d = extractImageFromFitzPage(p, doc)
+        if not r:
+            msgs.append(d)
+        else:
+            print(
+                '{}: Extracted "{}" from single-image page w={} h={}'.format(
+                    basename, d["ext"], d["width"], d["height"]
                 )
-                if d["ext"].lower() in PlomImageExts:
-                    converttopng = False
-                    # Bail on jpeg if dimensions are not multiples of 16.
-                    # (could relax: iMCU can also be 8x8, 16x8, 8x16: see PIL .layer)
-                    if d["ext"].lower() in ("jpeg", "jpg") and not (
-                        d["width"] % 16 == 0 and d["height"] % 16 == 0
-                    ):
-                        converttopng = True
-                        print(
-                            "  JPEG dim not mult. of 16; transcoding to PNG to avoid lossy transforms"
-                        )
-                        # TODO: we know its jpeg, could use PIL instead of `convert` below
-                else:
+            )
+            if d["ext"].lower() in PlomImageExts:
+                converttopng = False
+                # Bail on jpeg if dimensions are not multiples of 16.
+                # (could relax: iMCU can also be 8x8, 16x8, 8x16: see PIL .layer)
+                if d["ext"].lower() in ("jpeg", "jpg") and not (
+                    d["width"] % 16 == 0 and d["height"] % 16 == 0
+                ):
                     converttopng = True
                     print(
-                        "  {} format not in allowlist: transcoding to PNG".format(
-                            d["ext"]
-                        )
+                        "  JPEG dim not mult. of 16; transcoding to PNG to avoid lossy transforms"
                     )
+            else:
+                converttopng = True
+                print(
+                    "  {} format not in allowlist: transcoding to PNG".format(d["ext"])
+                )
 
-                if not converttopng:
-                    outname = os.path.join(dest, basename + "." + d["ext"])
-                    with open(outname, "wb") as f:
-                        f.write(d["image"])
-                else:
-                    outname = os.path.join(dest, basename + ".png")
-                    with tempfile.NamedTemporaryFile() as g:
-                        with open(g.name, "wb") as f:
-                            f.write(d["image"])
-                        subprocess.check_call(["convert", g.name, outname])
-                continue
-
-        # looks they use ceil not round so decrease a little bit
-        z = (float(ScenePixelHeight) - 0.01) / p.MediaBoxSize[1]
-        ## For testing, choose widely varying random sizes
-        # z = random.uniform(1, 5)
-        print(
-            "{}: Fitz render z={:4.2f}. No extract b/c: {}".format(
-                basename, z, "; ".join(msgs)
-            )
+            if not converttopng:
+                return d["ext"], d["image"]
+            try:
+                return "png", to_png(d["image"])
+            except OSError as err:
+                # e.g., jbig2, which Pillow cannot read: we can still render
+                msgs.append("Could not transcode: {}".format(err))
+
+    # looks they use ceil not round so decrease a little bit
+    z = (float(ScenePixelHeight) - 0.01) / p.MediaBoxSize[1]
+    ## For testing, choose widely varying random sizes
+    # z = random.uniform(1, 5)
+    print(
+        "{}: Fitz render z={:4.2f}. No extract b/c: {}".format(
+            basename, z, "; ".join(msgs)
         )
-        pix = p.getPixmap(fitz.Matrix(z, z), annots=True)
-        if pix.height != ScenePixelHeight:
-            warnings.warn(
-                "rounding error: height of {} instead of {}".format(
-                    pix.height, ScenePixelHeight
-                )
+    )
+    pix = p.getPixmap(fitz.Matrix(z, z), annots=True)
+    if pix.height != ScenePixelHeight:
+        warnings.warn(
+            "rounding error: height of {} instead of {}".format(
+                pix.height, ScenePixelHeight
             )
+        )
 
-        ## For testing, randomly make jpegs, sometimes of truly horrid quality
-        # if random.uniform(0, 1) < 0.4:
-        #     outname = os.path.join("scanPNGs", basename + ".jpg")
-        #     img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        #     quality = random.choice([4, 94, 94, 94, 94])
-        #     img.save(outname, "JPEG", quality=quality, optimize=True)
-        #     # random reorient half for debug/test, uses exiftool (Ubuntu: libimage-exiftool-perl)
-        #     r = random.choice([None, None, None, 3, 6, 8])
-        #     if r:
-        #         print("re-orienting randomly {}".format(r))
-        #         subprocess.check_call(["exiftool", "-overwrite_original", "-Orientation#={}".format(r), outname])
-        #     continue
-
-        # TODO: experiment with jpg: generate both and see which is smaller?
-        # (But be careful about "dim mult of 16" thing above.)
-        outname = os.path.join(dest, basename + ".png")
-        pix.writeImage(outname)
+    ## For testing, randomly make jpegs, sometimes of truly horrid quality
+    # if random.uniform(0, 1) < 0.4:
+    #     outname = os.path.join("scanPNGs", basename + ".jpg")
+    #     img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    #     quality = random.choice([4, 94, 94, 94, 94])
+    #     img.save(outname, "JPEG", quality=quality, optimize=True)
+    #     # random reorient half for debug/test, uses exiftool (Ubuntu: libimage-exiftool-perl)
+    #     r = random.choice([None, None, None, 3, 6, 8])
+    #     if r:
+    #         print("re-orienting randomly {}".format(r))
+    #         subprocess.check_call(["exiftool", "-overwrite_original", "-Orientation#={}".format(r), outname])
+    #     continue
+
+    # TODO: experiment with jpg: generate both and see which is smaller?
+    # (But be careful about "dim mult of 16" thing above.)
+    return "png", pix.getPNGData()
 
 
 def extractImageFromFitzPage(page, doc):
@@ -307,12 +373,7 @@ def processFileToPng_w_ghostscript(fname, dest):
 
 def gamma_adjust(fn):
     """Apply a simple gamma shift to an image"""
-    subprocess.run(
-        ["mogrify", "-quiet", "-gamma", "0.5", fn],
-        stderr=subprocess.STDOUT,
-        shell=False,
-        check=True,
-    )
+    gamma_adjust_file(fn)
 
 
 def normalizeJPEGOrientation(f):
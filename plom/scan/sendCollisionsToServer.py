@@ -11,32 +11,26 @@ import getpass
 import hashlib
 import json
 import os
-import shutil
 from pathlib import Path
 from textwrap import dedent
 
 from plom.messenger import ScanMessenger
+from plom.scan.scanManifest import ScanManifest, pageName
 from plom.plom_exceptions import *
 from plom import PlomImageExts
 from .sendUnknownsToServer import extractOrder
 
 
-def doFiling(rmsg, bundle, shortName, fname):
+def doFiling(rmsg, manifest, shortName, fname):
     if rmsg[0]:  # msg should be [True, "success", success message]
         # print(rmsg[2])
-        for suf in ["", ".qr", ".collide"]:
-            shutil.move(
-                Path(str(fname) + suf),
-                bundle / Path("uploads/sentPages/collisions") / Path(shortName + suf),
-            )
+        dest = Path("uploads/sentPages/collisions") / shortName
+        manifest.move(fname, dest, "sent")
     else:  # msg = [False, reason, message]
         if rmsg[1] == "duplicate":
             print(rmsg[2])
-            for suf in ["", ".qr", ".collide"]:
-                shutil.move(
-                    Path(str(fname) + suf),
-                    bundle / Path("uploads/discardedPages") / Path(shortName + suf),
-                )
+            dest = Path("uploads/discardedPages") / shortName
+            manifest.move(fname, dest, "discarded")
         elif rmsg[1] == "original":
             print(rmsg[2])
             print("This should not happen - todo = log error in a sensible way")
@@ -46,9 +40,13 @@ def doFiling(rmsg, bundle, shortName, fname):
 
 
 def sendCollidingFiles(scanMessenger, bundle_name, fileList):
+    manifest = ScanManifest(Path("bundles") / bundle_name)
     for fname in fileList:
-        with open(Path(str(fname) + ".collide"), "r") as fh:
-            cdat = json.load(fh)
+        cdat = manifest.get(pageName(fname)).get("collide")
+        if cdat is None:
+            # bundles from earlier versions have a .collide file instead
+            with open(Path(str(fname) + ".collide"), "r") as fh:
+                cdat = json.load(fh)
         print(
             "Uploading {} which collides with {}, tpv = {} {} {}".format(
                 fname, cdat[0], cdat[1], cdat[2], cdat[3]
@@ -72,7 +70,8 @@ def sendCollidingFiles(scanMessenger, bundle_name, fileList):
             bundle_name,
             bundle_order,
         )
-        doFiling(rmsg, Path("bundles") / bundle_name, shortName, fname)
+        doFiling(rmsg, manifest, shortName, fname)
+    manifest.close()
 
 
 def bundle_has_nonuploaded_collisions(bundle_dir):
@@ -147,11 +146,13 @@ def upload_collisions(bundleDir, server=None, password=None):
         if not bundleDir.is_dir():
             raise ValueError("should've been a directory!")
 
-        files = []
-        for ext in PlomImageExts:
-            files.extend(
-                (bundleDir / "uploads/collidingPages").glob("*.{}".format(ext))
-            )
+        files = ScanManifest(bundleDir).files("colliding")
+        if not files:
+            # bundles from earlier versions might not have a manifest
+            for ext in PlomImageExts:
+                files.extend(
+                    (bundleDir / "uploads/collidingPages").glob("*.{}".format(ext))
+                )
         sendCollidingFiles(scanMessenger, bundleDir.name, files)
     finally:
         scanMessenger.closeUser()
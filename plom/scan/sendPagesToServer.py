@@ -8,10 +8,10 @@ __license__ = "AGPL-3.0-or-later"
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import getpass
 import hashlib
-import json
 import os
 import shutil
 import sys
@@ -20,6 +20,8 @@ from pathlib import Path
 import toml
 
 from plom.messenger import ScanMessenger
+from plom.misc_utils import md5sum_of_file
+from plom.scan.scanManifest import ScanManifest
 from plom.plom_exceptions import *
 from plom import PlomImageExts
 from plom.rules import isValidStudentNumber
@@ -60,28 +62,49 @@ def extractTPV(name):
     return (ts, ps, vs)
 
 
-def fileSuccessfulUpload(bundle, shortName, fname, qr=True):
+def bundleOrderFromName(shortName):
+    """The order of a page within its bundle, from the name of its image."""
+    # TODO: very fragile order extraction, check how Andrew does it...
+    return int(Path(shortName).stem.split("-")[-1])
+
+
+def pageManifest(scanManifest, files):
+    """The bundle order and md5sum of each page image of a bundle.
+
+    Args:
+        scanManifest (ScanManifest): of the bundle, which remembers the
+            md5sums so only new or changed files are read again.
+        files (list of pathlib.Path): page images in the bundle.
+
+    Returns:
+        dict: keys are the files and values are pairs
+            `(bundle_order, md5sum)`.
+    """
+    md5s = scanManifest.md5sums(files)
+    return {
+        fname: (bundleOrderFromName(os.path.split(fname)[1]), md5s[fname])
+        for fname in files
+    }
+
+
+def fileSuccessfulUpload(bundle, shortName, fname, manifest=None):
     """After successful upload move file within bundle.
 
     The image file is moved to 'uploads/sentpages' within the bundle.
-    If the qr-flag is set then also move the corresponding .qr file
-    Note - tpages will have a qr file, while hwpages and lpages
-    do not.
+    If a manifest is given (tpages have one, while hwpages and lpages
+    do not) then record the move there too.
     """
-    shutil.move(fname, bundle / Path("uploads/sentPages") / shortName)
-    # tpages have a .qr while hwpages and lpages do not.
-    if qr:
-        shutil.move(
-            Path(str(fname) + ".qr"),
-            bundle / Path("uploads/sentPages") / (str(shortName) + ".qr"),
-        )
+    if manifest:
+        manifest.move(fname, Path("uploads/sentPages") / shortName, "sent")
+    else:
+        shutil.move(fname, bundle / Path("uploads/sentPages") / shortName)
 
 
-def fileFailedUpload(reason, message, bundle, shortName, fname):
+def fileFailedUpload(reason, message, manifest, shortName, fname):
     """Move image after failed upload.
 
     Upload can fail for 'good' and 'bad' reasons. The image is moved
-    accordingly.
+    accordingly, and the move recorded in the manifest of the bundle.
     Good reasons - you are trying to upload to a page that already exists in the system.
      * 'duplicate' - the image is duplicate of image in system (by md5sum)
      so move into 'uploads/discardedPages'
@@ -93,25 +116,19 @@ def fileFailedUpload(reason, message, bundle, shortName, fname):
     """
     print("Failed upload = {}, {}".format(reason, message))
     if reason == "duplicate":
-        shutil.move(fname, bundle / Path("uploads/discardedPages") / shortName)
-        shutil.move(
-            Path(str(fname) + ".qr"),
-            bundle / Path("uploads/discardedPages") / (str(shortName) + ".qr"),
-        )
+        manifest.move(fname, Path("uploads/discardedPages") / shortName, "discarded")
     elif reason == "collision":
-        nname = bundle / Path("uploads/collidingPages") / shortName
-        shutil.move(fname, nname)
-        shutil.move(str(fname) + ".qr", str(nname) + ".qr")
-        # and write the name of the colliding file
-        with open(str(nname) + ".collide", "w+") as fh:
-            json.dump(message, fh)  # this is [collidingFile, test, page, version]
+        # and record the name of the colliding file
+        # message is [collidingFile, test, page, version]
+        dest = Path("uploads/collidingPages") / shortName
+        manifest.move(fname, dest, "colliding", collide=message)
     else:  # now bad errors
         print("Image upload failed for *bad* reason - this should not happen.")
         print("Reason = {}".format(reason))
         print("Message = {}".format(message))
 
 
-def sendTestFiles(msgr, bundle_name, files, skip_list):
+def sendTestFiles(msgr, bundle_name, files, skip_list, batch_size=16, connections=4):
     """Send the test-page images of one bundle to the server.
 
     Args:
@@ -120,6 +137,8 @@ def sendTestFiles(msgr, bundle_name, files, skip_list):
         files (list of pathlib.Path): the page images to upload.
         skip_list (list of int): the bundle-orders of pages already in the system
             and so can be skipped.
+        batch_size (int): how many pages to send in each request.
+        connections (int): how many requests to have on the go at once.
 
     Returns:
         defaultdict: TODO document this.
@@ -127,11 +146,11 @@ def sendTestFiles(msgr, bundle_name, files, skip_list):
     After each image is uploaded we move it to various places in the
     bundle's "uploads" subdirectory.
     """
-    TUP = defaultdict(list)
+    bundledir = Path("bundles") / bundle_name
+    todo = []
     for fname in files:
         shortName = os.path.split(fname)[1]
-        # TODO: very fragile order extraction, check how Andrew does it...
-        bundle_order = int(Path(shortName).stem.split("-")[-1])
+        bundle_order = bundleOrderFromName(shortName)
         if bundle_order in skip_list:
             print(
                 "Image {} with bundle_order {} already uploaded. Skipping.".format(
@@ -139,30 +158,49 @@ def sendTestFiles(msgr, bundle_name, files, skip_list):
                 )
             )
             continue
+        todo.append(fname)
 
+    scanManifest = ScanManifest(bundledir)
+    orders_md5s = pageManifest(scanManifest, todo)
+    pages = []
+    for fname in todo:
+        shortName = os.path.split(fname)[1]
         ts, ps, vs = extractTPV(shortName)
-        print("Upload {},{},{} = {} to server".format(ts, ps, vs, shortName))
-        md5 = hashlib.md5(open(fname, "rb").read()).hexdigest()
-        code = "t{}p{}v{}".format(ts.zfill(4), ps.zfill(2), vs)
-        rmsg = msgr.uploadTestPage(
-            code,
-            int(ts),
-            int(ps),
-            int(vs),
-            shortName,
-            fname,
-            md5,
-            bundle_name,
-            bundle_order,
+        bundle_order, md5 = orders_md5s[fname]
+        pages.append(
+            {
+                "test": int(ts),
+                "page": int(ps),
+                "version": int(vs),
+                "fileName": shortName,
+                "md5sum": md5,
+                "bundle_order": bundle_order,
+                "image": fname,
+            }
         )
-        # rmsg = [True] or [False, reason, message]
-        if rmsg[0]:  # was successful upload
-            fileSuccessfulUpload(Path("bundles") / bundle_name, shortName, fname)
-            TUP[ts].append(ps)
-        else:  # was failed upload - reason, message in rmsg[1], rmsg[2]
-            fileFailedUpload(
-                rmsg[1], rmsg[2], Path("bundles") / bundle_name, shortName, fname
-            )
+
+    # Send batches over a few connections at once: otherwise we spend
+    # most of the time waiting on round trips, not sending images.
+    batches = [pages[k : k + batch_size] for k in range(0, len(pages), batch_size)]
+    TUP = defaultdict(list)
+    with scanManifest as manifest, ThreadPoolExecutor(
+        max_workers=connections
+    ) as executor:
+        results = executor.map(
+            lambda batch: msgr.uploadTestPages(bundle_name, batch), batches
+        )
+        for batch, rmsgs in zip(batches, results):
+            for pg, rmsg in zip(batch, rmsgs):
+                fname = pg["image"]
+                shortName = pg["fileName"]
+                ts, ps, vs = str(pg["test"]), str(pg["page"]), str(pg["version"])
+                print("Upload {},{},{} = {} to server".format(ts, ps, vs, shortName))
+                # rmsg = [True] or [False, reason, message]
+                if rmsg[0]:  # was successful upload
+                    fileSuccessfulUpload(bundledir, shortName, fname, manifest)
+                    TUP[ts].append(ps)
+                else:  # was failed upload - reason, message in rmsg[1], rmsg[2]
+                    fileFailedUpload(rmsg[1], rmsg[2], manifest, shortName, fname)
     return TUP
 
 
@@ -234,7 +272,7 @@ def sendHWFiles(msgr, file_list, skip_list, student_id, question, bundle_name):
             sid, q, n, shortName, fname, md5, bundle_name, bundle_order
         )
         if rmsg[0]:  # was successful upload
-            fileSuccessfulUpload(Path("./"), shortName, fname, qr=False)
+            fileSuccessfulUpload(Path("./"), shortName, fname)
             # be careful of workingdir.
             SIDQ[sid].append(q)
         else:
@@ -283,7 +321,7 @@ def sendLFiles(msgr, fileList, skip_list, student_id, bundle_name):
             sid, n, shortName, fname, md5, bundle_name, bundle_order
         )
         if rmsg[0]:  # was successful upload
-            fileSuccessfulUpload(Path("./"), shortName, fname, qr=False)
+            fileSuccessfulUpload(Path("./"), shortName, fname)
             # be careful of workingdir.
             JSID[sid] = True
         else:
@@ -291,13 +329,55 @@ def sendLFiles(msgr, fileList, skip_list, student_id, bundle_name):
     return JSID
 
 
+def filterByManifest(msgr, bundledir, files):
+    """Ask the server which of these page images it still needs.
+
+    Those the server already has are filed as sent.  Any that the
+    server has with different contents are left alone (and reported).
+
+    Returns:
+        list: the files that the server still needs.
+    """
+    with ScanManifest(bundledir) as scanManifest:
+        manifest = pageManifest(scanManifest, files)
+        rval = msgr.checkBundleManifest(bundledir.name, list(manifest.values()))
+        if not rval[0]:
+            print("Could not check bundle manifest: {}".format(rval[1]))
+            return files
+        needed = set(rval[1])
+        mismatched = set(rval[2])
+        todo = []
+        for fname in files:
+            bundle_order, md5 = manifest[fname]
+            shortName = os.path.split(fname)[1]
+            if bundle_order in needed:
+                todo.append(fname)
+            elif bundle_order in mismatched:
+                print(
+                    "Image {} with bundle_order {} differs from the one uploaded "
+                    "previously. Skipping.".format(fname, bundle_order)
+                )
+            else:
+                print(
+                    "Image {} with bundle_order {} already uploaded.".format(
+                        fname, bundle_order
+                    )
+                )
+                fileSuccessfulUpload(bundledir, shortName, fname, scanManifest)
+    return todo
+
+
 def uploadTPages(bundleDir, skip_list, server=None, password=None):
     """Upload the test pages to the server.
 
     Skips pages-image with orders in the skip-list (ie the page number within the bundle.pdf)
 
-    Bundle must already be created.  We will upload the
-    files and then send a 'please trigger an update' message to the server.
+    Bundle must already be created.  We first send the server a manifest
+    of the pages we have (see :func:`pageManifest`) and it tells us
+    which it still needs: pages it already has are filed as sent without
+    uploading them again, so resuming an interrupted upload is cheap.
+    We will upload the files and then send a 'please trigger an update'
+    message to the server.
     """
     if server and ":" in server:
         s, p = server.split(":")
@@ -334,10 +414,12 @@ def uploadTPages(bundleDir, skip_list, server=None, password=None):
     if not bundleDir.is_dir():
         raise ValueError("should've been a directory!")
 
-    files = []
-    # Look for pages in decodedPages
-    for ext in PlomImageExts:
-        files.extend(sorted((bundleDir / "decodedPages").glob("t*.{}".format(ext))))
+    files = ScanManifest(bundleDir).files("decoded")
+    if not files:
+        # bundles from earlier versions might not have a manifest
+        for ext in PlomImageExts:
+            files.extend(sorted((bundleDir / "decodedPages").glob("t*.{}".format(ext))))
+    files = filterByManifest(msgr, bundleDir, files)
     TUP = sendTestFiles(msgr, bundleDir.name, files, skip_list)
     # we do not automatically replace any missing test-pages, since that is a serious issue for tests, and should be done only by manager.
 
@@ -572,7 +654,7 @@ def bundle_name_and_md5(filename):
     if filename.suffix.lower() != ".pdf":
         raise ValueError("currently only PDF files are supported")
     bundle_name = filename.stem.replace(" ", "_")
-    md5 = hashlib.md5(open(filename, "rb").read()).hexdigest()
+    md5 = md5sum_of_file(filename)
     return (bundle_name, md5)
 
 
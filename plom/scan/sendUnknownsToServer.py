@@ -9,33 +9,26 @@ __license__ = "AGPL-3.0-or-later"
 
 import hashlib
 import os
-import shutil
 from pathlib import Path
 
 import getpass
 
 from plom.messenger import ScanMessenger
+from plom.scan.scanManifest import ScanManifest
 from plom.plom_exceptions import *
 from plom import PlomImageExts
 
 
-def doFiling(rmsg, bundle, shortName, fname):
+def doFiling(rmsg, manifest, shortName, fname):
     if rmsg[0]:  # msg should be [True, "success", success message]
         # print(rmsg[2])
         print("{} uploaded as unknown page.".format(fname))
-        shutil.move(fname, bundle / Path("uploads/sentPages/unknowns") / shortName)
-        shutil.move(
-            Path(str(fname) + ".qr"),
-            bundle / Path("uploads/sentPages/unknowns") / (str(shortName) + ".qr"),
-        )
+        manifest.move(fname, Path("uploads/sentPages/unknowns") / shortName, "sent")
     else:  # msg = [False, reason, message]
         if rmsg[1] == "duplicate":
             print(rmsg[2])
-            shutil.move(fname, bundle / Path("uploads/discardedPages") / shortName)
-            shutil.move(
-                Path(str(fname) + ".qr"),
-                bundle / Path("uploads/discardedPages") / (str(shortName) + ".qr"),
-            )
+            dest = Path("uploads/discardedPages") / shortName
+            manifest.move(fname, dest, "discarded")
         else:
             print(rmsg[2])
             print("This should not happen - todo = log error in sensible way")
@@ -50,6 +43,7 @@ def extractOrder(fname):
 
 
 def sendUnknownFiles(msgr, bundle_name, files):
+    manifest = ScanManifest(Path("bundles") / bundle_name)
     for fname in files:
         md5 = hashlib.md5(open(fname, "rb").read()).hexdigest()
         shortName = os.path.split(fname)[1]
@@ -58,7 +52,8 @@ def sendUnknownFiles(msgr, bundle_name, files):
         rmsg = msgr.uploadUnknownPage(
             shortName, fname, order, md5, bundle_name, bundle_order
         )
-        doFiling(rmsg, Path("bundles") / bundle_name, shortName, fname)
+        doFiling(rmsg, manifest, shortName, fname)
+    manifest.close()
 
 
 def bundle_has_nonuploaded_unknowns(bundle_dir):
@@ -127,10 +122,11 @@ def upload_unknowns(bundle_dir, server=None, password=None):
     try:
         if not bundle_dir.is_dir():
             raise ValueError("should've been a directory!")
-        files = []
-        # Look for pages in unknowns
-        for ext in PlomImageExts:
-            files.extend((bundle_dir / "unknownPages").glob("*.{}".format(ext)))
+        files = ScanManifest(bundle_dir).files("unknown")
+        if not files:
+            # bundles from earlier versions might not have a manifest
+            for ext in PlomImageExts:
+                files.extend((bundle_dir / "unknownPages").glob("*.{}".format(ext)))
         sendUnknownFiles(scanMessenger, bundle_dir.name, files)
     finally:
         scanMessenger.closeUser()
@@ -0,0 +1,45 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Colin B. Macdonald
+
+from io import BytesIO
+
+import pyqrcode
+from PIL import Image
+
+from plom.tpv_utils import encodeTPV
+from .fasterQRExtract import QRextractImage, enoughCorners
+
+
+def fake_page(corners, width=1700, height=2200):
+    """A blank page with qr codes for test 12, page 3 in some corners."""
+    img = Image.new("L", (width, height), 255)
+    where = {1: "NE", 2: "NW", 3: "SW", 4: "SE"}
+    for o in corners:
+        buf = BytesIO()
+        pyqrcode.create(encodeTPV(12, 3, 1, o, "123456"), error="H").png(buf, scale=4)
+        qr = Image.open(BytesIO(buf.getvalue())).convert("L")
+        x = 60 if where[o][1] == "W" else width - 60 - qr.width
+        y = 60 if where[o][0] == "N" else height - 60 - qr.height
+        img.paste(qr, (x, y))
+    return img
+
+
+def test_corners_found():
+    qrs = QRextractImage(fake_page([1, 3, 4]))
+    assert qrs["NW"] == []
+    assert [len(qrs[c]) for c in ("NE", "SW", "SE")] == [1, 1, 1]
+    assert enoughCorners(qrs)
+
+
+def test_corners_stops_early():
+    # three agreeing corners are enough, so NW is never searched
+    qrs = QRextractImage(fake_page([1, 2, 3, 4]))
+    assert qrs["NW"] == []
+    assert enoughCorners(qrs)
+
+
+def test_corners_not_enough():
+    qrs = QRextractImage(fake_page([3, 4]))
+    assert not enoughCorners(qrs)
+    assert qrs["NE"] == [] and qrs["NW"] == []
+    assert len(qrs["SW"]) == 1
@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Colin B. Macdonald
+
+import hashlib
+from pathlib import Path
+
+from .scanManifest import ScanManifest, pageName
+
+
+def test_page_name():
+    assert pageName("bundles/foo/pageImages/foo-003.png") == "foo-003.png"
+    assert pageName(Path("decodedPages/t0012p03v2.foo-003.png")) == "foo-003.png"
+    assert pageName("t0012p03v2-003.png") == "t0012p03v2-003.png"
+
+
+def test_manifest_persists_updates(tmpdir):
+    with ScanManifest(tmpdir) as m:
+        m.update("foo-1.png", qrs={"NE": []}, status="unknown")
+        m.update_many(
+            [
+                {"name": "foo-1.png", "status": "sent"},
+                {"name": "foo-2.png", "tpv": [1, 2, 1]},
+            ]
+        )
+    m = ScanManifest(tmpdir)
+    assert len(m) == 2
+    assert m.get("foo-1.png") == {"qrs": {"NE": []}, "status": "sent"}
+    assert m.get("foo-2.png") == {"tpv": [1, 2, 1]}
+    assert m.get("foo-3.png") == {}
+
+
+def test_manifest_ignores_torn_line(tmpdir):
+    with ScanManifest(tmpdir) as m:
+        m.update("foo-1.png", status="decoded")
+    with open(Path(tmpdir) / ScanManifest.filename, "a") as f:
+        f.write('{"name": "foo-1.png", "sta')
+    with ScanManifest(tmpdir) as m:
+        assert m.get("foo-1.png") == {"status": "decoded"}
+        m.update("foo-1.png", status="sent")
+    assert ScanManifest(tmpdir).get("foo-1.png") == {"status": "sent"}
+
+
+def test_manifest_moves_files(tmpdir):
+    bundle = Path(tmpdir)
+    (bundle / "decodedPages").mkdir()
+    (bundle / "sent").mkdir()
+    f = bundle / "decodedPages" / "t0001p02v1.foo-1.png"
+    f.write_bytes(b"x")
+    with ScanManifest(bundle) as m:
+        m.update("foo-1.png", status="decoded", file="decodedPages/" + f.name)
+        assert m.files("decoded") == [f]
+        m.move(f, Path("sent") / f.name, "sent")
+        assert m.files("decoded") == []
+        assert m.files("sent") == [bundle / "sent" / f.name]
+    assert (bundle / "sent" / f.name).exists()
+    assert not f.exists()
+    assert ScanManifest(bundle).get("foo-1.png")["status"] == "sent"
+
+
+def test_manifest_remembers_md5sums(tmpdir):
+    bundle = Path(tmpdir)
+    f = bundle / "t0001p02v1.foo-1.png"
+    f.write_bytes(b"x")
+    with ScanManifest(bundle) as m:
+        assert m.md5sums([f]) == {f: hashlib.md5(b"x").hexdigest()}
+    m = ScanManifest(bundle)
+    assert m.get("foo-1.png")["md5sum"] == hashlib.md5(b"x").hexdigest()
+    assert m.get("foo-1.png")["size"] == 1
+    # a changed file is hashed again
+    f.write_bytes(b"yy")
+    assert m.md5sums([f]) == {f: hashlib.md5(b"yy").hexdigest()}
+    m.close()
+    assert ScanManifest(bundle).get("foo-1.png")["size"] == 2
@@ -66,6 +66,44 @@ class ScanMessenger(BaseMessenger):
 
         return response.json()
 
+    def checkBundleManifest(self, bundle_name, manifest):
+        """Ask server which pages of a bundle it still needs.
+
+        Args:
+            bundle_name (str): an existing bundle.
+            manifest (list): pairs `[bundle_order, md5sum]` for each
+                page we have.
+
+        Returns:
+            list: `[True, needed, mismatched]`: the bundle_orders the
+                server does not have and those it has with a different
+                md5sum.  Or `[False, reason]`.
+        """
+        self.SRmutex.acquire()
+        try:
+            response = self.session.get(
+                "https://{}/admin/bundle/manifest".format(self.server),
+                json={
+                    "user": self.user,
+                    "token": self.token,
+                    "bundle": bundle_name,
+                    "manifest": manifest,
+                },
+                verify=False,
+            )
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            if response.status_code == 401:
+                raise PlomAuthenticationException() from None
+            else:
+                raise PlomSeriousException(
+                    "Some other sort of error {}".format(e)
+                ) from None
+        finally:
+            self.SRmutex.release()
+
+        return response.json()
+
     def createNewBundle(self, bundle_name, md5sum):
         """Ask server to create bundle with given name/md5sum.
 
@@ -130,6 +168,14 @@ class ScanMessenger(BaseMessenger):
     def uploadTestPage(
         self, code, test, page, version, sname, fname, md5sum, bundle, bundle_order
     ):
+        """Upload the image of a test page.
+
+        `fname` can be the name of the image file or its contents as bytes.
+        """
+        if isinstance(fname, bytes):
+            image = fname
+        else:
+            image = open(fname, "rb")
         self.SRmutex.acquire()
         try:
             param = {
@@ -147,7 +193,7 @@ class ScanMessenger(BaseMessenger):
             dat = MultipartEncoder(
                 fields={
                     "param": json.dumps(param),
-                    "originalImage": (sname, open(fname, "rb"), mime_type),  # image
+                    "originalImage": (sname, image, mime_type),  # image
                 }
             )
             response = self.session.put(
@@ -170,6 +216,59 @@ class ScanMessenger(BaseMessenger):
 
         return response.json()
 
+    def uploadTestPages(self, bundle, pages):
+        """Upload the images of many test pages in one request.
+
+        Unlike most methods this does not wait for other requests to
+        finish, so several threads can upload batches at once.
+
+        Args:
+            bundle (str): the name of the bundle the pages are from.
+            pages (list): of dicts with keys `test`, `page`, `version`,
+                `fileName`, `md5sum`, `bundle_order` and `image`: the
+                name of the image file or its contents as bytes.
+
+        Returns:
+            list: for each page `[True]` or `[False, reason, message]`,
+                as for :meth:`uploadTestPage`.
+        """
+        param = {
+            "user": self.user,
+            "token": self.token,
+            "bundle": bundle,
+            "pages": [{k: v for k, v in pg.items() if k != "image"} for pg in pages],
+        }
+        files = []
+        try:
+            fields = [("param", json.dumps(param))]
+            for n, pg in enumerate(pages):
+                image = pg["image"]
+                if not isinstance(image, bytes):
+                    image = open(image, "rb")
+                    files.append(image)
+                mime_type = mimetypes.guess_type(pg["fileName"])[0]
+                fields.append(("page{}".format(n), (pg["fileName"], image, mime_type)))
+            dat = MultipartEncoder(fields=fields)
+            response = self.session.put(
+                "https://{}/admin/testPages".format(self.server),
+                data=dat,
+                headers={"Content-Type": dat.content_type},
+                verify=False,
+            )
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            if response.status_code == 401:
+                raise PlomAuthenticationException() from None
+            else:
+                raise PlomSeriousException(
+                    "Some other sort of error {}".format(e)
+                ) from None
+        finally:
+            for f in files:
+                f.close()
+
+        return response.json()
+
     def uploadHWPage(
         self, sid, question, order, sname, fname, md5sum, bundle, bundle_order
     ):
@@ -168,6 +168,14 @@ spB = sub.add_parser(
 )
 spB.add_argument("-s", "--server", metavar="SERVER[:PORT]", action="store")
 spB.add_argument("-w", "--password", type=str, help='for the "manager" user')
+spB.add_argument(
+    "--incremental",
+    action="store_true",
+    help="""
+        Only build papers which are missing or out-of-date, e.g., after
+        a crash or a change to the classlist.  The server's database may
+        already be populated.""",
+)
 
 spClear = sub.add_parser(
     "clear",
@@ -229,7 +237,7 @@ def main():
         msgr = get_messenger(args.server, args.password)
         upload_classlist(classlist=cl, msgr=msgr)
     elif args.command == "make":
-        buildDatabaseAndPapers(args.server, args.password)
+        buildDatabaseAndPapers(args.server, args.password, args.incremental)
     elif args.command == "clear":
         clear_manager_login(args.server, args.password)
     else:
@@ -106,7 +106,7 @@ def make_required_directories(bundle=None):
             os.makedirs(bundle / Path(dir), exist_ok=True)
 
 
-def processScans(server, password, pdf_fname, skip_gamma):
+def processScans(server, password, pdf_fname, skip_gamma, upload=False):
     """Process PDF file into images and read QRcodes
 
     Convert file into a bundle-name
@@ -115,6 +115,10 @@ def processScans(server, password, pdf_fname, skip_gamma):
     - continue if neither known or both known
     Make required directories for processing bundle,
     convert PDF to images and read QR codes from those.
+
+    If `upload` is set, upload the test pages as soon as each is
+    processed, keeping the images in memory in between, then archive
+    the PDF.  Unknowns are left for the upload command as usual.
     """
     from plom.scan import scansToImages
     from plom.scan import sendPagesToServer
@@ -160,6 +164,10 @@ def processScans(server, password, pdf_fname, skip_gamma):
     with open(bundledir / "source.toml", "w+") as f:
         toml.dump({"file": str(pdf_fname), "md5": md5}, f)
 
+    if upload:
+        _processAndUploadScans(server, password, pdf_fname, bundledir, md5, skip_gamma)
+        return
+
     print("Processing PDF {} to images".format(pdf_fname))
     scansToImages.processScans(pdf_fname, bundledir, skip_gamma)
     print("Read QR codes")
@@ -170,6 +178,39 @@ def processScans(server, password, pdf_fname, skip_gamma):
         print('You can upload these by passing "--unknowns" to the upload command')
 
 
+def _processAndUploadScans(server, password, pdf_fname, bundledir, md5, skip_gamma):
+    """Process and upload the pages of a bundle together, see processScans."""
+    from plom.scan import sendPagesToServer, scansToImages
+    from plom.scan.pipeline import processAndUploadScans
+
+    print('Creating bundle "{}" on server'.format(bundledir.name))
+    rval = sendPagesToServer.createNewBundle(bundledir.name, md5, server, password)
+    # should be [True, skip_list] or [False, reason]
+    if not rval[0]:
+        print("There was a problem with this bundle: {}.  Stopping.".format(rval[1]))
+        return
+    skip_list = rval[1]
+
+    print("Processing PDF {} and uploading pages as we go".format(pdf_fname))
+    [TPN, updates] = processAndUploadScans(
+        pdf_fname, bundledir, skip_list, server, password, skip_gamma
+    )
+    print(
+        "Tests were uploaded to the following studentIDs: {}".format(
+            ", ".join(TPN.keys())
+        )
+    )
+    print("Server reports {} papers updated.".format(updates))
+    scansToImages.archiveTBundle(pdf_fname)
+
+    if bundle_has_nonuploaded_unknowns(bundledir):
+        print_unknowns_warning(bundledir)
+        print('You can upload these by running the upload command with "--unknowns"')
+    if bundle_has_nonuploaded_collisions(bundledir):
+        print_collision_warning(bundledir)
+        print('If you want to upload these collisions, run upload with "--collisions".')
+
+
 def uploadImages(
     server, password, bundle_name, unknowns_flag=False, collisions_flag=False
 ):
@@ -337,6 +378,13 @@ spP.add_argument(
     action="store_true",
     help="Save a little time by skipping the white balancing.",
 )
+spP.add_argument(
+    "--upload",
+    action="store_true",
+    help="""Upload the test pages as soon as each is processed.
+        Faster for large bundles, as pages are kept in memory instead of
+        being written and read back at each step.""",
+)
 spU.add_argument("bundleName", help="The name of the PDF file, without extension.")
 spU.add_argument(
     "-u",
@@ -360,7 +408,9 @@ def main():
     args = parser.parse_args()
 
     if args.command == "process":
-        processScans(args.server, args.password, args.scanPDF, args.no_gamma_shift)
+        processScans(
+            args.server, args.password, args.scanPDF, args.no_gamma_shift, args.upload
+        )
     elif args.command == "upload":
         uploadImages(
             args.server, args.password, args.bundleName, args.unknowns, args.collisions
@@ -0,0 +1,93 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""Run blocking database and file work off the aiohttp event loop"""
+
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("server")
+
+
+def default_number_of_workers():
+    """A reasonable default size for the pool of reader threads."""
+    return min(16, (os.cpu_count() or 1) + 4)
+
+
+class Dispatcher:
+    """Hand blocking calls to worker threads so the event loop stays free.
+
+    Reads (GET and HEAD requests) are run on a pool of threads so that
+    one slow query, such as building the spreadsheet, does not stall
+    every other client.  Anything that might write to the database is
+    run on a single writer thread: SQLite allows only one writer at a
+    time so there is nothing to gain by having more, and serializing
+    them ourselves avoids "database is locked" errors.
+    """
+
+    def __init__(self, workers=None):
+        """Set up the thread pools.
+
+        Arguments:
+            workers (int/None): number of reader threads.  If `None` we
+                pick something based on the number of CPUs.
+        """
+        if workers is None:
+            workers = default_number_of_workers()
+        workers = int(workers)
+        if workers < 1:
+            raise ValueError("Need at least one worker thread")
+        self.workers = workers
+        self.readers = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="plom_reader"
+        )
+        self.writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="plom_writer"
+        )
+        log.info("Dispatching blocking work to {} reader threads".format(workers))
+
+    async def _run_in(self, executor, f, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(f, *args, **kwargs)
+        )
+
+    async def read(self, f, *args, **kwargs):
+        """Run `f(*args, **kwargs)` on one of the reader threads."""
+        return await self._run_in(self.readers, f, *args, **kwargs)
+
+    async def write(self, f, *args, **kwargs):
+        """Run `f(*args, **kwargs)` on the (single) writer thread."""
+        return await self._run_in(self.writer, f, *args, **kwargs)
+
+    def write_soon(self, f, *args, **kwargs):
+        """Queue `f(*args, **kwargs)` on the writer thread, without waiting.
+
+        It runs after any writes already queued, e.g., to tidy up after
+        them even if the request that queued them has been cancelled.
+        """
+        return self.writer.submit(f, *args, **kwargs)
+
+    async def run(self, request, f, *args, **kwargs):
+        """Run `f` on a reader or the writer depending on the request method.
+
+        Arguments:
+            request (aiohttp.web_request.Request): the request being
+                served; GET and HEAD are assumed not to write.
+            f (function): the blocking function to call.
+
+        Returns:
+            Whatever `f` returns.
+        """
+        if request.method in ("GET", "HEAD"):
+            return await self.read(f, *args, **kwargs)
+        return await self.write(f, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        """Stop the thread pools, by default waiting for pending work."""
+        self.readers.shutdown(wait=wait)
+        self.writer.shutdown(wait=wait)
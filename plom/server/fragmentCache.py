@@ -0,0 +1,297 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Andrew Rechnitzer
+# Copyright (C) 2020 Colin B. Macdonald
+
+"""A persistent cache of rendered LaTeX fragments"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from plom.textools import texFragmentToPNG, texFragmentsToPNGs, texFragmentHash
+
+log = logging.getLogger("server")
+
+# default bound on the total size of the cached images, in bytes
+default_max_size = 64 * 1024 * 1024
+# how long to believe a fragment does not compile, in seconds
+default_bad_ttl = 10 * 60
+
+
+class BatchRenderer:
+    """Render LaTeX fragments in batches on a bounded pool of threads.
+
+    Fragments asked for while the workers are busy queue up, and the
+    next free worker renders everything queued (up to `max_batch`) in
+    a single LaTeX run.  Asking for a fragment that is already queued
+    waits on the same run rather than adding another.
+
+    Instances can be called like :func:`plom.textools.texFragmentToPNG`.
+    """
+
+    def __init__(self, workers=2, max_batch=64, render_many=texFragmentsToPNGs):
+        """Set up the pool.
+
+        Arguments:
+            workers (int): how many LaTeX runs may happen at once.
+            max_batch (int): most fragments to put in one document.
+            render_many (function): called as `render_many(fragments,
+                filenames)`, returns a list of bools.
+        """
+        self.max_batch = max_batch
+        self._render_many = render_many
+        self._lock = threading.Lock()
+        # fragment -> (Future, [filenames]), in order of arrival
+        self._queue = OrderedDict()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="plom_latex"
+        )
+
+    def submit_many(self, fragments, filenames):
+        """Queue up fragments to be rendered into files.
+
+        Returns:
+            list: of `concurrent.futures.Future`, one per fragment,
+                each with a bool result.
+        """
+        futures = []
+        with self._lock:
+            for fragment, filename in zip(fragments, filenames):
+                if fragment in self._queue:
+                    future, fnames = self._queue[fragment]
+                    fnames.append(filename)
+                else:
+                    future = Future()
+                    self._queue[fragment] = (future, [filename])
+                futures.append(future)
+        # one unit of work per batch we might need: extras find the queue empty
+        for n in range((len(fragments) - 1) // self.max_batch + 1):
+            self._executor.submit(self._work)
+        return futures
+
+    def render_many(self, fragments, filenames):
+        """Render fragments into files, waiting until done.
+
+        Returns:
+            list: of bools, True for each fragment that was rendered.
+        """
+        return [f.result() for f in self.submit_many(fragments, filenames)]
+
+    def __call__(self, fragment, filename):
+        return self.render_many([fragment], [filename])[0]
+
+    def _work(self):
+        with self._lock:
+            batch = []
+            while self._queue and len(batch) < self.max_batch:
+                batch.append(self._queue.popitem(last=False))
+        if not batch:
+            return
+        log.debug("Rendering a batch of {} latex fragments".format(len(batch)))
+        fragments = [fragment for fragment, (future, fnames) in batch]
+        filenames = [fnames[0] for fragment, (future, fnames) in batch]
+        try:
+            results = self._render_many(fragments, filenames)
+        except Exception as err:
+            for fragment, (future, fnames) in batch:
+                future.set_exception(err)
+            return
+        for ok, (fragment, (future, fnames)) in zip(results, batch):
+            if ok:
+                for fname in fnames[1:]:
+                    shutil.copyfile(fnames[0], fname)
+            future.set_result(ok)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class FragmentCache:
+    """Rendered LaTeX fragments on disk, keyed by a hash of their source.
+
+    Markers mostly ask for the same rubric comments, so we keep each
+    rendered PNG in a directory named by the hash of the fragment
+    together with the preamble it is rendered with.  Fragments that do
+    not compile are remembered too (as an empty ".bad" file) so we do
+    not keep re-running LaTeX on them, but only for a while: the
+    failure might have been a timeout or a full disk rather than the
+    fragment itself.
+
+    The total size of the images is bounded: the least recently used
+    are removed first.  File modification times record the use, so the
+    order survives a server restart.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_size=default_max_size,
+        render=texFragmentToPNG,
+        bad_ttl=default_bad_ttl,
+    ):
+        """Set up the cache, picking up whatever is already in `directory`.
+
+        Arguments:
+            directory (str/pathlib.Path): where to keep the images,
+                created if necessary.
+            max_size (int): approximate bound on the total size in bytes.
+            render (function): called as `render(fragment, filename)`,
+                returns True if it succeeded in writing a PNG file.
+            bad_ttl (float): seconds to remember that a fragment did
+                not compile before trying it again.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self.max_size = max_size
+        self.bad_ttl = bad_ttl
+        self._render = render
+        self._lock = threading.Lock()
+        # key -> size, ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._size = 0
+        files = sorted(self.directory.glob("*.png"), key=lambda f: f.stat().st_mtime)
+        for f in files:
+            self._entries[f.stem] = f.stat().st_size
+            self._size += f.stat().st_size
+        log.info(
+            "Fragment cache has {} images ({} bytes)".format(
+                len(self._entries), self._size
+            )
+        )
+        self._evict()
+        for f in self.directory.glob("*.bad"):
+            self._is_bad(f)
+
+    @staticmethod
+    def key(fragment):
+        """The hash of the fragment and the preamble used to render it."""
+        return texFragmentHash(fragment)
+
+    def _path(self, key):
+        return self.directory / "{}.png".format(key)
+
+    def _bad_path(self, key):
+        return self.directory / "{}.bad".format(key)
+
+    def _is_bad(self, bad_path):
+        """Is there a marker that has not expired?  Removes expired ones."""
+        try:
+            age = time.time() - bad_path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        if age < self.bad_ttl:
+            return True
+        try:
+            bad_path.unlink()
+        except FileNotFoundError:
+            pass
+        return False
+
+    def lookup(self, fragment):
+        """Find a fragment in the cache without rendering it.
+
+        Returns:
+            pathlib.Path/None/False: the PNG file of the rendered
+                fragment, None if the fragment is not in the cache, or
+                False if we know it did not compile recently.
+        """
+        key = self.key(fragment)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                path = self._path(key)
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    # removed behind our back
+                    self._size -= self._entries.pop(key)
+                    return None
+                return path
+        if self._is_bad(self._bad_path(key)):
+            return False
+        return None
+
+    def get(self, fragment):
+        """Return a PNG file of the rendered fragment, rendering it if needed.
+
+        Returns:
+            pathlib.Path/None: the PNG file or None if the fragment
+                does not compile.
+        """
+        path = self.lookup(fragment)
+        if path is False:
+            return None
+        if path is not None:
+            return path
+        key = self.key(fragment)
+        path = self._path(key)
+        # render to a unique name and then move into place, in case
+        # another thread is rendering the same fragment.
+        tmp = self.directory / "{}.{}.tmp".format(key, threading.get_ident())
+        if not self._render(fragment, tmp):
+            self._bad_path(key).touch()
+            return None
+        self.add(key, tmp)
+        return path
+
+    def get_many(self, fragments):
+        """Return PNG files of many rendered fragments, rendering as needed.
+
+        Fragments not already in the cache are rendered together if the
+        renderer can do batches (see :class:`BatchRenderer`).
+
+        Returns:
+            list: of `pathlib.Path` or None, as for :meth:`get`.
+        """
+        paths = [self.lookup(fragment) for fragment in fragments]
+        todo = {}
+        for fragment, path in zip(fragments, paths):
+            if path is None:
+                key = self.key(fragment)
+                todo[key] = fragment
+        if todo:
+            keys = list(todo.keys())
+            tmps = [
+                self.directory / "{}.{}.tmp".format(key, threading.get_ident())
+                for key in keys
+            ]
+            render_many = getattr(self._render, "render_many", None)
+            if render_many:
+                results = render_many([todo[k] for k in keys], tmps)
+            else:
+                results = [self._render(todo[k], t) for k, t in zip(keys, tmps)]
+            for key, tmp, ok in zip(keys, tmps, results):
+                if ok:
+                    self.add(key, tmp)
+                else:
+                    self._bad_path(key).touch()
+            paths = [self.lookup(fragment) for fragment in fragments]
+        return [path if path else None for path in paths]
+
+    def add(self, key, filename):
+        """Move a rendered PNG file into the cache under the given key."""
+        path = self._path(key)
+        os.replace(filename, path)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries[key]
+            self._entries[key] = path.stat().st_size
+            self._entries.move_to_end(key)
+            self._size += self._entries[key]
+            self._evict()
+
+    def _evict(self):
+        # caller holds the lock (or we are still in __init__)
+        while self._size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+            log.debug("Fragment cache evicted {}".format(key))
@@ -145,6 +145,34 @@ class MarkHandler:
         else:
             return web.Response(status=406)  # a latex error
 
+    # @routes.get("/MK/latex/batch")
+    @authenticate_by_token_required_fields(["user", "fragments"])
+    def MlatexFragments(self, data, request):
+        """Return the latex images for a list of strings included in the request.
+
+        Respond with status 200.
+
+        Args:
+            data (dict): Includes the user/token and a list of latex
+                string fragments.
+            request (aiohttp.web_request.Request): Request of type GET /MK/latex/batch.
+
+        Returns:
+            aiohttp.web_response.Response: A response which includes
+                multipart objects: first a json list of bools, one per
+                fragment, False for those with a latex error, followed by
+                the images of the fragments that compiled, in order.
+        """
+        latex_response = self.server.MlatexFragments(data["user"], data["fragments"])
+        filenames = latex_response[1]
+
+        with MultipartWriter("latexFragments") as multipart_writer:
+            multipart_writer.append_json([bool(f) for f in filenames])
+            for filename in filenames:
+                if filename:
+                    multipart_writer.append(open(filename, "rb"))
+        return web.Response(body=multipart_writer, status=200)
+
     # @routes.patch("/MK/tasks/{task}")
     @authenticate_by_token_required_fields(["user"])
     def MclaimThisTask(self, data, request):
@@ -169,22 +197,65 @@ class MarkHandler:
         if (
             task_available
         ):  # return [True, tag, integrity_check, image_id_list, filename1, filename2,...]
-            task_tags = claimed_task[1]
-            task_integrity_check = claimed_task[2]
-            task_image_ids = claimed_task[3]
-            task_page_paths = claimed_task[4:]
-
             with MultipartWriter("imageAndTags") as multipart_writer:
-                multipart_writer.append(task_tags)  # append tags as raw text.
-                # append integrity_check as raw text.
-                multipart_writer.append(task_integrity_check)
-                multipart_writer.append_json(task_image_ids)  # append as json
-                for file_name in task_page_paths:
-                    multipart_writer.append(open(file_name, "rb"))
+                self._append_claimed_task(multipart_writer, claimed_task[1:])
             return web.Response(body=multipart_writer, status=200)
         else:
             return web.Response(status=204)  # that task already taken.
 
+    # @routes.patch("/MK/tasks/available")
+    @authenticate_by_token_required_fields(["user", "q", "v"])
+    def MclaimNextTask(self, data, request):
+        """Choose the next task, assign it to the user and return its images.
+
+        This does the work of `MgetNextTask` followed by `MclaimThisTask`
+        in one request, and the task cannot be taken by someone else in
+        between.
+
+        Respond with status 200/204.
+
+        Args:
+            data (dict): Dictionary including user data in addition to
+                question number and test version.
+            request (aiohttp.web_request.Request): Request of type PATCH /MK/tasks/available.
+
+        Returns:
+            aiohttp.web_response.Response: A response object which includes
+                multipart objects: the task code followed by the same
+                parts as `MclaimThisTask`.  Status 204 if there are no
+                tasks left.
+        """
+        claimed_task = self.server.MclaimNextTask(data["user"], data["q"], data["v"])
+
+        # returns [True, task, tag, integrity_check, image_id_list, filename1,...] or [False]
+        if not claimed_task[0]:
+            return web.Response(status=204)  # no papers left
+
+        with MultipartWriter("imageAndTags") as multipart_writer:
+            multipart_writer.append(claimed_task[1])  # append task code as raw text.
+            self._append_claimed_task(multipart_writer, claimed_task[2:])
+        return web.Response(body=multipart_writer, status=200)
+
+    @staticmethod
+    def _append_claimed_task(multipart_writer, claimed_task):
+        """Append the tags, integrity check, image md5s and images of a claimed task.
+
+        Args:
+            multipart_writer (aiohttp.MultipartWriter): where to put the parts.
+            claimed_task (list): [tag, integrity_check, image_id_list, filename1, filename2,...]
+        """
+        task_tags = claimed_task[0]
+        task_integrity_check = claimed_task[1]
+        task_image_ids = claimed_task[2]
+        task_page_paths = claimed_task[3:]
+
+        multipart_writer.append(task_tags)  # append tags as raw text.
+        # append integrity_check as raw text.
+        multipart_writer.append(task_integrity_check)
+        multipart_writer.append_json(task_image_ids)  # append as json
+        for file_name in task_page_paths:
+            multipart_writer.append(open(file_name, "rb"))
+
     # @routes.delete("/MK/tasks/{task}")
     @authenticate_by_token_required_fields(["user"])
     def MdidNotFinishTask(self, data, request):
@@ -278,7 +349,8 @@ class MarkHandler:
             return web.Response(status=406)  # should have sent 3 parts
         plomdat = await plom_file_object.read()
 
-        marked_task_status = self.server.MreturnMarkedTask(
+        marked_task_status = await self.server.dispatcher.write(
+            self.server.MreturnMarkedTask,
             task_metadata["user"],
             task_code,
             int(task_metadata["pg"]),
@@ -533,7 +605,9 @@ class MarkHandler:
         router.add_get("/MK/progress", self.MprogressCount)
         router.add_get("/MK/tasks/complete", self.MgetDoneTasks)
         router.add_get("/MK/tasks/available", self.MgetNextTask)
+        router.add_patch("/MK/tasks/available", self.MclaimNextTask)
         router.add_get("/MK/latex", self.MlatexFragment)
+        router.add_get("/MK/latex/batch", self.MlatexFragments)
         router.add_patch("/MK/tasks/{task}", self.MclaimThisTask)
         router.add_delete("/MK/tasks/{task}", self.MdidNotFinishTask)
         router.add_put("/MK/tasks/{task}", self.MreturnMarkedTask)
@@ -7,6 +7,7 @@ from aiohttp import web, MultipartWriter, MultipartReader
 
 from .routeutils import authenticate_by_token, authenticate_by_token_required_fields
 from .routeutils import validate_required_fields, log
+from .routeutils import receive_upload, discard_uploads, upload_md5sum_mismatch
 
 
 class UploadHandler:
@@ -60,6 +61,25 @@ class UploadHandler:
         rval = self.server.createNewBundle(data["bundle"], data["md5sum"])
         return web.json_response(rval, status=200)  # all fine
 
+    # @routes.get("/admin/bundle/manifest")
+    @authenticate_by_token_required_fields(["user", "bundle", "manifest"])
+    def checkBundleManifest(self, data, request):
+        """Which pages of a bundle still need to be uploaded.
+
+        The client sends a manifest: a list of `[bundle_order, md5sum]`
+        for every page it has.  This lets a client resume an interrupted
+        upload of a big bundle with one request.
+
+        Returns:
+            list: `[True, needed, mismatched]`: the bundle_orders we do
+                not have yet and those we have with different contents.
+                Or `[False, "no such bundle"]`.
+        """
+        if not data["user"] in ["scanner", "manager"]:
+            return web.Response(status=401)
+        rval = self.server.checkBundleManifest(data["bundle"], data["manifest"])
+        return web.json_response(rval, status=200)
+
     async def sidToTest(self, request):
         """Match given student_id to a test-number.
 
@@ -112,20 +132,80 @@ class UploadHandler:
         part1 = await reader.next()  # should be the image file
         if part1 is None:  # weird error
             return web.Response(status=406)  # should have sent 3 parts
-        image = await part1.read()
+        image = await receive_upload(part1, param["md5sum"])
+        if image is None:
+            return web.json_response(upload_md5sum_mismatch, status=200)
         # file it away.
-        rmsg = self.server.addTestPage(
-            param["test"],
-            param["page"],
-            param["version"],
-            param["fileName"],
-            image,
-            param["md5sum"],
-            param["bundle"],
-            param["bundle_order"],
-        )
+        try:
+            rmsg = await self.server.dispatcher.write(
+                self.server.addTestPage,
+                param["test"],
+                param["page"],
+                param["version"],
+                param["fileName"],
+                image,
+                param["md5sum"],
+                param["bundle"],
+                param["bundle_order"],
+            )
+        finally:
+            # once the writer is done with it: only there if not filed away
+            self.server.dispatcher.write_soon(discard_uploads, [image])
         return web.json_response(rmsg, status=200)  # all good
 
+    async def uploadTestPages(self, request):
+        """Upload many test pages from one bundle in a single request.
+
+        The first part of the multipart request has the parameters,
+        including a list `pages` of dicts with keys `test`, `page`,
+        `version`, `fileName`, `md5sum` and `bundle_order`.  The image
+        of each page follows in the same order, one part per page.
+
+        Returns:
+            list: with the same result for each page as
+                :meth:`uploadTestPage` would give.
+        """
+        reader = MultipartReader.from_response(request)
+
+        part0 = await reader.next()  # should be parameters
+        if part0 is None:  # weird error
+            return web.Response(status=406)
+        param = await part0.json()
+
+        if not validate_required_fields(param, ["user", "token", "bundle", "pages"]):
+            return web.Response(status=400)
+        page_fields = ["test", "page", "version", "fileName", "md5sum", "bundle_order"]
+        for pg in param["pages"]:
+            if not validate_required_fields(pg, page_fields):
+                return web.Response(status=400)
+        if not self.server.validate(param["user"], param["token"]):
+            return web.Response(status=401)
+        if not param["user"] in ("manager", "scanner"):
+            return web.Response(status=401)
+
+        images = []
+        try:
+            for pg in param["pages"]:
+                part = await reader.next()  # should be the next image file
+                if part is None:  # weird error
+                    return web.Response(status=406)  # should have sent more parts
+                images.append(await receive_upload(part, pg["md5sum"]))
+            good = [k for k, image in enumerate(images) if image is not None]
+            # file them away off the event loop: other batches arrive meanwhile
+            rmsgs = await self.server.dispatcher.write(
+                self.server.addTestPages,
+                param["bundle"],
+                [param["pages"][k] for k in good],
+                [images[k] for k in good],
+            )
+        finally:
+            # once the writer is done with them: only there if not filed away
+            self.server.dispatcher.write_soon(discard_uploads, images)
+        results = [upload_md5sum_mismatch] * len(images)
+        for k, rmsg in zip(good, rmsgs):
+            results[k] = rmsg
+        return web.json_response(results, status=200)
+
     async def uploadHWPage(self, request):
         reader = MultipartReader.from_response(request)
 
@@ -157,18 +237,25 @@ class UploadHandler:
         part1 = await reader.next()  # should be the image file
         if part1 is None:  # weird error
             return web.Response(status=406)  # should have sent 3 parts
-        image = await part1.read()
+        image = await receive_upload(part1, param["md5sum"])
+        if image is None:
+            return web.json_response(upload_md5sum_mismatch, status=200)
         # file it away.
-        rmsg = self.server.addHWPage(
-            param["sid"],
-            param["question"],
-            param["order"],
-            param["fileName"],
-            image,
-            param["md5sum"],
-            param["bundle"],
-            param["bundle_order"],
-        )
+        try:
+            rmsg = await self.server.dispatcher.write(
+                self.server.addHWPage,
+                param["sid"],
+                param["question"],
+                param["order"],
+                param["fileName"],
+                image,
+                param["md5sum"],
+                param["bundle"],
+                param["bundle_order"],
+            )
+        finally:
+            # once the writer is done with it: only there if not filed away
+            self.server.dispatcher.write_soon(discard_uploads, [image])
         return web.json_response(rmsg, status=200)  # all good
 
     async def uploadLPage(self, request):
@@ -201,17 +288,24 @@ class UploadHandler:
         part1 = await reader.next()  # should be the image file
         if part1 is None:  # weird error
             return web.Response(status=406)  # should have sent 3 parts
-        image = await part1.read()
+        image = await receive_upload(part1, param["md5sum"])
+        if image is None:
+            return web.json_response(upload_md5sum_mismatch, status=200)
         # file it away.
-        rmsg = self.server.addLPage(
-            param["sid"],
-            param["order"],
-            param["fileName"],
-            image,
-            param["md5sum"],
-            param["bundle"],
-            param["bundle_order"],
-        )
+        try:
+            rmsg = await self.server.dispatcher.write(
+                self.server.addLPage,
+                param["sid"],
+                param["order"],
+                param["fileName"],
+                image,
+                param["md5sum"],
+                param["bundle"],
+                param["bundle_order"],
+            )
+        finally:
+            # once the writer is done with it: only there if not filed away
+            self.server.dispatcher.write_soon(discard_uploads, [image])
         return web.json_response(rmsg, status=200)  # all good
 
     async def uploadUnknownPage(self, request):
@@ -235,16 +329,23 @@ class UploadHandler:
         part1 = await reader.next()  # should be the image file
         if part1 is None:  # weird error
             return web.Response(status=406)  # should have sent 3 parts
-        image = await part1.read()
+        image = await receive_upload(part1, param["md5sum"])
+        if image is None:
+            return web.json_response(upload_md5sum_mismatch, status=200)
         # file it away.
-        rmsg = self.server.addUnknownPage(
-            param["fileName"],
-            image,
-            param["order"],
-            param["md5sum"],
-            param["bundle"],
-            param["bundle_order"],
-        )
+        try:
+            rmsg = await self.server.dispatcher.write(
+                self.server.addUnknownPage,
+                param["fileName"],
+                image,
+                param["order"],
+                param["md5sum"],
+                param["bundle"],
+                param["bundle_order"],
+            )
+        finally:
+            # once the writer is done with it: only there if not filed away
+            self.server.dispatcher.write_soon(discard_uploads, [image])
         return web.json_response(rmsg, status=200)  # all good
 
     async def uploadCollidingPage(self, request):
@@ -282,18 +383,25 @@ class UploadHandler:
         part1 = await reader.next()  # should be the image file
         if part1 is None:  # weird error
             return web.Response(status=406)  # should have sent 2 parts
-        image = await part1.read()
+        image = await receive_upload(part1, param["md5sum"])
+        if image is None:
+            return web.json_response(upload_md5sum_mismatch, status=200)
         # file it away.
-        rmsg = self.server.addCollidingPage(
-            param["test"],
-            param["page"],
-            param["version"],
-            param["fileName"],
-            image,
-            param["md5sum"],
-            param["bundle"],
-            param["bundle_order"],
-        )
+        try:
+            rmsg = await self.server.dispatcher.write(
+                self.server.addCollidingPage,
+                param["test"],
+                param["page"],
+                param["version"],
+                param["fileName"],
+                image,
+                param["md5sum"],
+                param["bundle"],
+                param["bundle_order"],
+            )
+        finally:
+            # once the writer is done with it: only there if not filed away
+            self.server.dispatcher.write_soon(discard_uploads, [image])
         return web.json_response(rmsg, status=200)  # all good
 
     async def replaceMissingTestPage(self, request):
@@ -307,8 +415,11 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.replaceMissingTestPage(
-            data["test"], data["page"], data["version"]
+        rval = await self.server.dispatcher.write(
+            self.server.replaceMissingTestPage,
+            data["test"],
+            data["page"],
+            data["version"],
         )
         if rval[0]:
             return web.json_response(rval, status=200)  # all fine
@@ -330,8 +441,11 @@ class UploadHandler:
         if data["user"] != "manager" and data["user"] != "scanner":
             return web.Response(status=401)
 
-        rval = self.server.replaceMissingHWQuestion(
-            data["sid"], data["test"], data["question"]
+        rval = await self.server.dispatcher.write(
+            self.server.replaceMissingHWQuestion,
+            data["sid"],
+            data["test"],
+            data["question"],
         )
         if rval[0]:
             return web.json_response(rval, status=200)  # all fine
@@ -352,7 +466,9 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.removeAllScannedPages(data["test"],)
+        rval = await self.server.dispatcher.write(
+            self.server.removeAllScannedPages, data["test"]
+        )
         if rval[0]:
             return web.json_response(rval, status=200)  # all fine
         else:
@@ -577,7 +693,9 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.removeUnknownImage(data["fileName"])
+        rval = await self.server.dispatcher.write(
+            self.server.removeUnknownImage, data["fileName"]
+        )
         if rval[0]:
             return web.Response(status=200)  # all fine
         else:
@@ -592,7 +710,9 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.removeCollidingImage(data["fileName"])
+        rval = await self.server.dispatcher.write(
+            self.server.removeCollidingImage, data["fileName"]
+        )
         if rval[0]:
             return web.Response(status=200)  # all fine
         else:
@@ -609,8 +729,12 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.unknownToTestPage(
-            data["fileName"], data["test"], data["page"], data["rotation"]
+        rval = await self.server.dispatcher.write(
+            self.server.unknownToTestPage,
+            data["fileName"],
+            data["test"],
+            data["page"],
+            data["rotation"],
         )
         if rval[0]:
             return web.json_response(rval[1], status=200)  # all fine
@@ -631,8 +755,12 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.unknownToHWPage(
-            data["fileName"], data["test"], data["question"], data["rotation"]
+        rval = await self.server.dispatcher.write(
+            self.server.unknownToHWPage,
+            data["fileName"],
+            data["test"],
+            data["question"],
+            data["rotation"],
         )
         if rval[0]:
             return web.Response(status=200)  # all fine
@@ -653,8 +781,12 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.unknownToExtraPage(
-            data["fileName"], data["test"], data["question"], data["rotation"]
+        rval = await self.server.dispatcher.write(
+            self.server.unknownToExtraPage,
+            data["fileName"],
+            data["test"],
+            data["question"],
+            data["rotation"],
         )  # returns [True], or [False, reason]
         if rval[0]:
             return web.Response(status=200)  # all fine
@@ -675,8 +807,12 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.collidingToTestPage(
-            data["fileName"], data["test"], data["page"], data["version"]
+        rval = await self.server.dispatcher.write(
+            self.server.collidingToTestPage,
+            data["fileName"],
+            data["test"],
+            data["page"],
+            data["version"],
         )
         if rval[0]:
             return web.Response(status=200)  # all fine
@@ -695,7 +831,9 @@ class UploadHandler:
         if not data["user"] == "manager":
             return web.Response(status=401)
 
-        rval = self.server.discardToUnknown(data["fileName"])
+        rval = await self.server.dispatcher.write(
+            self.server.discardToUnknown, data["fileName"]
+        )
         if rval[0]:
             return web.Response(status=200)  # all fine
         else:
@@ -710,7 +848,7 @@ class UploadHandler:
         if data["user"] != "manager" and data["user"] != "scanner":
             return web.Response(status=401)
 
-        rval = self.server.processHWUploads()
+        rval = await self.server.dispatcher.write(self.server.processHWUploads)
         return web.json_response(
             rval[1], status=200
         )  # all fine - report number of tests updated
@@ -724,7 +862,7 @@ class UploadHandler:
         if data["user"] != "manager" and data["user"] != "scanner":
             return web.Response(status=401)
 
-        rval = self.server.processLUploads()
+        rval = await self.server.dispatcher.write(self.server.processLUploads)
         return web.json_response(
             rval[1], status=200
         )  # all fine - report number of tests updated
@@ -763,7 +901,7 @@ class UploadHandler:
         if data["user"] != "manager" and data["user"] != "scanner":
             return web.Response(status=403)
 
-        rval = self.server.processTUploads()
+        rval = await self.server.dispatcher.write(self.server.processTUploads)
         return web.json_response(rval[1], status=200)
 
     @authenticate_by_token_required_fields(["user"])
@@ -819,12 +957,9 @@ class UploadHandler:
                 with 500 Internal Server Error if a test does not exist.
         """
         spec = self.server.testSpec
-        vers = {}
-        for paper_idx in range(1, spec["numberToProduce"] + 1):
-            ver = self.server.DB.getPageVersions(paper_idx)
-            if not ver:
-                return web.Response(status=500)
-            vers[paper_idx] = ver
+        vers = self.server.DB.getAllPageVersions()
+        if any(t not in vers for t in range(1, spec["numberToProduce"] + 1)):
+            return web.Response(status=500)
         # JSON converts int keys to strings, we'll fix this at the far end
         # return web.json_response(str(pickle.dumps(vers)), status=200)
         return web.json_response(vers, status=200)
@@ -834,8 +969,8 @@ class UploadHandler:
     def notify_pdf_of_paper_produced(self, data, request):
         """Inform server that a PDF for this paper has been produced.
 
-        This is to be called one-at-a-time for each paper.  If this is a
-        bottleneck we could consider adding a "bulk" version.
+        This is to be called one-at-a-time for each paper.  See also
+        :func:`notify_pdfs_of_papers_produced` which does many at once.
 
         Note that the file itself is not uploaded to the server: we're
         just merely creating a record that such a file exists somewhere.
@@ -873,11 +1008,50 @@ class UploadHandler:
             return web.Response(status=409)
         return web.Response(status=200)
 
+    # @route.put("/admin/pdf_produced")
+    @authenticate_by_token_required_fields(["user", "papers", "rebuilt"])
+    def notify_pdfs_of_papers_produced(self, data, request):
+        """Inform server that PDFs for many papers have been produced.
+
+        If a paper was already produced from a PDF file with the same
+        md5sum then that's fine.  Either all papers are recorded or
+        none are.
+
+        Inputs:
+            user (str): who's calling?  A field of the request.
+            papers (list): pairs `[t, md5sum]` of the paper number and
+                the md5sum of the file that was produced (or None).
+            rebuilt (list): the numbers of papers that were made again,
+                so replace the md5sums we have for them.
+
+        Returns:
+            aiohttp.web.Response: with status code as below.
+
+        Status codes:
+            200 OK: the info was recorded.
+            400 Bad Request: only "manager" is allowed to do this.
+            401 Unauthorized: invalid credientials.
+            404 Not Found: some paper number is outside valid range.
+            409 Conflict: some paper has already been produced from a
+                different file, and was not rebuilt or is already used.
+        """
+        if not data["user"] == "manager":
+            return web.Response(status=400)
+        try:
+            self.server.DB.produceTests(data["papers"], data["rebuilt"])
+        except IndexError as e:
+            raise web.HTTPNotFound(reason=str(e)) from None
+        except ValueError as e:
+            raise web.HTTPConflict(reason=str(e)) from None
+        return web.Response(status=200)
+
     def setUpRoutes(self, router):
         router.add_get("/admin/bundle", self.doesBundleExist)
         router.add_put("/admin/bundle", self.createNewBundle)
+        router.add_get("/admin/bundle/manifest", self.checkBundleManifest)
         router.add_get("/admin/sidToTest", self.sidToTest)
         router.add_put("/admin/testPages/{tpv}", self.uploadTestPage)
+        router.add_put("/admin/testPages", self.uploadTestPages)
         router.add_put("/admin/hwPages", self.uploadHWPage)
         router.add_put("/admin/lPages", self.uploadLPage)
         router.add_put("/admin/unknownPages", self.uploadUnknownPage)
@@ -914,3 +1088,4 @@ class UploadHandler:
         router.add_put(
             "/admin/pdf_produced/{papernum}", self.notify_pdf_of_paper_produced
         )
+        router.add_put("/admin/pdf_produced", self.notify_pdfs_of_papers_produced)
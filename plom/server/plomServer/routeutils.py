@@ -4,8 +4,13 @@
 
 """Misc routing utilities"""
 
+import hashlib
 import logging
 import functools
+import os
+import tempfile
+from pathlib import Path
+
 from aiohttp import web
 
 log = logging.getLogger("routes")
@@ -45,6 +50,10 @@ def authenticate_by_token(f):
     have too.  This is essentially a way to avoid copy-pasting lots of
     boilerplate code.
 
+    The authentication and the function itself are run by the server's
+    dispatcher on a worker thread, so they may block (database queries,
+    reading files) without stalling the event loop.
+
     The function under decoration should be a class method with no
     further arguments.
 
@@ -65,10 +74,16 @@ def authenticate_by_token(f):
         data = await request.json()
         if not validate_required_fields(data, ["user", "token"]):
             return web.Response(status=400)
-        if not zelf.server.validate(data["user"], data["token"]):
-            return web.Response(status=401)
-        log.debug('{} authenticated "{}" via token'.format(f.__name__, data["user"]))
-        return f(zelf)
+
+        def _authenticate_and_run():
+            if not zelf.server.validate(data["user"], data["token"]):
+                return web.Response(status=401)
+            log.debug(
+                '{} authenticated "{}" via token'.format(f.__name__, data["user"])
+            )
+            return f(zelf)
+
+        return await zelf.server.dispatcher.run(request, _authenticate_and_run)
 
     return wrapped
 
@@ -90,6 +105,9 @@ def authenticate_by_token_required_fields(fields):
     Here `data` is the result of `request.json()` and `request` is the
     original request (don't try to take data from it again!)
 
+    As with `@authenticate_by_token`, `foo` runs on a worker thread:
+    reads for GET requests, the single writer thread otherwise.
+
     Arguments:
         f (function): the function to be decorated (TODO: not listed
             above for some reason).
@@ -110,18 +128,93 @@ def authenticate_by_token_required_fields(fields):
             log.debug("{} validating fields {}".format(f.__name__, fields))
             if not validate_required_fields(data, fields):
                 return web.Response(status=400)
-            if not zelf.server.validate(data["user"], data["token"]):
-                return web.Response(status=401)
-            log.debug(
-                '{} authenticated "{}" via token'.format(f.__name__, data["user"])
-            )
-            return f(zelf, data, request)
+
+            def _authenticate_and_run():
+                if not zelf.server.validate(data["user"], data["token"]):
+                    return web.Response(status=401)
+                log.debug(
+                    '{} authenticated "{}" via token'.format(f.__name__, data["user"])
+                )
+                return f(zelf, data, request)
+
+            return await zelf.server.dispatcher.run(request, _authenticate_and_run)
 
         return wrapped
 
     return _decorate
 
 
+async def receive_upload(part, md5sum, directory="pages"):
+    """Stream an uploaded file into a temporary file, checking its md5sum.
+
+    The data is hashed as it arrives, so it is never all held in memory
+    and we need not read it back to check it.  The temporary file is in
+    `directory`, on the same filesystem as where the server keeps the
+    images, so it can be moved into place atomically with `os.replace`.
+
+    Arguments:
+        part (aiohttp.BodyPartReader): a part of a multipart request.
+        md5sum (str): what the client says the md5sum is.
+        directory (str): where to put the temporary file.
+
+    Returns:
+        str/None: name of the temporary file, or None if the contents
+            did not match `md5sum` (in which case nothing is kept).
+    """
+    md5 = hashlib.md5()
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".upload.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await part.read_chunk()
+                if not chunk:
+                    break
+                md5.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        # e.g., the client went away part way through
+        os.unlink(tmp)
+        raise
+    if md5.hexdigest() != md5sum:
+        log.warning("Upload did not match its md5sum: discarding")
+        os.unlink(tmp)
+        return None
+    return tmp
+
+
+def discard_uploads(files):
+    """Remove any of the files from :func:`receive_upload` still about.
+
+    Once filed away the files have been moved into place, so this only
+    removes those left behind by an error.
+
+    Arguments:
+        files (list): of file names, or None for ones not kept.
+    """
+    for f in files:
+        if f is None:
+            continue
+        try:
+            os.unlink(f)
+            log.warning("Removed unused upload {}".format(f))
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_uploads(directory="pages"):
+    """Remove temporary files of uploads that did not finish.
+
+    Call this at startup, before any uploads can be in progress.
+    """
+    for f in Path(directory).glob(".upload.*"):
+        log.info("Removing stale upload {}".format(f))
+        f.unlink()
+
+
+# returned for an upload whose contents do not match its md5sum
+upload_md5sum_mismatch = [False, "md5sum", "Image does not match its md5sum"]
+
+
 def no_authentication_only_log_request(f):
     """Decorator for logging requests only.
 
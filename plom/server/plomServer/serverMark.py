@@ -13,8 +13,6 @@ import tempfile
 import uuid
 import logging
 
-from plom.textools import texFragmentToPNG
-
 
 log = logging.getLogger("server")
 
@@ -125,18 +123,32 @@ def MlatexFragment(self, username, latex_fragment):
 
     Returns:
         list: A list with either False or True with the latex image's
-            file name.
+            file name.  Rendered fragments are cached so repeated
+            requests do not run LaTeX again.
     """
 
-    # TODO - only one frag file per user - is this okay?
-    filename = os.path.join(self.tempDirectory.name, "{}_frag.png".format(username))
-
-    if texFragmentToPNG(latex_fragment, filename):
+    filename = self.fragmentCache.get(latex_fragment)
+    if filename:
         return [True, filename]
     else:
         return [False]
 
 
+def MlatexFragments(self, username, latex_fragments):
+    """Respond with paths to the images of many latex fragments.
+
+    Args:
+        username (str): Username string.
+        latex_fragments (list): latex strings for the images requested.
+
+    Returns:
+        list: A list with True and a list, in the same order as the
+            fragments, of the image file names or None for those that
+            do not compile.
+    """
+    return [True, self.fragmentCache.get_many(latex_fragments)]
+
+
 def MclaimThisTask(self, username, task_code):
     """Assign the specified paper to this user and return the task information.
 
@@ -152,6 +164,26 @@ def MclaimThisTask(self, username, task_code):
     return self.DB.MgiveTaskToClient(username, task_code)
 
 
+def MclaimNextTask(self, username, question_number, version_number):
+    """Take the next unmarked paper off the queue and assign it to this user.
+
+    Args:
+        username (str): User who requests the paper.
+        question_number (int): Question number.
+        version_number (int): Version number.
+
+    Returns:
+        list: A list which either only has a False value included (no
+            papers left) or [True, `task_code`, `question_tag`,
+            `integrity_check`, `list_of_image_md5s` `image_file1`,
+            `image_file2`,...]
+    """
+
+    version_number = int(version_number)
+    question_number = int(question_number)
+    return self.DB.MgiveNextTaskToClient(username, question_number, version_number)
+
+
 def MdidNotFinish(self, username, task_code):
     """Inform database that a user did not finish a task.
 
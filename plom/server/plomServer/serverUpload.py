@@ -26,6 +26,10 @@ def createNewBundle(self, bundle_file, md5):
     return self.DB.createNewBundle(bundle_file, md5)
 
 
+def checkBundleManifest(self, bundle_name, manifest):
+    return self.DB.checkBundleManifest(bundle_name, manifest)
+
+
 def sidToTest(self, student_id):
     return self.DB.sidToTest(student_id)
 
@@ -41,17 +45,43 @@ def addTestPage(self, t, p, v, fname, image, md5o, bundle, bundle_order):
         if not os.path.isfile(newName):
             break
     val = self.DB.uploadTestPage(t, p, v, fname, newName, md5o, bundle, bundle_order)
+    # image is the received file: move it into place or remove it
     if val[0]:
-        with open(newName, "wb") as fh:
-            fh.write(image)
-        md5n = hashlib.md5(open(newName, "rb").read()).hexdigest()
-        assert md5n == md5o
+        os.replace(image, newName)
         log.debug("Storing {} as {} = {}".format(prefix, newName, val))
     else:
+        os.unlink(image)
         log.debug("Did not store page.  From database = {}".format(val[1]))
     return val
 
 
+def addTestPages(self, bundle, pages, images):
+    """Add many test pages from the same bundle, see :func:`addTestPage`.
+
+    Args:
+        bundle (str): name of the bundle the pages come from.
+        pages (list): of dicts with keys `test`, `page`, `version`,
+            `fileName`, `md5sum` and `bundle_order`.
+        images (list): the received file of each image.
+
+    Returns:
+        list: the result of :func:`addTestPage` for each page, in order.
+    """
+    return [
+        self.addTestPage(
+            pg["test"],
+            pg["page"],
+            pg["version"],
+            pg["fileName"],
+            image,
+            pg["md5sum"],
+            bundle,
+            pg["bundle_order"],
+        )
+        for pg, image in zip(pages, images)
+    ]
+
+
 def addHWPage(self, sid, q, o, fname, image, md5o, bundle, bundle_order):
     # take extension from the client filename
     base, ext = os.path.splitext(fname)
@@ -64,12 +94,10 @@ def addHWPage(self, sid, q, o, fname, image, md5o, bundle, bundle_order):
             break
     val = self.DB.uploadHWPage(sid, q, o, fname, newName, md5o, bundle, bundle_order)
     if val[0]:
-        with open(newName, "wb") as fh:
-            fh.write(image)
-        md5n = hashlib.md5(open(newName, "rb").read()).hexdigest()
-        assert md5n == md5o
+        os.replace(image, newName)
         log.debug("Storing {} as {} = {}".format(prefix, newName, val))
     else:
+        os.unlink(image)
         log.debug("Did not store page.  From database = {}".format(val[1]))
     return val
 
@@ -86,12 +114,10 @@ def addLPage(self, sid, o, fname, image, md5o, bundle, bundle_order):
             break
     val = self.DB.uploadLPage(sid, o, fname, newName, md5o, bundle, bundle_order)
     if val[0]:
-        with open(newName, "wb") as fh:
-            fh.write(image)
-        md5n = hashlib.md5(open(newName, "rb").read()).hexdigest()
-        assert md5n == md5o
+        os.replace(image, newName)
         log.debug("Storing {} as {} = {}".format(prefix, newName, val))
     else:
+        os.unlink(image)
         log.debug("Did not store page.  From database = {}".format(val[1]))
     return val
 
@@ -108,12 +134,10 @@ def addUnknownPage(self, fname, image, order, md5o, bundle, bundle_order):
             break
     val = self.DB.uploadUnknownPage(fname, newName, order, md5o, bundle, bundle_order)
     if val[0]:
-        with open(newName, "wb") as fh:
-            fh.write(image)
-        md5n = hashlib.md5(open(newName, "rb").read()).hexdigest()
-        assert md5n == md5o
+        os.replace(image, newName)
         log.debug("Storing {} = {}".format(newName, val))
     else:
+        os.unlink(image)
         log.debug("Did not store page.  From database = {}".format(val[1]))
     return val
 
@@ -132,12 +156,10 @@ def addCollidingPage(self, t, p, v, fname, image, md5o, bundle, bundle_order):
         t, p, v, fname, newName, md5o, bundle, bundle_order
     )
     if val[0]:
-        with open(newName, "wb") as fh:
-            fh.write(image)
-        md5n = hashlib.md5(open(newName, "rb").read()).hexdigest()
-        assert md5n == md5o
+        os.replace(image, newName)
         log.debug("Storing {} as {} = {}".format(prefix, newName, val))
     else:
+        os.unlink(image)
         log.debug("Did not store page.  From database = {}".format(val[1]))
     return val
 
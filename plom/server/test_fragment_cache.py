@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Colin B. Macdonald
+
+import os
+
+import threading
+import time
+
+from .fragmentCache import FragmentCache, BatchRenderer
+
+
+class FakeRender:
+    """Pretend to render: fragments containing "broken" fail."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, fragment, filename):
+        self.calls += 1
+        if "broken" in fragment:
+            return False
+        with open(filename, "wb") as f:
+            f.write(b"x" * 100)
+        return True
+
+
+def test_cache_renders_once(tmpdir):
+    render = FakeRender()
+    cache = FragmentCache(tmpdir, render=render)
+    f1 = cache.get("$x$")
+    f2 = cache.get("$x$")
+    assert f1 == f2
+    assert os.path.isfile(f1)
+    assert render.calls == 1
+    cache.get("$y$")
+    assert render.calls == 2
+
+
+def test_cache_remembers_failures(tmpdir):
+    render = FakeRender()
+    cache = FragmentCache(tmpdir, render=render)
+    assert cache.get(r"\broken") is None
+    assert cache.get(r"\broken") is None
+    assert render.calls == 1
+
+
+def test_cache_forgets_failures_after_a_while(tmpdir):
+    render = FakeRender()
+    cache = FragmentCache(tmpdir, render=render, bad_ttl=60)
+    assert cache.get(r"\broken") is None
+    (bad,) = tmpdir.listdir("*.bad")
+    # as if the failure was two minutes ago
+    old = time.time() - 120
+    os.utime(bad, (old, old))
+    assert cache.get(r"\broken") is None
+    assert render.calls == 2
+    os.utime(bad, (old, old))
+    FragmentCache(tmpdir, render=render, bad_ttl=60)
+    assert not bad.exists()
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    render = FakeRender()
+    cache = FragmentCache(tmpdir, max_size=250, render=render)
+    a = cache.get("a")
+    b = cache.get("b")
+    cache.get("a")  # now b is least recently used
+    cache.get("c")
+    assert os.path.isfile(a)
+    assert not os.path.isfile(b)
+    assert cache.lookup("b") is None
+
+
+def test_cache_persists(tmpdir):
+    render = FakeRender()
+    FragmentCache(tmpdir, render=render).get("a")
+    cache = FragmentCache(tmpdir, render=render)
+    assert cache.lookup("a")
+    cache.get("a")
+    assert render.calls == 1
+
+
+class FakeRenderMany:
+    """Pretend to render in batches, holding the first until released."""
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+
+    def __call__(self, fragments, filenames):
+        self.release.wait(5)
+        self.batches.append(list(fragments))
+        for filename in filenames:
+            with open(filename, "wb") as f:
+                f.write(b"x" * 100)
+        return ["broken" not in frag for frag in fragments]
+
+
+def test_batch_renderer_coalesces(tmpdir):
+    render_many = FakeRenderMany()
+    renderer = BatchRenderer(workers=1, render_many=render_many)
+    first = renderer.submit_many(["a"], [tmpdir / "a.png"])
+    # wait for the worker to take "a" off the queue
+    while renderer._queue:
+        time.sleep(0.01)
+    frags = ["b", "c", "b", r"\broken"]
+    futures = renderer.submit_many(
+        frags, [tmpdir / "{}.png".format(n) for n in range(4)]
+    )
+    render_many.release.set()
+    assert first[0].result() is True
+    assert [f.result() for f in futures] == [True, True, True, False]
+    assert render_many.batches == [["a"], ["b", "c", r"\broken"]]
+    assert os.path.isfile(tmpdir / "2.png")
+    renderer.shutdown()
+
+
+def test_batch_renderer_in_cache(tmpdir):
+    renderer = BatchRenderer(render_many=FakeRenderMany())
+    renderer._render_many.release.set()
+    cache = FragmentCache(tmpdir, render=renderer)
+    assert os.path.isfile(cache.get("$x$"))
+    assert cache.get(r"\broken") is None
+    renderer.shutdown()
+
+
+def test_cache_get_many(tmpdir):
+    render_many = FakeRenderMany()
+    render_many.release.set()
+    renderer = BatchRenderer(render_many=render_many)
+    cache = FragmentCache(tmpdir, render=renderer)
+    cache.get("a")
+    paths = cache.get_many(["a", "b", r"\broken", "b"])
+    assert paths[0] == cache.lookup("a")
+    assert paths[1] == paths[3]
+    assert os.path.isfile(paths[1])
+    assert paths[2] is None
+    assert render_many.batches == [["a"], ["b", r"\broken"]]
+    renderer.shutdown()
@@ -32,6 +32,8 @@ from plom import specdir
 from plom.db import PlomDB
 
 from .authenticate import Authority
+from .dispatcher import Dispatcher
+from .fragmentCache import FragmentCache, BatchRenderer
 
 serverInfo = {"server": "127.0.0.1", "port": Default_Port}
 # ----------------------
@@ -47,6 +49,7 @@ from .plomServer.routesUpload import UploadHandler
 from .plomServer.routesID import IDHandler
 from .plomServer.routesMark import MarkHandler
 from .plomServer.routesReport import ReportHandler
+from .plomServer.routeutils import remove_stale_uploads
 
 
 # 5 is to keep debug/info lined up
@@ -72,6 +75,7 @@ def build_directories():
         "markedQuestions",
         "markedQuestions/plomFiles",
         "markedQuestions/commentFiles",
+        "latexFragments",
     ]
     for dir in lst:
         try:
@@ -85,11 +89,12 @@ def build_directories():
 
 
 class Server(object):
-    def __init__(self, spec, db, masterToken):
+    def __init__(self, spec, db, masterToken, workers=None):
         log.debug("Initialising server")
         self.testSpec = spec
         self.authority = Authority(masterToken)
         self.DB = db
+        self.dispatcher = Dispatcher(workers)
         self.API = serverAPI
         self.Version = __version__
         print(
@@ -101,6 +106,7 @@ class Server(object):
         self.tempDirectory = tempfile.TemporaryDirectory()
         # Give directory correct permissions.
         subprocess.check_call(["chmod", "o-r", self.tempDirectory.name])
+        self.fragmentCache = FragmentCache("latexFragments", render=BatchRenderer())
         self.load_users()
 
     def load_users(self):
@@ -143,8 +149,10 @@ class Server(object):
     from .plomServer.serverUpload import (
         doesBundleExist,
         createNewBundle,
+        checkBundleManifest,
         sidToTest,
         addTestPage,
+        addTestPages,
         addHWPage,
         addLPage,
         processHWUploads,
@@ -197,7 +205,9 @@ class Server(object):
         MgetDoneTasks,
         MgetNextTask,
         MlatexFragment,
+        MlatexFragments,
         MclaimThisTask,
+        MclaimNextTask,
         MdidNotFinish,
         MrecordMark,
         MreturnMarkedTask,
@@ -264,7 +274,8 @@ def launch(masterToken=None):
     examDB = PlomDB(Path(specdir) / "plom.db")
     spec = SpecParser(Path(specdir) / "verifiedSpec.toml").spec
     build_directories()
-    peon = Server(spec, examDB, masterToken)
+    remove_stale_uploads("pages")
+    peon = Server(spec, examDB, masterToken, workers=serverInfo.get("workers"))
     userIniter = UserInitHandler(peon)
     uploader = UploadHandler(peon)
     ider = IDHandler(peon)
@@ -287,3 +298,5 @@ def launch(masterToken=None):
     except KeyboardInterrupt:
         log.info("Closing down")  # TODO: I never see this!
         pass
+    finally:
+        peon.dispatcher.shutdown()
@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright (C) 2020 Colin B. Macdonald
+
+from io import BytesIO
+
+from PIL import Image
+
+from .image_utils import gamma_adjust, is_wider, rotate, rotate_file, to_png
+
+
+def png_bytes(img):
+    out = BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue()
+
+
+def test_is_wider():
+    assert is_wider(png_bytes(Image.new("L", (20, 10))))
+    assert not is_wider(png_bytes(Image.new("L", (10, 20))))
+
+
+def test_gamma_white_stays_white():
+    img = Image.new("L", (3, 1))
+    img.putdata([255, 128, 0])
+    out = Image.open(BytesIO(gamma_adjust(png_bytes(img))))
+    assert list(out.getdata()) == [255, 64, 0]
+
+
+def test_gamma_keeps_palette_and_alpha():
+    img = Image.new("RGBA", (2, 1), (128, 128, 128, 100))
+    out = Image.open(BytesIO(gamma_adjust(png_bytes(img))))
+    assert out.getpixel((0, 0)) == (64, 64, 64, 100)
+    img = Image.new("L", (2, 1), 128).convert("P")
+    out = Image.open(BytesIO(gamma_adjust(png_bytes(img))))
+    assert out.mode == "P"
+    assert out.convert("L").getpixel((0, 0)) == 64
+
+
+def test_rotate_clockwise(tmpdir):
+    img = Image.new("L", (2, 1))
+    img.putdata([0, 255])
+    out = Image.open(BytesIO(rotate(png_bytes(img), 90)))
+    assert out.size == (1, 2)
+    assert list(out.getdata()) == [0, 255]
+    out = Image.open(BytesIO(rotate(png_bytes(img), "-90")))
+    assert list(out.getdata()) == [255, 0]
+    f = tmpdir / "x.png"
+    img.save(f)
+    rotate_file(f, 180)
+    assert list(Image.open(f).getdata()) == [255, 0]
+
+
+def test_to_png():
+    out = BytesIO()
+    Image.new("CMYK", (4, 4)).save(out, "JPEG")
+    img = Image.open(BytesIO(to_png(out.getvalue())))
+    assert img.format == "PNG"
+    assert img.size == (4, 4)
@@ -1,4 +1,7 @@
-from .misc_utils import format_int_list_with_runs
+import hashlib
+
+from .misc_utils import format_int_list_with_runs, md5sum_of_file
+from .misc_utils import read_jsonl, open_jsonl_for_append
 
 
 def test_runs():
@@ -14,3 +17,21 @@ def test_shortruns():
     L = ["1", "2", "4", "5", "6", "7", "9", "10", "12", "78", "79", "80"]
     out = "1, 2, 4-7, 9, 10, 12, 78-80"
     assert format_int_list_with_runs(L, use_unicode=False) == out
+
+
+def test_md5sum_of_file_in_chunks(tmpdir):
+    data = bytes(range(256)) * 1000
+    f = tmpdir / "foo.pdf"
+    f.write_binary(data)
+    assert md5sum_of_file(f, chunk_size=1000) == hashlib.md5(data).hexdigest()
+    assert md5sum_of_file(str(f)) == hashlib.md5(data).hexdigest()
+
+
+def test_jsonl_append_after_torn_line(tmpdir):
+    f = tmpdir / "foo.jsonl"
+    assert read_jsonl(f) == []
+    f.write('{"a": 1}\n{"b": ')
+    assert read_jsonl(f) == [{"a": 1}]
+    with open_jsonl_for_append(f) as fh:
+        fh.write('{"c": 3}\n')
+    assert read_jsonl(f) == [{"a": 1}, {"c": 3}]
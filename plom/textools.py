@@ -7,6 +7,7 @@ __credits__ = "The Plom Project Developers"
 __license__ = "AGPL-3.0-or-later"
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import hashlib
 import os
 import sys
 import subprocess
@@ -17,70 +18,153 @@ from pathlib import Path
 import pkg_resources
 
 
-def texFragmentToPNG(fragment, outName):
-    """Process a fragment of latex and produce a png image."""
-
-    head = r"""
+# Everything up to the fragments, see texFragmentToPNG
+fragment_preamble = r"""
     \documentclass[12pt]{article}
     \usepackage[letterpaper, textwidth=5in]{geometry}
     \usepackage{amsmath, amsfonts}
     \usepackage{xcolor}
     \usepackage[active, tightpage]{preview}
     \begin{document}
+    """
+
+# Wrapped around a fragment of latex by texFragmentToPNG
+fragment_head = (
+    fragment_preamble
+    + r"""
     \begin{preview}
     \color{red}
     """
+)
 
-    foot = r"""
+fragment_foot = r"""
     \end{preview}
     \end{document}
     """
 
-    # make a temp dir to build latex in
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with open(os.path.join(tmpdir, "frag.tex"), "w") as fh:
-            fh.write(head)
-            fh.write(fragment)
-            fh.write(foot)
 
-        latexIt = subprocess.run(
-            [
-                "latexmk",
-                "-quiet",
-                "-interaction=nonstopmode",
-                "-no-shell-escape",
-                "frag.tex",
-            ],
-            cwd=tmpdir,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        if latexIt.returncode != 0:
-            return False
+def texFragmentHash(fragment):
+    """A hash of a fragment of latex together with how we render it.
 
-        convertIt = subprocess.run(
-            [
-                "dvipng",
-                "-q",
-                "-D",
-                "225",
-                "-bg",
-                "transparent",
-                "frag.dvi",
-                "-o",
-                "frag.png",
-            ],
-            cwd=tmpdir,
-            stdout=subprocess.DEVNULL,
-        )
-        if convertIt.returncode != 0:
-            # sys.exit(convertIt.returncode)
-            return False
+    If the preamble changes then so do the hashes, so this is safe to
+    use as a key for caching rendered images.
+    """
+    src = fragment_head + fragment + fragment_foot
+    return hashlib.sha256(src.encode("utf-8")).hexdigest()
+
+
+def _latexAndConvert(src, tmpdir, outPattern):
+    """Compile latex source in a directory, convert DVI pages to png.
 
+    Args:
+        src (str): the latex source.
+        tmpdir (str): directory to work in.
+        outPattern (str): png filename, with "%d" for the page
+            number if there are several pages.
+
+    Returns:
+        bool: True if both latex and dvipng succeeded.
+    """
+    with open(os.path.join(tmpdir, "frag.tex"), "w") as fh:
+        fh.write(src)
+
+    latexIt = subprocess.run(
+        [
+            "latexmk",
+            "-quiet",
+            "-interaction=nonstopmode",
+            "-no-shell-escape",
+            "frag.tex",
+        ],
+        cwd=tmpdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if latexIt.returncode != 0:
+        return False
+
+    convertIt = subprocess.run(
+        [
+            "dvipng",
+            "-q",
+            "-D",
+            "225",
+            "-bg",
+            "transparent",
+            "frag.dvi",
+            "-o",
+            outPattern,
+        ],
+        cwd=tmpdir,
+        stdout=subprocess.DEVNULL,
+    )
+    if convertIt.returncode != 0:
+        # sys.exit(convertIt.returncode)
+        return False
+    return True
+
+
+def texFragmentToPNG(fragment, outName):
+    """Process a fragment of latex and produce a png image."""
+
+    # make a temp dir to build latex in
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if not _latexAndConvert(
+            fragment_head + fragment + fragment_foot, tmpdir, "frag.png"
+        ):
+            return False
         shutil.copyfile(os.path.join(tmpdir, "frag.png"), outName)
     return True
 
 
+def texFragmentsToPNGs(fragments, outNames):
+    """Process many fragments of latex and produce a png image of each.
+
+    The fragments go into one document, each in its own `preview`
+    environment, so LaTeX starts once for the lot and a single dvipng
+    call writes one image per page.  If that fails, say because one of
+    the fragments is broken, we fall back to doing them one at a time
+    so only the broken ones fail.
+
+    Args:
+        fragments (list): strings of latex.
+        outNames (list): where to write the png of each fragment.
+
+    Returns:
+        list: of bools, True for each fragment that was rendered.
+    """
+    if len(fragments) != len(outNames):
+        raise ValueError("Need one output filename per fragment")
+    if len(fragments) <= 1:
+        return [texFragmentToPNG(f, o) for f, o in zip(fragments, outNames)]
+
+    src = fragment_preamble
+    for fragment in fragments:
+        src += "\\begin{preview}\n\\color{red}\n"
+        src += fragment
+        src += "\n\\end{preview}\n"
+    src += "\\end{document}\n"
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pngs = [
+            os.path.join(tmpdir, "frag{}.png".format(n + 1))
+            for n in range(len(fragments))
+        ]
+        # make sure each fragment made exactly one page
+        if (
+            _latexAndConvert(src, tmpdir, "frag%d.png")
+            and all(os.path.isfile(f) for f in pngs)
+            and not os.path.isfile(
+                os.path.join(tmpdir, "frag{}.png".format(len(fragments) + 1))
+            )
+        ):
+            for png, outName in zip(pngs, outNames):
+                shutil.copyfile(png, outName)
+            return [True] * len(fragments)
+
+    return [texFragmentToPNG(f, o) for f, o in zip(fragments, outNames)]
+
+
 def buildLaTeX(src, out):
     """Compile a string or bytes of latex.
 